@@ -1,5 +1,125 @@
-from django.contrib import admin
-from simplemfa.models import AuthCode
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
 
+from simplemfa.models import AuthCode, DeliveryJob
+from simplemfa.rechallenge import rechallenge_users, CHUNK_SIZE
+from simplemfa.routers import get_mfa_database, get_user_database
 
-admin.site.register(AuthCode)
+
+def estimate_row_count(model, using="default"):
+    """
+    The planner's estimate of the number of rows in model's table (PostgreSQL and MySQL), or None
+    """
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        sql = "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass"
+    elif connection.vendor == "mysql":
+        sql = "SELECT table_rows FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s"
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [model._meta.db_table])
+        row = cursor.fetchone()
+    # PostgreSQL reports -1 for tables that were never analyzed
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids exact COUNT(*)s of large tables: the unfiltered changelist uses the database's row estimate
+    once it is above estimate_threshold, and filtered counts stop at max_count rows.
+    """
+    estimate_threshold = 10000
+    max_count = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, using=queryset.db)
+            if estimate is not None and estimate >= self.estimate_threshold:
+                return estimate
+        # COUNT(*) over a LIMITed subquery reads at most max_count index entries
+        return queryset.order_by()[:self.max_count].count()
+
+
+class CodeStatusListFilter(admin.SimpleListFilter):
+    title = "status"
+    parameter_name = "status"
+
+    def lookups(self, request, model_admin):
+        return [("active", "Active"), ("expired", "Expired")]
+
+    def queryset(self, request, queryset):
+        # both are range scans on the expires index
+        if self.value() == "active":
+            return queryset.filter(expires__gt=timezone.now())
+        if self.value() == "expired":
+            return queryset.filter(expires__lte=timezone.now())
+        return queryset
+
+
+@admin.register(AuthCode)
+class AuthCodeAdmin(admin.ModelAdmin):
+    list_display = ("user", "sent_via", "delivered_via", "created", "expires", "is_active")
+    list_select_related = ("user",)
+    list_filter = ("sent_via", CodeStatusListFilter)
+    search_fields = ("=user__username",)
+    raw_id_fields = ("user",)
+    readonly_fields = ("code",)
+    paginator = EstimatedCountPaginator
+    # the "x of y selected" total would be another exact COUNT(*) of the whole table
+    show_full_result_count = False
+    actions = ["purge_expired", "revoke_codes", "rechallenge"]
+
+    def users_in_mfa_database(self):
+        # joins to the user table only work when users are read from the MFA database
+        return get_mfa_database() == get_user_database()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if not self.users_in_mfa_database():
+            queryset = queryset.prefetch_related("user")
+        return queryset
+
+    def get_list_select_related(self, request):
+        # an empty tuple, as False would make the changelist select_related() the user anyway
+        return self.list_select_related if self.users_in_mfa_database() else ()
+
+    def get_search_fields(self, request):
+        return self.search_fields if self.users_in_mfa_database() else ()
+
+    def get_actions(self, request):
+        # delete_selected loads and lists every row, while purge_expired and revoke_codes delete set-based
+        actions = super().get_actions(request)
+        actions.pop("delete_selected", None)
+        return actions
+
+    def is_active(self, obj):
+        return obj.expires > timezone.now()
+    is_active.boolean = True
+    is_active.short_description = "Active"
+
+    def purge_expired(self, request, queryset):
+        # AuthCode has no dependent rows, so this is a single DELETE
+        deleted, _ = queryset.filter(expires__lte=timezone.now()).delete()
+        self.message_user(request, f"Purged {deleted} expired code(s).", messages.SUCCESS)
+    purge_expired.short_description = "Purge selected codes that have expired"
+
+    def revoke_codes(self, request, queryset):
+        user_ids = list(queryset.values_list("user_id", flat=True))
+        deleted = 0
+        for start in range(0, len(user_ids), CHUNK_SIZE):
+            chunk = user_ids[start:start + CHUNK_SIZE]
+            DeliveryJob.objects.filter(user_id__in=chunk, status="PENDING").delete()
+            deleted += AuthCode.objects.filter(user_id__in=chunk).delete()[0]
+        self.message_user(request, f"Revoked {deleted} code(s).", messages.SUCCESS)
+    revoke_codes.short_description = "Revoke all codes and pending deliveries of the selected users"
+
+    def rechallenge(self, request, queryset):
+        count = rechallenge_users(list(queryset.values_list("user_id", flat=True)))
+        self.message_user(request, f"{count} user(s) must complete MFA again.", messages.SUCCESS)
+    rechallenge.short_description = "Re-challenge the selected users"
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class SimplemfaConfig(AppConfig):
     name = 'simplemfa'
+
+    def ready(self):
+        from simplemfa.conf import get_config
+        # resolve and validate the simplemfa settings once at startup, so misconfiguration fails fast
+        get_config()
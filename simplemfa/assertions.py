@@ -0,0 +1,127 @@
+"""
+MFA assertions
+
+With MFA_ASSERTION_ENABLED, a successful MFA login also issues a short-lived signed assertion
+"<user id>:<expiry>:<epoch>:<MFA epochs>:<trust epochs>" as a cookie and in the X-MFA-Assertion
+response header. Clients without sessions (e.g. API clients using tokens) send it back in the
+X-MFA-Assertion request header. Checking it is an HMAC, a few comparisons and one cache get_many()
+of the user's current MFA and trust epochs (one per cache if MFA_RECHALLENGE_CACHE and
+MFA_TRUSTED_DEVICE_CACHE differ; epochs missing from the cache are read from the database once and
+cached). So re-challenging the user (rechallenge.py) or revoking their trusted devices (devices.py)
+invalidates it, and changing MFA_ASSERTION_EPOCH invalidates every assertion issued before. Logging
+out deletes the assertion cookie.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.core import signing
+from django.dispatch import receiver
+
+from simplemfa import devices, rechallenge
+from simplemfa.conf import get_config
+from simplemfa.helpers import set_cookie
+
+
+COOKIE_NAME = "_simplemfa_assertion"
+HEADER_NAME = "X-MFA-Assertion"
+META_NAME = "HTTP_X_MFA_ASSERTION"
+SIGNING_SALT = "simplemfa.assertions"
+# set on the request by logout, so ValidateMFAMiddleware deletes the assertion cookie from the response
+LOGGED_OUT_ATTRIBUTE = "_simplemfa_logged_out"
+
+
+def get_signer():
+    return signing.Signer(salt=SIGNING_SALT)
+
+
+def get_user_epochs(user_id):
+    """
+    The user's MFA and trust epochs (and the global ones) in the form kept in assertions
+    """
+    config = get_config()
+    if config.MFA_RECHALLENGE_CACHE == config.MFA_TRUSTED_DEVICE_CACHE:
+        keys = [rechallenge.mfa_epoch_key(user_id), rechallenge.global_epoch_key(),
+                devices.user_epoch_key(user_id), devices.global_epoch_key()]
+        cached = rechallenge.get_epoch_cache().get_many(keys)
+        if len(cached) == len(keys):
+            return "{}.{}:{}.{}".format(*(cached[key] for key in keys))
+    # separate caches, or epochs not cached yet: read (and cache) them the usual way
+    mfa_epochs, trust_epochs = rechallenge.get_mfa_epochs(user_id), devices.get_epochs(user_id)
+    return f"{mfa_epochs[0]}.{mfa_epochs[1]}:{trust_epochs[0]}.{trust_epochs[1]}"
+
+
+def issue_assertion(user_id, max_age=None):
+    config = get_config()
+    if max_age is None:
+        max_age = config.MFA_ASSERTION_MAX_AGE
+    return get_signer().sign(f"{user_id}:{int(time.time()) + max_age}:{config.MFA_ASSERTION_EPOCH}:"
+                             f"{get_user_epochs(user_id)}")
+
+
+def set_assertion(response, user_id):
+    """
+    Adds a new assertion for user_id to response, as a cookie and as a header
+    """
+    max_age = get_config().MFA_ASSERTION_MAX_AGE
+    assertion = issue_assertion(user_id, max_age=max_age)
+    set_cookie(response, COOKIE_NAME, assertion, days_expire=max_age / (24 * 60 * 60), httponly=True)
+    response[HEADER_NAME] = assertion
+    return assertion
+
+
+def delete_assertion(response):
+    response.delete_cookie(COOKIE_NAME, domain=settings.SESSION_COOKIE_DOMAIN)
+
+
+@receiver(user_logged_out)
+def end_assertion(sender, request, user, **kwargs):
+    # the signal has no response to change, so the middleware deletes the cookie on the way out
+    if request is not None:
+        setattr(request, LOGGED_OUT_ATTRIBUTE, True)
+
+
+def verify_assertion(assertion, user_id):
+    try:
+        value = get_signer().unsign(assertion)
+        # assertions issued before epochs were included have too few parts and are refused
+        asserted_user, expires, epoch, mfa_epochs, trust_epochs = value.rsplit(":", 4)
+        if asserted_user != str(user_id) or int(expires) <= time.time() or \
+                int(epoch) != get_config().MFA_ASSERTION_EPOCH:
+            return False
+    except (signing.BadSignature, ValueError):
+        return False
+    # checked last: the signature and expiry cost no cache round trip
+    return f"{mfa_epochs}:{trust_epochs}" == get_user_epochs(user_id)
+
+
+def get_request_assertion(request):
+    return request.META.get(META_NAME) or request.COOKIES.get(COOKIE_NAME)
+
+
+def has_valid_assertion(request, user=None):
+    """
+    True if assertions are enabled and the request carries a valid one for user (default request.user)
+    """
+    if not get_config().MFA_ASSERTION_ENABLED:
+        return False
+    assertion = get_request_assertion(request)
+    if not assertion:
+        return False
+    if user is None:
+        user = request.user
+    return user.is_authenticated and verify_assertion(assertion, user.pk)
+
+
+class HasMFAAssertion:
+    """
+    A Django REST framework permission class (no import of DRF needed) for APIs whose token
+    authentication runs in the view, after ValidateMFAMiddleware has seen an anonymous request
+    """
+    message = "A valid MFA assertion is required."
+
+    def has_permission(self, request, view):
+        return has_valid_assertion(request)
+
+    def has_object_permission(self, request, view, obj):
+        return True
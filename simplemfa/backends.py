@@ -0,0 +1,351 @@
+"""
+Delivery backends for MFA codes
+
+Each delivery mode (EMAIL, TEXT, PHONE) maps to a backend class in MFA_DELIVERY_BACKENDS. Backends are
+imported on first use, so deployments that only send email never import twilio, and one instance
+of each backend (including its provider client and HTTP connection pool) is reused for the life of
+the process.
+
+Backends also have an asend() coroutine used by the async views. It runs send() in a worker thread
+unless the backend has a native async implementation, and a send_many() method used by the outbox
+worker to deliver a batch of queued codes.
+"""
+import asyncio
+import smtplib
+import threading
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template import TemplateDoesNotExist
+from django.utils.module_loading import import_string
+
+from simplemfa.conf import get_config
+from simplemfa.rendering import get_cached_template, render_cached_template, build_voice_twiml
+
+
+DEFAULT_DELIVERY_BACKENDS = {
+    "EMAIL": "simplemfa.backends.EmailBackend",
+    "TEXT": "simplemfa.backends.TwilioTextBackend",
+    "PHONE": "simplemfa.backends.TwilioVoiceBackend",
+}
+
+
+class BaseDeliveryBackend:
+
+    def __init__(self, mode=None):
+        self.mode = mode
+
+    def send(self, user, context):
+        """
+        Sends context['code'] to the user, returning True if the provider accepted the message
+        """
+        raise NotImplementedError("Subclasses of BaseDeliveryBackend must provide a send() method")
+
+    async def asend(self, user, context):
+        # not thread sensitive: a slow provider must not hold up the thread that runs the ORM
+        return await sync_to_async(self.send, thread_sensitive=False)(user, context)
+
+    def send_many(self, deliveries):
+        """
+        Sends a list of (user, context) pairs, returning a list of results in the same order
+        """
+        return [self.send(user, context) for user, context in deliveries]
+
+
+class EmailBackend(BaseDeliveryBackend):
+    """
+    Sends codes as a multipart message: the plain text template plus, if html_template_name exists, an
+    HTML alternative. send() connects per message and send_many() sends a whole batch over one connection.
+    With MFA_EMAIL_REUSE_CONNECTION each thread instead keeps one open connection from get_connection()
+    (SMTP connections are not thread-safe) and reuses it for every message, so the SMTP handshake is paid
+    once per thread rather than once per code.
+    """
+    template_name = 'simplemfa/auth_email.html'
+    html_template_name = 'simplemfa/auth_email_html.html'
+    # errors after which the connection is assumed stale (e.g. closed by the server while idle)
+    stale_connection_errors = (smtplib.SMTPServerDisconnected, ConnectionError)
+
+    _local = threading.local()
+    # bumped when the email settings change, so every thread drops its connection on next use
+    _generation = 0
+
+    def has_html_template(self):
+        if self.html_template_name is None:
+            return False
+        try:
+            get_cached_template(self.html_template_name)
+            return True
+        except TemplateDoesNotExist:
+            return False
+
+    def build_message(self, user, context, connection=None):
+        subject = f"{context['app_name']} Verification Code"
+        from_email = settings.DEFAULT_FROM_EMAIL or f"no-reply@{context['host']}"
+        message = EmailMultiAlternatives(subject, render_cached_template(self.template_name, context), from_email,
+                                         [user.email], connection=connection)
+        if self.has_html_template():
+            message.attach_alternative(render_cached_template(self.html_template_name, context), "text/html")
+        return message
+
+    @classmethod
+    def get_connection(cls):
+        if not get_config().MFA_EMAIL_REUSE_CONNECTION:
+            return get_connection(fail_silently=False)
+        local = cls._local
+        if getattr(local, "generation", None) != EmailBackend._generation or local.connection is None:
+            cls.close_connection()
+            local.connection = get_connection(fail_silently=False)
+            local.connection.open()
+            local.generation = EmailBackend._generation
+        return local.connection
+
+    @classmethod
+    def close_connection(cls):
+        connection = getattr(cls._local, "connection", None)
+        cls._local.connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    @classmethod
+    def reset_connections(cls):
+        EmailBackend._generation += 1
+
+    def send_messages(self, messages, connection=None):
+        if connection is not None:
+            return connection.send_messages(messages)
+        try:
+            return self.get_connection().send_messages(messages)
+        except self.stale_connection_errors:
+            if not get_config().MFA_EMAIL_REUSE_CONNECTION:
+                raise
+            # one retry on a fresh connection
+            self.close_connection()
+            return self.get_connection().send_messages(messages)
+
+    def send(self, user, context):
+        return bool(self.send_messages([self.build_message(user, context)]))
+
+    def send_many(self, deliveries):
+        # one message at a time over the same connection: a single send_messages() call for the batch
+        # raises at the first bad message, after the earlier ones went out, and does not say which failed
+        connection = None
+        if not get_config().MFA_EMAIL_REUSE_CONNECTION:
+            connection = get_connection(fail_silently=False)
+            connection.open()
+        results = []
+        try:
+            for user, context in deliveries:
+                try:
+                    results.append(bool(user.email) and
+                                   bool(self.send_messages([self.build_message(user, context)], connection)))
+                except Exception:
+                    results.append(False)
+        finally:
+            if connection is not None:
+                connection.close()
+        return results
+
+
+class TwilioBackend(BaseDeliveryBackend):
+    """
+    Shares one twilio.rest.Client per channel and process. Its HTTP client keeps a pooled requests
+    session, so the TCP/TLS connection to the Twilio API is reused between messages, and its timeout is
+    the channel's own delivery time budget.
+    """
+    _clients = {}
+    _client_lock = threading.Lock()
+    # aiohttp sessions belong to an event loop, so async clients are kept per loop (and channel)
+    _async_clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def get_timeout(cls, mode):
+        from simplemfa.breakers import get_breaker_settings
+        # the HTTP timeout is the channel's delivery time budget, so a hung provider fails fast
+        return get_breaker_settings(mode)["TIME_BUDGET"] or None
+
+    @classmethod
+    def get_client(cls, mode="TEXT"):
+        config = get_config()
+        if not config.TWILIO_CONFIGURED:
+            return None
+        client = TwilioBackend._clients.get(mode)
+        if client is None:
+            with TwilioBackend._client_lock:
+                client = TwilioBackend._clients.get(mode)
+                if client is None:
+                    from twilio.http.http_client import TwilioHttpClient
+                    from twilio.rest import Client
+                    http_client = TwilioHttpClient(pool_connections=True, timeout=cls.get_timeout(mode))
+                    client = TwilioBackend._clients[mode] = Client(config.TWILIO_ACCOUNT_SID,
+                                                                   config.TWILIO_AUTH_TOKEN, http_client=http_client)
+        return client
+
+    @classmethod
+    def get_async_client(cls, mode="TEXT"):
+        """
+        Returns a twilio.rest.Client using twilio's aiohttp-based AsyncTwilioHttpClient for the running
+        event loop, or None if Twilio is not configured or aiohttp is not installed
+        """
+        config = get_config()
+        if not config.TWILIO_CONFIGURED:
+            return None
+        loop = asyncio.get_running_loop()
+        clients = TwilioBackend._async_clients.setdefault(loop, {})
+        client = clients.get(mode)
+        if client is None:
+            try:
+                from twilio.http.async_http_client import AsyncTwilioHttpClient
+            except ImportError:
+                return None
+            from twilio.rest import Client
+            client = clients[mode] = Client(config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN,
+                                            http_client=AsyncTwilioHttpClient(timeout=cls.get_timeout(mode)))
+        return client
+
+    @classmethod
+    def reset_client(cls):
+        with TwilioBackend._client_lock:
+            TwilioBackend._clients.clear()
+            TwilioBackend._async_clients.clear()
+
+    def get_recipient(self, user):
+        from simplemfa.helpers import parse_phone
+        getter = get_config().USER_PHONE_GETTER
+        if getter is None:
+            return None
+        recipient = getter(user)
+        return parse_phone(recipient) if recipient is not None else None
+
+    def send(self, user, context):
+        client = self.get_client(self.mode)
+        if client is None:
+            return False
+        try:
+            recipient = self.get_recipient(user)
+            if recipient is None:
+                return False
+            self.send_to(client, recipient, context)
+            return True
+        except Exception:
+            return False
+
+    def send_to(self, client, recipient, context):
+        raise NotImplementedError("Subclasses of TwilioBackend must provide a send_to() method")
+
+    async def asend(self, user, context):
+        client = self.get_async_client(self.mode)
+        if client is None:
+            return await super().asend(user, context)
+        try:
+            # the phone getter may follow a relation (e.g. "profile.phone"), which queries the database
+            recipient = await sync_to_async(self.get_recipient)(user)
+            if recipient is None:
+                return False
+            await self.asend_to(client, recipient, context)
+            return True
+        except Exception:
+            return False
+
+    async def asend_to(self, client, recipient, context):
+        raise NotImplementedError("Subclasses of TwilioBackend must provide an asend_to() method")
+
+
+class TwilioTextBackend(TwilioBackend):
+    template_name = 'simplemfa/auth_text.html'
+
+    def send_to(self, client, recipient, context):
+        msg = str(render_cached_template(self.template_name, context))
+        client.messages.create(to=recipient, from_=get_config().TWILIO_NUMBER, body=msg)
+
+    async def asend_to(self, client, recipient, context):
+        msg = str(render_cached_template(self.template_name, context))
+        await client.messages.create_async(to=recipient, from_=get_config().TWILIO_NUMBER, body=msg)
+
+
+class TwilioVoiceBackend(TwilioBackend):
+    template_name = 'simplemfa/auth_voice.html'
+
+    def send_to(self, client, recipient, context):
+        msg = str(render_cached_template(self.template_name, context)) + ","
+        twiml = build_voice_twiml(msg, context['code'])
+        client.calls.create(to=recipient, from_=get_config().TWILIO_NUMBER, twiml=twiml)
+
+    async def asend_to(self, client, recipient, context):
+        msg = str(render_cached_template(self.template_name, context)) + ","
+        twiml = build_voice_twiml(msg, context['code'])
+        await client.calls.create_async(to=recipient, from_=get_config().TWILIO_NUMBER, twiml=twiml)
+
+
+# messages "sent" through LocMemBackend, like django.core.mail.outbox
+outbox = []
+
+
+class LocMemBackend(BaseDeliveryBackend):
+    """
+    A local, in-memory provider for tests and development. Set fail = True on the class to simulate a
+    provider outage, and delay to a number of seconds to simulate provider latency.
+    """
+    fail = False
+    delay = 0
+
+    def send(self, user, context):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.record(user, context)
+
+    async def asend(self, user, context):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.record(user, context)
+
+    def record(self, user, context):
+        if self.fail:
+            return False
+        outbox.append({"mode": self.mode, "user_id": user.id, "code": context['code'], "context": context})
+        return True
+
+
+_backend_cache = {}
+_backend_lock = threading.Lock()
+
+
+def get_delivery_backends():
+    backends = dict(DEFAULT_DELIVERY_BACKENDS)
+    backends.update(get_config().MFA_DELIVERY_BACKENDS)
+    return backends
+
+
+def get_delivery_backend(mode):
+    """
+    Returns the (process-wide) backend instance for a delivery mode, or None if the mode is unknown
+    """
+    backend = _backend_cache.get(mode)
+    if backend is None:
+        path = get_delivery_backends().get(mode)
+        if path is None:
+            return None
+        with _backend_lock:
+            backend = _backend_cache.get(mode)
+            if backend is None:
+                backend = import_string(path)(mode=mode)
+                _backend_cache[mode] = backend
+    return backend
+
+
+@receiver(setting_changed)
+def reset_delivery_backends(**kwargs):
+    if kwargs["setting"] == "MFA_DELIVERY_BACKENDS":
+        _backend_cache.clear()
+    elif kwargs["setting"] in ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "MFA_CIRCUIT_BREAKER"):
+        TwilioBackend.reset_client()
+    elif kwargs["setting"].startswith("EMAIL_") or kwargs["setting"] == "MFA_EMAIL_REUSE_CONNECTION":
+        EmailBackend.reset_connections()
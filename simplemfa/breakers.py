@@ -0,0 +1,112 @@
+"""
+Circuit breakers for the non-email delivery channels
+
+After FAILURE_THRESHOLD consecutive failures (or calls slower than TIME_BUDGET seconds) a channel's
+breaker opens. While it is open, codes go straight to the email fallback instead of waiting on a
+provider that is down. After RESET_TIMEOUT seconds a single request is let through to probe the
+channel: a success closes the breaker again, a failure opens it for another RESET_TIMEOUT. State is
+kept in the Django cache so every worker process shares it.
+"""
+import logging
+import time
+
+from django.core.cache import caches
+
+from simplemfa.conf import get_config
+from simplemfa.signals import circuit_opened, circuit_closed
+
+
+logger = logging.getLogger("simplemfa")
+
+DEFAULT_CIRCUIT_BREAKER = {
+    "ENABLED": True,
+    "FAILURE_THRESHOLD": 5,
+    "RESET_TIMEOUT": 60,
+    "TIME_BUDGET": 5.0,
+    "CACHE": "default",
+}
+
+
+def get_breaker_settings(channel):
+    config = dict(DEFAULT_CIRCUIT_BREAKER)
+    overrides = get_config().MFA_CIRCUIT_BREAKER
+    config.update({key: value for key, value in overrides.items() if key != "CHANNELS"})
+    config.update(overrides.get("CHANNELS", {}).get(channel, {}))
+    return config
+
+
+class CircuitBreaker:
+    key_prefix = "simplemfa:breaker"
+
+    def __init__(self, channel, failure_threshold=5, reset_timeout=60, time_budget=5.0, cache_alias="default"):
+        self.channel = channel
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.time_budget = time_budget
+        self.cache_alias = cache_alias
+
+    @classmethod
+    def for_channel(cls, channel):
+        config = get_breaker_settings(channel)
+        if not config["ENABLED"]:
+            return None
+        return cls(channel, failure_threshold=config["FAILURE_THRESHOLD"], reset_timeout=config["RESET_TIMEOUT"],
+                   time_budget=config["TIME_BUDGET"], cache_alias=config["CACHE"])
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def make_key(self, name):
+        return f"{self.key_prefix}:{self.channel}:{name}"
+
+    def allow_request(self):
+        opened_until = self.cache.get(self.make_key("opened_until"))
+        if opened_until is None:
+            return True
+        if time.time() < opened_until:
+            return False
+        # half-open: exactly one request (across all workers) probes the channel
+        return self.cache.add(self.make_key("probe"), True, timeout=max(int(self.time_budget) + 1, 1))
+
+    def record(self, succeeded, elapsed=0.0):
+        if succeeded and (self.time_budget is None or elapsed <= self.time_budget):
+            self.record_success()
+        else:
+            self.record_failure()
+
+    def record_success(self):
+        values = self.cache.get_many([self.make_key("failures"), self.make_key("opened_until")])
+        if not values:
+            return
+        self.cache.delete_many([self.make_key("failures"), self.make_key("opened_until"), self.make_key("probe")])
+        if self.make_key("opened_until") in values:
+            logger.info("simplemfa circuit breaker closed for channel %s", self.channel)
+            circuit_closed.send(sender=self.__class__, channel=self.channel)
+
+    def record_failure(self):
+        key = self.make_key("failures")
+        # keep the failure count around long enough to span a full open/probe cycle
+        self.cache.add(key, 0, timeout=self.reset_timeout * 2)
+        try:
+            failures = self.cache.incr(key)
+        except ValueError:
+            failures = 1
+            self.cache.set(key, failures, timeout=self.reset_timeout * 2)
+
+        now = time.time()
+        opened_until = self.cache.get(self.make_key("opened_until"))
+        # a failed probe reopens the breaker even if the failure count expired while it was open
+        if failures >= self.failure_threshold or opened_until is not None:
+            self.cache.set(self.make_key("opened_until"), now + self.reset_timeout, timeout=self.reset_timeout * 2)
+            self.cache.delete(self.make_key("probe"))
+            # only announce the transition, not failures of calls already in flight when it opened
+            if opened_until is None or opened_until <= now:
+                logger.warning("simplemfa circuit breaker opened for channel %s after %s failures",
+                               self.channel, failures)
+                circuit_opened.send(sender=self.__class__, channel=self.channel, failures=failures,
+                                    reset_timeout=self.reset_timeout)
+
+
+def get_circuit_breaker(channel):
+    return CircuitBreaker.for_channel(channel)
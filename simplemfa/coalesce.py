@@ -0,0 +1,41 @@
+"""
+Coalescing of duplicate code requests
+
+With MFA_REQUEST_COALESCE_SECONDS > 0, a second request for a code over the same channel within that
+many seconds reuses the outstanding code instead of replacing it and sending another message. The
+claim is an atomic cache.add, so it holds across worker processes sharing the cache.
+"""
+from django.core.cache import caches
+
+from simplemfa.conf import get_config
+
+
+KEY_PREFIX = "simplemfa:coalesce"
+
+
+def get_coalesce_cache():
+    return caches[get_config().MFA_REQUEST_COALESCE_CACHE]
+
+
+def claim_code_request(user_id, mode):
+    """
+    Returns True if the caller should issue and send a new code, False if an identical request was
+    handled within the coalescing window
+    """
+    window = get_config().MFA_REQUEST_COALESCE_SECONDS
+    if not window:
+        return True
+    cache = get_coalesce_cache()
+    key = f"{KEY_PREFIX}:{user_id}"
+    if cache.add(key, mode, timeout=window):
+        return True
+    if cache.get(key) == mode:
+        return False
+    # a different channel was requested: its code replaces the outstanding one, so it is not a duplicate
+    cache.set(key, mode, timeout=window)
+    return True
+
+
+def release_code_request(user_id):
+    if get_config().MFA_REQUEST_COALESCE_SECONDS:
+        get_coalesce_cache().delete(f"{KEY_PREFIX}:{user_id}")
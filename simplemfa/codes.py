@@ -0,0 +1,69 @@
+"""
+Random code generation
+
+Codes are drawn from the operating system's CSPRNG (the secrets module). Random bytes are read in one
+call per batch and mapped to the alphabet with a translation table, rejecting the bytes that would
+make some characters more likely than others (modulo bias), so every code in the alphabet is equally
+likely. Generating many codes at once (recovery codes, bulk enrollment, load tests) costs one
+system call and a few string operations rather than a call per character.
+"""
+import secrets
+import string
+from functools import lru_cache
+
+from simplemfa.conf import get_config
+
+
+DIGITS = string.digits
+
+
+@lru_cache(maxsize=16)
+def get_translation(alphabet):
+    """
+    Returns the table mapping every random byte to a character of alphabet, and the bytes to reject
+    """
+    size = len(alphabet)
+    if not 0 < size <= 256 or any(ord(char) > 127 for char in alphabet):
+        raise ValueError("The alphabet must contain between 1 and 256 ASCII characters.")
+    # bytes from limit up would favour the first 256 % size characters
+    limit = 256 - 256 % size
+    table = bytes(ord(alphabet[byte % size]) if byte < limit else 0 for byte in range(256))
+    return table, bytes(range(limit, 256)), limit
+
+
+def random_chars(count, alphabet=DIGITS):
+    """
+    Returns a string of count characters, each drawn uniformly and independently from alphabet
+    """
+    table, rejected, limit = get_translation(alphabet)
+    chars = ""
+    while len(chars) < count:
+        missing = count - len(chars)
+        # enough bytes to cover the expected rejections, so a second draw is rare
+        data = secrets.token_bytes(missing * 256 // limit + 8)
+        chars += data.translate(table, rejected).decode("ascii")
+    return chars[:count]
+
+
+def random_codes(count, length=None, alphabet=DIGITS, unique=False):
+    """
+    Returns a list of count random codes of length characters (MFA_CODE_LENGTH by default). With
+    unique=True the codes are all different.
+    """
+    if length is None:
+        length = get_config().MFA_CODE_LENGTH
+    if unique and count > len(alphabet) ** length:
+        raise ValueError(f"There are fewer than {count} distinct codes of length {length}.")
+
+    chars = random_chars(count * length, alphabet)
+    codes = [chars[start:start + length] for start in range(0, count * length, length)]
+    if unique:
+        # dict keeps the order, so the result stays a uniformly random sample
+        codes = list(dict.fromkeys(codes))
+        while len(codes) < count:
+            codes = list(dict.fromkeys(codes + random_codes(count - len(codes), length, alphabet)))
+    return codes
+
+
+def random_code(length=None, alphabet=DIGITS):
+    return random_chars(length if length is not None else get_config().MFA_CODE_LENGTH, alphabet)
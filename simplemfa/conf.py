@@ -0,0 +1,166 @@
+"""
+Resolved simplemfa settings
+
+All of the package's settings are read from django.conf.settings once, validated and stored in an
+immutable SimpleMFAConfig (see structures.CustomImmutableDict). The config is resolved and validated
+at app ready() and rebuilt lazily after any of its settings change (e.g. override_settings in tests).
+"""
+import re
+from operator import attrgetter
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from simplemfa.structures import CustomImmutableDict
+
+
+DEFAULTS = {
+    "REQUIRE_MFA": False,
+    "APP_NAME": None,
+    "MFA_CODE_LENGTH": 6,
+    "MFA_CODE_EXPIRATION": 15 * 60,
+    "MFA_CODE_DELIVERY_DEFAULT": "EMAIL",
+    "MFA_COOKIE_EXPIRATION_DAYS": 7,
+    "MFA_USER_MODE_ATTRIBUTE": None,
+    "MFA_USER_PHONE_ATTRIBUTE": None,
+    "MFA_CODE_HASHER": "simplemfa.hashers.HMACSHA256CodeHasher",
+    "MFA_CODE_STORE": "simplemfa.stores.DatabaseCodeStore",
+    "MFA_CODE_STORE_CACHE": "default",
+    "MFA_DATABASE": "default",
+    "MFA_USER_DATABASE": None,
+    "MFA_EXEMPT_PATHS": (),
+    "MFA_EXEMPT_PATH_PATTERNS": (),
+    "MFA_ASYNC_DELIVERY": False,
+    "MFA_DELIVERY_MAX_ATTEMPTS": 5,
+    "MFA_DELIVERY_RETRY_BACKOFF": 2,
+    "MFA_DELIVERY_BACKENDS": {},
+    "MFA_DELIVERY_FANOUT": (),
+    "MFA_DELIVERY_FANOUT_WORKERS": 10,
+    "MFA_CIRCUIT_BREAKER": {},
+    "MFA_RATE_LIMITS": {},
+    "MFA_RATE_LIMIT_CACHE": "default",
+    "MFA_RATE_LIMIT_PROXY_COUNT": 0,
+    "MFA_REQUEST_COALESCE_SECONDS": 0,
+    "MFA_REQUEST_COALESCE_CACHE": "default",
+    "MFA_TOTP_PERIOD": 30,
+    "MFA_TOTP_DIGITS": 6,
+    "MFA_TOTP_DRIFT_STEPS": 1,
+    "MFA_TOTP_ISSUER": None,
+    "MFA_TOTP_CACHE": "default",
+    "MFA_RECOVERY_CODE_COUNT": 10,
+    "MFA_RECOVERY_CODE_LENGTH": 10,
+    "MFA_TRUSTED_DEVICE_CACHE": "default",
+    "MFA_RECHALLENGE_CACHE": "default",
+    "MFA_ASSERTION_ENABLED": False,
+    "MFA_ASSERTION_MAX_AGE": 60 * 60,
+    "MFA_ASSERTION_EPOCH": 0,
+    "MFA_SERVER_TIMING": False,
+    "MFA_METRICS": False,
+    "MFA_EMAIL_REUSE_CONNECTION": False,
+    "TWILIO_ACCOUNT_SID": None,
+    "TWILIO_AUTH_TOKEN": None,
+    "TWILIO_NUMBER": None,
+}
+
+BUILTIN_DELIVERY_MODES = ("EMAIL", "TEXT", "PHONE", "TOTP")
+
+
+def compile_user_attribute(path):
+    """
+    Turns a dotted attribute path of request.user (e.g. "profile.phone") into a getter
+    """
+    if not path:
+        return None
+    return attrgetter(path)
+
+
+class SimpleMFAConfig(CustomImmutableDict):
+
+    @classmethod
+    def from_settings(cls):
+        values = {name: getattr(settings, name, default) for name, default in DEFAULTS.items()}
+        values["USER_MODE_GETTER"] = compile_user_attribute(values["MFA_USER_MODE_ATTRIBUTE"])
+        values["USER_PHONE_GETTER"] = compile_user_attribute(values["MFA_USER_PHONE_ATTRIBUTE"])
+        values["TWILIO_CONFIGURED"] = all(values[name] is not None for name in
+                                          ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "TWILIO_NUMBER"))
+        config = cls(values)
+        config.validate()
+        return config
+
+    def validate(self):
+        for name in ("MFA_CODE_LENGTH", "MFA_CODE_EXPIRATION", "MFA_DELIVERY_MAX_ATTEMPTS", "MFA_TOTP_PERIOD",
+                     "MFA_ASSERTION_MAX_AGE", "MFA_RECOVERY_CODE_COUNT", "MFA_DELIVERY_FANOUT_WORKERS"):
+            if not isinstance(self[name], int) or self[name] < 1:
+                raise ImproperlyConfigured(f"{name} must be a positive integer.")
+
+        if not isinstance(self.MFA_REQUEST_COALESCE_SECONDS, int) or self.MFA_REQUEST_COALESCE_SECONDS < 0:
+            raise ImproperlyConfigured("MFA_REQUEST_COALESCE_SECONDS must be a non-negative integer.")
+
+        if not isinstance(self.MFA_ASSERTION_EPOCH, int):
+            raise ImproperlyConfigured("MFA_ASSERTION_EPOCH must be an integer.")
+
+        if not isinstance(self.MFA_RECOVERY_CODE_LENGTH, int) or not 8 <= self.MFA_RECOVERY_CODE_LENGTH <= 32:
+            raise ImproperlyConfigured("MFA_RECOVERY_CODE_LENGTH must be an integer between 8 and 32.")
+
+        if self.MFA_TOTP_DIGITS not in (6, 7, 8):
+            raise ImproperlyConfigured("MFA_TOTP_DIGITS must be 6, 7 or 8.")
+
+        if not isinstance(self.MFA_TOTP_DRIFT_STEPS, int) or not 0 <= self.MFA_TOTP_DRIFT_STEPS <= 10:
+            raise ImproperlyConfigured("MFA_TOTP_DRIFT_STEPS must be an integer between 0 and 10.")
+
+        if self.MFA_COOKIE_EXPIRATION_DAYS is not None and \
+                (not isinstance(self.MFA_COOKIE_EXPIRATION_DAYS, (int, float)) or self.MFA_COOKIE_EXPIRATION_DAYS < 0):
+            raise ImproperlyConfigured("MFA_COOKIE_EXPIRATION_DAYS must be a non-negative number or None.")
+
+        if not isinstance(self.MFA_RATE_LIMIT_PROXY_COUNT, int) or self.MFA_RATE_LIMIT_PROXY_COUNT < 0:
+            raise ImproperlyConfigured("MFA_RATE_LIMIT_PROXY_COUNT must be a non-negative integer.")
+
+        for name in ("MFA_DELIVERY_BACKENDS", "MFA_CIRCUIT_BREAKER", "MFA_RATE_LIMITS"):
+            if not isinstance(self[name], dict):
+                raise ImproperlyConfigured(f"{name} must be a dict.")
+
+        for scope, limits in self.MFA_RATE_LIMITS.items():
+            for kind, limit in limits.items():
+                if kind not in ("USER", "IP") or len(limit) != 2 or min(limit) <= 0:
+                    raise ImproperlyConfigured(f"MFA_RATE_LIMITS[{scope!r}][{kind!r}] must be a positive "
+                                               f"(max_calls, window_seconds) pair keyed by \"USER\" or \"IP\".")
+
+        modes = set(BUILTIN_DELIVERY_MODES) | set(self.MFA_DELIVERY_BACKENDS)
+        if self.MFA_CODE_DELIVERY_DEFAULT not in modes:
+            raise ImproperlyConfigured(f"MFA_CODE_DELIVERY_DEFAULT must be one of {', '.join(sorted(modes))}.")
+
+        if not isinstance(self.MFA_DELIVERY_FANOUT, (list, tuple)) or \
+                any(channel not in modes or channel == "TOTP" for channel in self.MFA_DELIVERY_FANOUT):
+            raise ImproperlyConfigured("MFA_DELIVERY_FANOUT must be a list of delivery modes other than TOTP.")
+
+        for pattern in self.MFA_EXEMPT_PATH_PATTERNS:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ImproperlyConfigured(f"Invalid pattern in MFA_EXEMPT_PATH_PATTERNS ({pattern!r}): {e}")
+
+    def __repr__(self):
+        values = dict(self)
+        if values.get("TWILIO_AUTH_TOKEN"):
+            values["TWILIO_AUTH_TOKEN"] = "********"
+        return '<SimpleMFAConfig ' + dict.__repr__(values) + '>'
+
+
+_config = None
+
+
+def get_config():
+    global _config
+    config = _config
+    if config is None:
+        config = _config = SimpleMFAConfig.from_settings()
+    return config
+
+
+@receiver(setting_changed)
+def reset_config(**kwargs):
+    global _config
+    if kwargs["setting"] in DEFAULTS:
+        _config = None
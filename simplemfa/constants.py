@@ -6,4 +6,19 @@ class MessageConstants:
     ACCOUNT_NOT_FOUND = "Your account was not found."
     MFA_CODE_NOT_FOUND = "Your code was not found. Please request a new one."
     MFA_NEW_CODE_SENT = "A new code has been created and sent."
+    MFA_NEW_CODE_QUEUED = "A new code has been requested and will be sent shortly."
+    MFA_CODE_ALREADY_SENT = "A code was just sent. Please allow a few moments for it to arrive."
     MFA_GENERIC_ERROR = "Something went wrong. A code was not created. Try again."
+    MFA_RATE_LIMITED = "Too many attempts. Please wait a few minutes and try again."
+    MFA_TOTP_READY = "Enter the code shown in your authenticator app."
+    MFA_TOTP_NOT_ENROLLED = "No authenticator app is set up for your account."
+    MFA_TOTP_ENROLLED = "Your authenticator app has been set up."
+    MFA_TOTP_REMOVED = "Your authenticator app has been removed."
+    MFA_RECOVERY_CODES_GENERATED = "New recovery codes have been created. Any earlier ones no longer work."
+
+
+class CodeVerificationResult:
+    VALID = "VALID"
+    INVALID = "INVALID"
+    EXPIRED = "EXPIRED"
+    NOT_FOUND = "NOT_FOUND"
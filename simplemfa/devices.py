@@ -0,0 +1,131 @@
+"""
+Trusted ("remember this device") devices
+
+Trusting a device creates a TrustedDevice row and sets a signed cookie holding the row id, the user id
+and the user's and the global trust epoch at that moment. A device stays trusted while its row exists
+and has not expired and both epochs are unchanged. Raising an epoch therefore revokes all of one user's
+devices, or everyone's, in a single write without touching the device rows. Device expirations and
+epochs are cached, so checking a device on a warm cache costs one cache round trip and no SQL.
+"""
+import time
+
+from django.core import signing
+from django.core.cache import caches
+from django.utils import timezone
+
+from simplemfa.conf import get_config
+from simplemfa.helpers import set_cookie
+from simplemfa.models import TrustedDevice, MFAUserState, MFAEpoch
+
+
+COOKIE_NAME = "_simplemfa_trusted_device"
+SIGNING_SALT = "simplemfa.devices"
+KEY_PREFIX = "simplemfa:trust"
+GLOBAL_EPOCH = "trust"
+CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_device_cache():
+    return caches[get_config().MFA_TRUSTED_DEVICE_CACHE]
+
+
+def get_trust_seconds():
+    days = get_config().MFA_COOKIE_EXPIRATION_DAYS
+    return int((7 if days is None else days) * 24 * 60 * 60)
+
+
+def device_key(device_id):
+    return f"{KEY_PREFIX}:device:{device_id}"
+
+
+def user_epoch_key(user_id):
+    return f"{KEY_PREFIX}:user:{user_id}"
+
+
+def global_epoch_key():
+    return f"{KEY_PREFIX}:global"
+
+
+def trust_device(request, response):
+    """
+    Registers the requesting device as trusted for request.user and sets its cookie on response
+    """
+    user_id = request.user.pk
+    seconds = get_trust_seconds()
+    user_epoch, global_epoch = get_epochs(user_id)
+    device = TrustedDevice.objects.create(user_id=user_id, expires=timezone.now() + timezone.timedelta(seconds=seconds),
+                                          user_agent=request.META.get("HTTP_USER_AGENT", "")[:255])
+    token = signing.dumps({"d": device.id, "u": user_id, "e": user_epoch, "g": global_epoch}, salt=SIGNING_SALT)
+    set_cookie(response, COOKIE_NAME, token, httponly=True)
+    return device
+
+
+def read_device_token(request):
+    value = request.COOKIES.get(COOKIE_NAME)
+    if not value:
+        return None
+    try:
+        return signing.loads(value, salt=SIGNING_SALT, max_age=get_trust_seconds())
+    except (signing.BadSignature, ValueError):
+        # includes the unsigned timestamps set by earlier versions
+        return None
+
+
+def get_epochs(user_id):
+    cache = get_device_cache()
+    keys = (user_epoch_key(user_id), global_epoch_key())
+    cached = cache.get_many(keys)
+    if keys[0] not in cached:
+        cached[keys[0]] = MFAUserState.get_epoch(user_id)
+        # add(), not set(): never overwrite a newer value; revocations set() theirs after committing
+        cache.add(keys[0], cached[keys[0]], timeout=CACHE_TIMEOUT)
+    if keys[1] not in cached:
+        cached[keys[1]] = MFAEpoch.get_value(GLOBAL_EPOCH)
+        cache.add(keys[1], cached[keys[1]], timeout=CACHE_TIMEOUT)
+    return cached[keys[0]], cached[keys[1]]
+
+
+def is_trusted_device(request):
+    """
+    True if the request carries a valid, unrevoked trusted device cookie for request.user
+    """
+    token = read_device_token(request)
+    if token is None or token.get("u") != request.user.pk:
+        return False
+
+    cache = get_device_cache()
+    device_id, user_id = token["d"], token["u"]
+    keys = (device_key(device_id), user_epoch_key(user_id), global_epoch_key())
+    cached = cache.get_many(keys)
+
+    expires = cached.get(keys[0])
+    if expires is None:
+        expiration = TrustedDevice.get_expiration_for_device(device_id)
+        # unknown devices are cached as 0 so that revoked cookies do not reach the database either
+        expires = expiration.timestamp() if expiration is not None else 0
+        cache.add(keys[0], expires, timeout=CACHE_TIMEOUT)
+    if expires <= time.time():
+        return False
+
+    if keys[1] in cached and keys[2] in cached:
+        epochs = cached[keys[1]], cached[keys[2]]
+    else:
+        epochs = get_epochs(user_id)
+    return epochs == (token["e"], token["g"])
+
+
+def revoke_device(device_id):
+    TrustedDevice.objects.filter(id=device_id).delete()
+    get_device_cache().set(device_key(device_id), 0, timeout=CACHE_TIMEOUT)
+
+
+def revoke_user_devices(user_id):
+    epoch = MFAUserState.bump_epoch(user_id)
+    get_device_cache().set(user_epoch_key(user_id), epoch, timeout=CACHE_TIMEOUT)
+    return epoch
+
+
+def revoke_all_devices():
+    epoch = MFAEpoch.bump(GLOBAL_EPOCH)
+    get_device_cache().set(global_epoch_key(), epoch, timeout=CACHE_TIMEOUT)
+    return epoch
@@ -0,0 +1,106 @@
+"""
+Sending a code through several channels at once
+
+With MFA_DELIVERY_FANOUT a code is sent through every fan-out channel at the same time, on a bounded
+thread pool shared by the process (or as tasks on the event loop, for the async views), and delivery
+returns as soon as the first channel confirms. The other sends keep running after the response.
+Failures are logged to the simplemfa logger and counted by the channels' circuit breakers, but never
+hold up the user.
+"""
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+from django.dispatch import receiver
+
+from simplemfa.conf import get_config
+
+
+logger = logging.getLogger("simplemfa")
+
+_executor = None
+_executor_lock = threading.Lock()
+# sends still running after delivery returned; the event loop only keeps weak references to tasks
+_background_tasks = set()
+
+
+def get_executor():
+    global _executor
+    executor = _executor
+    if executor is None:
+        with _executor_lock:
+            executor = _executor
+            if executor is None:
+                executor = _executor = ThreadPoolExecutor(max_workers=get_config().MFA_DELIVERY_FANOUT_WORKERS,
+                                                          thread_name_prefix="simplemfa-fanout")
+    return executor
+
+
+@receiver(setting_changed)
+def reset_executor(**kwargs):
+    global _executor
+    if kwargs["setting"] == "MFA_DELIVERY_FANOUT_WORKERS":
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = None
+
+
+def log_result(channel, result):
+    if not result:
+        logger.warning("simplemfa delivery through channel %s failed", channel)
+    return result
+
+
+def run_channel(send, channel):
+    try:
+        return log_result(channel, bool(send(channel)))
+    except Exception:
+        logger.exception("simplemfa delivery through channel %s raised an error", channel)
+        return False
+    finally:
+        # the pool's threads outlive requests, so nothing else would close a connection a backend opened
+        close_old_connections()
+
+
+async def arun_channel(send, channel):
+    try:
+        return log_result(channel, bool(await send(channel)))
+    except Exception:
+        logger.exception("simplemfa delivery through channel %s raised an error", channel)
+        return False
+
+
+def fan_out(send, channels):
+    """
+    Calls send(channel) for all channels at once on the fan-out pool. Returns the first channel it
+    succeeded for as soon as it does, or None if it failed for every channel.
+    """
+    futures = {get_executor().submit(run_channel, send, channel): channel for channel in channels}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.result():
+                return futures[future]
+    return None
+
+
+async def afan_out(send, channels):
+    """
+    The coroutine version of fan_out(), awaiting send(channel) for all channels concurrently
+    """
+    tasks = {asyncio.ensure_future(arun_channel(send, channel)): channel for channel in channels}
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.result():
+                _background_tasks.update(pending)
+                for other in pending:
+                    other.add_done_callback(_background_tasks.discard)
+                return tasks[task]
+    return None
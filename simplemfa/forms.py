@@ -1,9 +1,17 @@
 from django import forms
-from django.contrib.auth.models import User
-from django.contrib.auth.hashers import check_password
-from simplemfa.models import AuthCode
-from django.utils import timezone
-from simplemfa.constants import MessageConstants
+from simplemfa.constants import MessageConstants, CodeVerificationResult
+from simplemfa.instrumentation import timed
+from simplemfa.models import TOTPDevice
+from simplemfa.recovery import looks_like_recovery_code, use_recovery_code
+from simplemfa.stores import get_code_store
+from simplemfa.totp import verify_totp
+
+
+VERIFICATION_ERRORS = {
+    CodeVerificationResult.NOT_FOUND: MessageConstants.MFA_CODE_NOT_FOUND,
+    CodeVerificationResult.EXPIRED: MessageConstants.MFA_CODE_EXPIRED,
+    CodeVerificationResult.INVALID: MessageConstants.MFA_CODE_NOT_AUTHENTICATED,
+}
 
 
 class MFAAuth(forms.Form):
@@ -12,37 +20,60 @@ class MFAAuth(forms.Form):
     next = forms.CharField(widget=forms.HiddenInput())
     trusted_device = forms.CharField(widget=forms.CheckboxInput())
 
+    def __init__(self, *args, user=None, mode=None, **kwargs):
+        # the view passes request.user, the only account codes are verified for
+        self.user = user
+        # the mode the code was requested with; TOTP codes are checked against the authenticator app secret
+        self.mode = mode
+        self.used_recovery_code = False
+        super().__init__(*args, **kwargs)
+
+    def get_user(self, user_id):
+        # codes are only ever checked for the logged in user: a posted user_id naming anybody else is
+        # refused, or a session could complete MFA with another account's code
+        if self.user is None or self.user.id != user_id or not self.user.is_active:
+            return None
+        return self.user
+
     def clean(self):
         cleaned_data = super().clean()
         auth_code = cleaned_data.get("auth_code", None)
         user_id = cleaned_data.get("user_id", None)
-        user = None
 
-        try:
-            User.objects.get(id=user_id, is_active=True)
-        except User.DoesNotExist:
+        if self.get_user(user_id) is None:
             self.add_error("user_id", MessageConstants.ACCOUNT_NOT_FOUND)
-        else:
-            user = User.objects.get(id=user_id, is_active=True)
-
-        try:
-            now = timezone.now()
-            auth = AuthCode.objects.get(user=user)
-        except [AuthCode.DoesNotExist, AuthCode.MultipleObjectsReturned]:
-            self.add_error("auth_code", MessageConstants.MFA_CODE_NOT_FOUND)
-        else:
-            if auth.expires <= now:
-                self.add_error("auth_code", MessageConstants.MFA_CODE_EXPIRED)
-                auth.delete()
-            elif not check_password(auth_code.upper(), auth.code):
-                self.add_error("auth_code", MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
+            return cleaned_data
+
+        if auth_code is None:
+            return cleaned_data
+
+        with timed("mfa.verify"):
+            # a recovery code works in place of any other code, including when none was requested
+            if looks_like_recovery_code(auth_code) and use_recovery_code(user_id, auth_code):
+                self.used_recovery_code = True
+                return cleaned_data
+
+            if self.mode == "TOTP":
+                self.clean_totp(user_id, auth_code)
+                return cleaned_data
+
+            result = get_code_store().verify(user_id, auth_code.upper())
+        if result != CodeVerificationResult.VALID:
+            self.add_error("auth_code", VERIFICATION_ERRORS[result])
+        return cleaned_data
+
+    def clean_totp(self, user_id, auth_code):
+        secret = TOTPDevice.get_secret_for_user(user_id)
+        if secret is None:
+            self.add_error("auth_code", MessageConstants.MFA_TOTP_NOT_ENROLLED)
+        elif not verify_totp(user_id, secret, auth_code):
+            self.add_error("auth_code", MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
 
     def authenticate(self):
         if self.is_valid():
             try:
-                auths = AuthCode.objects.filter(user_id=self.cleaned_data.get("user_id")).all()
-                for auth in auths:
-                    auth.delete()
+                if self.mode != "TOTP":
+                    get_code_store().delete_all_codes_for_user(self.cleaned_data.get("user_id"))
                 return True
             except:
                 self.add_error("auth_code", MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
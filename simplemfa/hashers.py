@@ -0,0 +1,117 @@
+"""
+Pluggable hashers for short-lived MFA codes
+
+MFA codes only live for a few minutes, so the key-stretching applied to user passwords by Django's
+default hashers (PBKDF2 with hundreds of thousands of iterations) buys very little while costing a
+lot of CPU on every code request and verification attempt. The default hasher here is a keyed
+HMAC-SHA256 digest (keyed from SECRET_KEY, salted per code) which is checked in constant time.
+
+Codes that were hashed with Django's password hashers (the format used by earlier versions of this
+package) are still verified through check_password(), so existing AuthCode rows keep working.
+"""
+import hashlib
+import hmac
+import secrets
+
+from django.conf import settings
+from django.contrib.auth.hashers import check_password, identify_hasher, make_password
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from simplemfa.conf import DEFAULTS, get_config
+
+
+class BaseCodeHasher:
+    algorithm = None
+
+    def encode(self, code):
+        raise NotImplementedError("Subclasses of BaseCodeHasher must provide an encode() method")
+
+    def verify(self, code, encoded):
+        raise NotImplementedError("Subclasses of BaseCodeHasher must provide a verify() method")
+
+    def handles(self, encoded):
+        return encoded.startswith(f"{self.algorithm}$")
+
+
+class HMACSHA256CodeHasher(BaseCodeHasher):
+    algorithm = "hmac_sha256"
+    salt_length = 16
+    key_salt = "simplemfa.hashers.HMACSHA256CodeHasher"
+
+    def __init__(self):
+        # derive a dedicated key so the raw SECRET_KEY is never used directly as the HMAC key
+        self.key = hashlib.sha256(f"{self.key_salt}{settings.SECRET_KEY}".encode()).digest()
+
+    def digest(self, code, salt):
+        return hmac.new(self.key, f"{salt}${code}".encode(), hashlib.sha256).hexdigest()
+
+    def encode(self, code):
+        salt = secrets.token_hex(self.salt_length // 2)
+        return f"{self.algorithm}${salt}${self.digest(code, salt)}"
+
+    def verify(self, code, encoded):
+        try:
+            algorithm, salt, digest = encoded.split("$", 2)
+        except ValueError:
+            return False
+        if algorithm != self.algorithm:
+            return False
+        return hmac.compare_digest(digest, self.digest(code, salt))
+
+
+class DjangoPasswordCodeHasher(BaseCodeHasher):
+    """
+    Hashes codes with Django's password hashers (make_password/check_password), as earlier
+    versions of this package did. Also used to verify codes stored in that format.
+    """
+
+    def encode(self, code):
+        return make_password(code)
+
+    def verify(self, code, encoded):
+        return check_password(code, encoded)
+
+    def handles(self, encoded):
+        try:
+            identify_hasher(encoded)
+        except ValueError:
+            return False
+        return True
+
+
+_hasher_cache = {}
+
+
+def get_code_hasher(path=None):
+    if path is None:
+        path = get_config().MFA_CODE_HASHER
+    if path not in _hasher_cache:
+        _hasher_cache[path] = import_string(path)()
+    return _hasher_cache[path]
+
+
+@receiver(setting_changed)
+def reset_code_hashers(**kwargs):
+    if kwargs["setting"] in ("MFA_CODE_HASHER", "SECRET_KEY"):
+        _hasher_cache.clear()
+
+
+def make_code_hash(code):
+    return get_code_hasher().encode(code)
+
+
+def check_code_hash(code, encoded):
+    if code is None or not encoded:
+        return False
+    hasher = get_code_hasher()
+    if hasher.handles(encoded):
+        return hasher.verify(code, encoded)
+
+    # fall back to any other known format so that codes issued before a hasher change still verify
+    for path in (DEFAULTS["MFA_CODE_HASHER"], "simplemfa.hashers.DjangoPasswordCodeHasher"):
+        fallback = get_code_hasher(path)
+        if fallback is not hasher and fallback.handles(encoded):
+            return fallback.verify(code, encoded)
+    return False
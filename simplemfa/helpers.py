@@ -1,11 +1,16 @@
+import time
+
 from django import template
-from django.core.mail import send_mail
-from django.template.loader import get_template
 from django.conf import settings
 from django.shortcuts import reverse
-from twilio.twiml.voice_response import VoiceResponse, Say
-from twilio.rest import Client
 from django.utils import timezone
+from simplemfa.backends import get_delivery_backend, TwilioBackend
+from simplemfa.breakers import get_circuit_breaker
+from simplemfa.conf import get_config
+from simplemfa.fanout import fan_out, afan_out
+from simplemfa.instrumentation import timed
+from simplemfa.rendering import get_cached_template, resolve_template_fallback
+from simplemfa.models import DeliveryJob
 
 
 def get_client_ip(request):
@@ -17,99 +22,88 @@ def get_client_ip(request):
     return ip
 
 
+def is_ajax(request):
+    # HttpRequest.is_ajax() was deprecated in Django 3.1 and removed in 4.0
+    return request.headers.get("x-requested-with") == "XMLHttpRequest"
+
+
 def template_exists(value):
     try:
-        template.loader.get_template(value)
+        get_cached_template(value)
         return True
     except template.TemplateDoesNotExist:
         return False
 
 
 def template_fallback(values):
-    for value in values:
-        if template_exists(value):
-            return value
-    raise template.TemplateDoesNotExist
+    return resolve_template_fallback(values)
+
+
+def get_app_name(request):
+    app_name = get_config().APP_NAME
+    return app_name if app_name is not None else f"{request.META.get('HTTP_HOST')}"
 
 
 def get_message_context(request, code):
+    return build_message_context(request.user, code, app_name=get_app_name(request),
+                                 url=request.build_absolute_uri(location=reverse('mfa:mfa-login')),
+                                 host=request.META.get('HTTP_HOST'), request=request)
+
+
+def build_message_context(user, code, app_name, url, host=None, request=None):
+    # everything the message templates need, without requiring a live request (e.g. for queued delivery)
     context = {
-        'username': request.user.username,
+        'username': user.username,
         'request': request,
-        'app_name': settings.APP_NAME if hasattr(settings, "APP_NAME") else f"{request.META.get('HTTP_HOST')}",
+        'app_name': app_name,
         'code': code,
-        'url': request.build_absolute_uri(location=reverse('mfa:mfa-login'))
+        'url': url,
+        'host': host,
     }
     return context
 
 
 def get_twilio_client():
-    if hasattr(settings, "TWILIO_ACCOUNT_SID") and hasattr(settings, "TWILIO_AUTH_TOKEN") and \
-            hasattr(settings, "TWILIO_NUMBER"):
-        return Client(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_AUTH_TOKEN)
-    return None
+    return TwilioBackend.get_client()
 
 
 def send_mfa_code_email(request, code):
-    html_template = get_template('simplemfa/auth_email.html')
-    context = get_message_context(request, code)
-    msg = html_template.render(context)
-    subject = f"{context['app_name']} Verification Code"
-    default_from_email = settings.DEFAULT_FROM_EMAIL if hasattr(settings, 'DEFAULT_FROM_EMAIL') else \
-        f"no-reply@{request.META.get('HTTP_HOST')}"
-    return send_mail(subject, msg, default_from_email, [request.user.email], fail_silently=False)
+    return deliver_mfa_code_email(request.user, get_message_context(request, code))
 
 
 def send_mfa_code_text(request, code):
-    template = get_template('simplemfa/auth_text.html')
-    context = get_message_context(request, code)
-    msg = str(template.render(context))
-    client = get_twilio_client()
-    if hasattr(settings, "MFA_USER_PHONE_ATTRIBUTE") and client is not None:
-        phone_object_string = f"request.user.{settings.MFA_USER_PHONE_ATTRIBUTE}"
-        try:
-            recipient = eval(phone_object_string)
-            if recipient is not None:
-                recipient = parse_phone(recipient)
-                client.messages.create(to=recipient,
-                                       from_=settings.TWILIO_NUMBER,
-                                       body=msg)
-                return True
-        except:
-            return False
-    return False
+    return deliver_mfa_code_text(request.user, get_message_context(request, code))
 
 
 def send_mfa_code_phone(request, code):
-    template = get_template('simplemfa/auth_voice.html')
-    context = get_message_context(request, code)
-    msg = str(template.render(context)) + ","
-    client = get_twilio_client()
-    if hasattr(settings, "MFA_USER_PHONE_ATTRIBUTE") and client is not None:
-        phone_object_string = f"request.user.{settings.MFA_USER_PHONE_ATTRIBUTE}"
-        try:
-            recipient = eval(phone_object_string)
-            code_list = [str(i) for i in str(code)]
-            if recipient is not None:
-                recipient = parse_phone(recipient)
-                response = VoiceResponse()
-                say = Say()
-                say.p(f",,,,,,,,,{msg},,,,,,,,,...")
-                for char in code_list:
-                    say.say_as(f",,,,,,,,...{str(char)},,,,,,,,...", interpret_as="spell-out")
-                say.p(f",,,,,,,,,...Again, {msg},,,,,,,,,")
-                for char in code_list:
-                    say.say_as(f",,,,,,,,...{str(char)},,,,,,,,...", interpret_as="spell-out")
-                say.p(",,,,,,Goodbye!")
-                response.append(say)
-                print(response.to_xml())
-                client.calls.create(to=recipient,
-                                    from_=settings.TWILIO_NUMBER,
-                                    twiml=str(response.to_xml()))
-                return True
-        except:
-            return False
-    return False
+    return deliver_mfa_code_phone(request.user, get_message_context(request, code))
+
+
+def deliver_mfa_code_email(user, context):
+    return send_with_backend(get_delivery_backend("EMAIL"), user, context)
+
+
+def deliver_mfa_code_text(user, context):
+    return send_with_backend(get_delivery_backend("TEXT"), user, context)
+
+
+def deliver_mfa_code_phone(user, context):
+    return send_with_backend(get_delivery_backend("PHONE"), user, context)
+
+
+def send_with_backend(backend, user, context):
+    with timed(f"mfa.provider.{backend.mode.lower()}"):
+        return backend.send(user, context)
+
+
+def send_many_with_backend(backend, deliveries):
+    with timed(f"mfa.provider.{backend.mode.lower()}"):
+        return backend.send_many(deliveries)
+
+
+async def asend_with_backend(backend, user, context):
+    with timed(f"mfa.provider.{backend.mode.lower()}"):
+        return await backend.asend(user, context)
 
 
 def parse_phone(phone):
@@ -120,54 +114,147 @@ def parse_phone(phone):
 
 
 def get_user_mfa_mode(request):
-    if hasattr(settings, "MFA_USER_MODE_ATTRIBUTE"):
-        mode_attr_string = f"request.user.{settings.MFA_USER_MODE_ATTRIBUTE}"
-        return eval(mode_attr_string) if eval(mode_attr_string) is not None else "EMAIL"
-    else:
-        return "EMAIL"
+    config = get_config()
+    mode = config.USER_MODE_GETTER(request.user) if config.USER_MODE_GETTER is not None else None
+    return mode if mode is not None else config.MFA_CODE_DELIVERY_DEFAULT
 
 
 def send_mfa_code(request, code, mode=None):
     if mode is None:
         mode = get_user_mfa_mode(request)
+    return deliver_mfa_code(request.user, get_message_context(request, code), mode=mode)
+
+
+def get_delivery_channels(mode):
+    """
+    The channels a code requested with mode is sent through: every MFA_DELIVERY_FANOUT channel that has
+    a backend if mode is one of them, otherwise mode alone
+    """
+    fanout = get_config().MFA_DELIVERY_FANOUT
+    if mode not in fanout:
+        return [mode]
+    return [channel for channel in fanout if get_delivery_backend(channel) is not None]
+
+
+def send_through_channel(channel, user, context):
+    """
+    Sends through the channel's backend and returns the result, or False if the channel has no backend
+    or its circuit breaker is open
+    """
+    backend = get_delivery_backend(channel)
+    if backend is None:
+        return False
+    breaker = get_circuit_breaker(channel) if channel != "EMAIL" else None
+    if breaker is None:
+        return send_with_backend(backend, user, context)
+    if not breaker.allow_request():
+        return False
+    start = time.monotonic()
+    result = send_with_backend(backend, user, context)
+    breaker.record(result, elapsed=time.monotonic() - start)
+    return result
+
+
+async def asend_through_channel(channel, user, context):
+    backend = get_delivery_backend(channel)
+    if backend is None:
+        return False
+    breaker = get_circuit_breaker(channel) if channel != "EMAIL" else None
+    if breaker is None:
+        return await asend_with_backend(backend, user, context)
+    if not breaker.allow_request():
+        return False
+    start = time.monotonic()
+    result = await asend_with_backend(backend, user, context)
+    breaker.record(result, elapsed=time.monotonic() - start)
+    return result
+
+
+def deliver_mfa_code(user, context, mode="EMAIL"):
+    """
+    Sends the code and returns the channel that confirmed delivery, or None if none did
+    """
+    channels = get_delivery_channels(mode)
+    if len(channels) > 1:
+        # sent through all channels at once; the first to confirm completes delivery
+        channel = fan_out(lambda channel: send_through_channel(channel, user, context), channels)
+        if channel is not None or "EMAIL" in channels:
+            return channel
+    elif mode != "EMAIL" and send_through_channel(mode, user, context):
+        return mode
+    # email is the default and the fallback for every other channel, including when its breaker is open
+    return "EMAIL" if deliver_mfa_code_email(user, context) else None
+
+
+async def asend_mfa_code(request, code, mode=None):
+    if mode is None:
+        mode = get_user_mfa_mode(request)
+    return await adeliver_mfa_code(request.user, get_message_context(request, code), mode=mode)
+
+
+async def adeliver_mfa_code(user, context, mode="EMAIL"):
+    """
+    The coroutine version of deliver_mfa_code(), awaiting the backends' asend()
+    """
+    channels = get_delivery_channels(mode)
+    if len(channels) > 1:
+        channel = await afan_out(lambda channel: asend_through_channel(channel, user, context), channels)
+        if channel is not None or "EMAIL" in channels:
+            return channel
+    elif mode != "EMAIL" and await asend_through_channel(mode, user, context):
+        return mode
+    return "EMAIL" if await asend_with_backend(get_delivery_backend("EMAIL"), user, context) else None
 
-    if mode == "TEXT":
-        if not send_mfa_code_text(request, code):
-            return send_mfa_code_email(request, code)
-        else:
-            return True
-    elif mode == "PHONE":
-        if not send_mfa_code_phone(request, code):
-            return send_mfa_code_email(request, code)
-        else:
-            return True
-    else:
-        return send_mfa_code_email(request, code)
+
+def async_delivery_enabled():
+    return get_config().MFA_ASYNC_DELIVERY
+
+
+def queue_mfa_code(request, mode=None):
+    if mode is None:
+        mode = get_user_mfa_mode(request)
+    # only one outstanding code per user, so any older queued delivery is obsolete
+    DeliveryJob.cancel_pending_for_user(request.user.id)
+    return DeliveryJob.enqueue(request.user.id, mode, app_name=get_app_name(request),
+                               url=request.build_absolute_uri(location=reverse('mfa:mfa-login')),
+                               host=request.META.get('HTTP_HOST'))
+
+
+def build_job_context(job):
+    return build_message_context(job.user, job.code, app_name=job.app_name, url=job.url, host=job.host)
+
+
+def deliver_queued_mfa_code(job):
+    return deliver_mfa_code(job.user, build_job_context(job), mode=job.sent_via)
+
+
+def deliver_queued_mfa_codes_email(jobs):
+    """
+    Delivers a batch of queued email codes with one send_many() call, returning a result per job
+    """
+    return send_many_with_backend(get_delivery_backend("EMAIL"), [(job.user, build_job_context(job)) for job in jobs])
 
 
 def get_user_phone(request):
-    if hasattr(settings, "MFA_USER_PHONE_ATTRIBUTE"):
-        mode_attr_string = f"request.user.{settings.MFA_USER_PHONE_ATTRIBUTE}"
-        return eval(mode_attr_string) if eval(mode_attr_string) is not None else None
-    return None
+    getter = get_config().USER_PHONE_GETTER
+    return getter(request.user) if getter is not None else None
 
 
 def get_cookie_expiration():
-    if hasattr(settings, "MFA_COOKIE_EXPIRATION_DAYS"):
-        return settings.MFA_COOKIE_EXPIRATION_DAYS
-    else:
-        return 7
+    return get_config().MFA_COOKIE_EXPIRATION_DAYS
 
 
-def set_cookie(response, key, value, days_expire=get_cookie_expiration()):
+def set_cookie(response, key, value, days_expire=None, httponly=False):
+    if days_expire is None:
+        days_expire = get_cookie_expiration()
     if days_expire is None:
         max_age = 7 * 24 * 60 * 60  # seven days
     else:
-        max_age = days_expire * 24 * 60 * 60
+        max_age = int(days_expire * 24 * 60 * 60)
     expires = timezone.datetime.strftime(timezone.now() + timezone.timedelta(seconds=max_age),
                                          "%a, %d-%b-%Y %H:%M:%S UTC")
     response.set_cookie(key, value, max_age=max_age, expires=expires, domain=settings.SESSION_COOKIE_DOMAIN,
-                        secure=settings.SESSION_COOKIE_SECURE or None)
+                        secure=settings.SESSION_COOKIE_SECURE or None, httponly=httponly)
 
 
 def sanitize_email(email):
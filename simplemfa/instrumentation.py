@@ -0,0 +1,144 @@
+"""
+Timing of the steps of the MFA flow
+
+Instrumented steps are wrapped in timed("<stage>"). Each measurement is:
+- sent as the simplemfa.signals.timing_recorded signal;
+- collected per request for the Server-Timing response header (MFA_SERVER_TIMING);
+- aggregated in process into counts and histograms (MFA_METRICS), which a metrics exporter can read
+  from get_metrics().snapshot().
+
+Stages: mfa.generate, mfa.hash, mfa.store, mfa.render, mfa.provider.<mode>, mfa.verify and
+mfa.middleware.
+"""
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from simplemfa.conf import get_config
+from simplemfa.signals import timing_recorded
+
+
+# upper bounds (seconds) of the histogram buckets, roughly 1-2.5-5 steps from 100us to 10s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, float("inf"))
+
+# stage -> total seconds for the current request, or None outside of a request with Server-Timing enabled
+_request_timings = ContextVar("simplemfa_request_timings", default=None)
+
+
+class StageTimer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.stage, perf_counter() - self.start)
+        return False
+
+
+def timed(stage):
+    return StageTimer(stage)
+
+
+def record(stage, duration):
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + duration
+    if get_config().MFA_METRICS:
+        get_metrics().observe(stage, duration)
+    if timing_recorded.receivers:
+        timing_recorded.send(sender=None, stage=stage, duration=duration)
+
+
+def start_request_timings():
+    """
+    Starts collecting timings for the current request; returns the token for finish_request_timings()
+    """
+    return _request_timings.set({})
+
+
+def finish_request_timings(token):
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    return timings or {}
+
+
+def format_server_timing(timings):
+    return ", ".join(f"{stage};dur={duration * 1000:.3f}" for stage, duration in timings.items())
+
+
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        """
+        The upper bound of the bucket holding the given fraction (0-1) of observations
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": list(zip(self.buckets, self.counts)),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+        }
+
+
+class MetricsRegistry:
+    """
+    Per-process histograms by stage. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, duration):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(duration)
+
+    def snapshot(self):
+        with self.lock:
+            return {stage: histogram.snapshot() for stage, histogram in self.histograms.items()}
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+_metrics = MetricsRegistry()
+
+
+def get_metrics():
+    return _metrics
@@ -0,0 +1,517 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import platform
+import random
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core import mail
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.http import HttpResponse
+from django.shortcuts import redirect, reverse
+from django.test import RequestFactory, override_settings
+from django.test.utils import setup_databases, teardown_databases
+from django.urls import resolve, Resolver404
+from django.utils import timezone
+from importlib import import_module
+
+from simplemfa.assertions import issue_assertion, COOKIE_NAME as ASSERTION_COOKIE_NAME
+from simplemfa.backends import LocMemBackend, outbox
+from simplemfa.codes import random_code, random_codes
+from simplemfa.devices import trust_device, COOKIE_NAME as DEVICE_COOKIE_NAME
+from simplemfa.forms import MFAAuth
+from simplemfa.helpers import deliver_mfa_code, adeliver_mfa_code
+from simplemfa.middleware import ValidateMFAMiddleware
+from simplemfa.models import AuthCode
+from simplemfa.stores import get_code_store
+from simplemfa.totp import generate_secret, match_totp, totp_code
+from simplemfa.views import MFARequestView
+
+
+GROUPS = ("middleware", "request", "verify", "cleanup", "codes", "totp", "delivery", "load")
+
+STORES = {
+    "database store": "simplemfa.stores.DatabaseCodeStore",
+    "cache store": "simplemfa.stores.CacheCodeStore",
+}
+
+# a self-contained setup: in-memory cache and email, a fake SMS/voice provider and no limits in the way
+BENCHMARK_SETTINGS = {
+    "REQUIRE_MFA": True,
+    "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                           "LOCATION": "simplemfa-benchmark"}},
+    "EMAIL_BACKEND": "django.core.mail.backends.locmem.EmailBackend",
+    "MFA_DELIVERY_BACKENDS": {"TEXT": "simplemfa.backends.LocMemBackend",
+                              "PHONE": "simplemfa.backends.LocMemBackend"},
+    "MFA_ASYNC_DELIVERY": False,
+    "MFA_RATE_LIMITS": {},
+    "MFA_REQUEST_COALESCE_SECONDS": 0,
+    "MFA_SERVER_TIMING": False,
+    "MFA_METRICS": False,
+}
+
+
+def legacy_process_view(request, view_func):
+    """
+    The ValidateMFAMiddleware.process_view implementation prior to the cached exempt matcher,
+    kept here as the baseline for the "before" numbers
+    """
+    mfa_required = settings.REQUIRE_MFA if hasattr(settings, "REQUIRE_MFA") else False
+    mfa_authenticated = request.session.get("_simplemfa_authenticated", False)
+
+    if getattr(view_func, 'login_exempt', False):
+        return None
+
+    if "_simplemfa_trusted_device" in request.COOKIES:
+        return None
+
+    if request.resolver_match is not None and 'simplemfa' in request.resolver_match.namespaces:
+        return None
+
+    if request.path in [reverse("simplemfa:mfa-login"), reverse("simplemfa:mfa-request"),
+                        reverse("login"), reverse("logout")]:
+        return None
+
+    if request.user.is_authenticated and mfa_required and not mfa_authenticated:
+        url = f"{reverse('simplemfa:mfa-login')}?next={request.path}"
+        return redirect(url, request)
+
+    return None
+
+
+def naive_match_totp(secret, code, timestamp, period=30, digits=6, drift=1):
+    """
+    A drift-window check that stops at the first match, kept as the baseline for simplemfa.totp.match_totp,
+    which computes every step so its timing does not reveal which step matched
+    """
+    key = base64.b32decode(secret + "=" * (-len(secret) % 8))
+    current = int(timestamp // period)
+    for counter in range(current - drift, current + drift + 1):
+        digest = hmac.new(key, struct.pack(">Q", counter), hashlib.sha1).digest()
+        start = digest[-1] & 0x0F
+        value = struct.unpack(">I", digest[start:start + 4])[0] & 0x7FFFFFFF
+        if str(value % 10 ** digits).zfill(digits) == code:
+            return counter
+    return None
+
+
+def naive_random_code(length=6):
+    """
+    The former numeric code generator (the non-cryptographic random module), kept as the baseline for
+    simplemfa.codes.random_code
+    """
+    return str(random.randint(10 ** (length - 1), 10 ** length - 1))
+
+
+def summarize(durations, wall_seconds=None):
+    """
+    Latency statistics for a list of per-call durations (seconds). Throughput is based on
+    wall_seconds when given (concurrent runs), otherwise on the summed durations.
+    """
+    durations = sorted(durations)
+    count = len(durations)
+    total = sum(durations)
+    elapsed = wall_seconds if wall_seconds is not None else total
+
+    def percentile(fraction):
+        return durations[min(count - 1, int(fraction * count))] * 1000000 if count else None
+
+    return {
+        "iterations": count,
+        "total_seconds": elapsed,
+        "per_call_us": total / count * 1000000 if count else None,
+        "p50_us": percentile(0.5),
+        "p95_us": percentile(0.95),
+        "p99_us": percentile(0.99),
+        "max_us": durations[-1] * 1000000 if count else None,
+        "calls_per_second": count / elapsed if elapsed else None,
+    }
+
+
+def time_calls(func, iterations, setup=None):
+    """
+    Times func() iterations times. setup(), if given, runs untimed before each call and its return
+    value is passed to func.
+    """
+    durations = []
+    for _ in range(iterations):
+        if setup is None:
+            start = time.perf_counter()
+            func()
+        else:
+            args = setup()
+            start = time.perf_counter()
+            func(args)
+        durations.append(time.perf_counter() - start)
+    return summarize(durations)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the simplemfa hot paths (middleware, code requests, verification, cleanup, delivery and " \
+           "concurrent load) against a throwaway test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=10000,
+                            help="Calls per middleware, code generation and TOTP scenario")
+        parser.add_argument("--flow-iterations", type=int, default=1000,
+                            help="Calls per code request and verification scenario")
+        parser.add_argument("--only", nargs="+", choices=GROUPS, help="Only run these scenario groups")
+        parser.add_argument("--path", default="/", help="A protected (non-exempt) path in your project")
+        parser.add_argument("--table-sizes", default="1000,10000",
+                            help="Comma-separated AuthCode table sizes for the cleanup scenarios")
+        parser.add_argument("--deliveries", type=int, default=50, help="Code deliveries in the delivery scenarios")
+        parser.add_argument("--provider-latency", type=float, default=0.05,
+                            help="Seconds each simulated provider call takes in the delivery and load scenarios")
+        parser.add_argument("--concurrency", type=int, default=8, help="Worker threads in the load scenario")
+        parser.add_argument("--load-cycles", type=int, default=200,
+                            help="Request and verify cycles in the load scenario")
+        parser.add_argument("--json", action="store_true", help="Output machine-readable JSON")
+        parser.add_argument("--output", help="Also write the JSON results to this file")
+        parser.add_argument("--compare", help="A JSON file from an earlier run to compare per-call times with")
+
+    def handle(self, *args, **options):
+        groups = options["only"] or GROUPS
+        try:
+            table_sizes = [int(size) for size in options["table_sizes"].split(",") if size]
+        except ValueError:
+            raise CommandError("--table-sizes must be a comma-separated list of integers.")
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            # RequestFactory requests come from "testserver"
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"], **BENCHMARK_SETTINGS):
+                results = self.run_benchmarks(groups, table_sizes, options)
+        finally:
+            LocMemBackend.delay = 0
+            outbox.clear()
+            teardown_databases(old_config, verbosity=0)
+
+        report = {
+            "meta": {
+                "timestamp": timezone.now().isoformat(),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "database": connection.vendor,
+                "groups": list(groups),
+                "options": {name: options[name] for name in ("iterations", "flow_iterations", "table_sizes",
+                                                            "deliveries", "provider_latency", "concurrency",
+                                                            "load_cycles")},
+            },
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+
+        baseline = {}
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f).get("results", {})
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        for name, result in results.items():
+            if result["per_call_us"] is None:
+                # every call of a load run failed
+                line = f"{name:<58} {'-':>12} us/call"
+            else:
+                line = f"{name:<58} {result['per_call_us']:>12.2f} us/call"
+            if result.get("p99_us") is not None:
+                line += f"  p99 {result['p99_us']:>12.2f} us"
+            line += f"  ({result['iterations']} calls)"
+            previous = baseline.get(name, {}).get("per_call_us")
+            if previous and result["per_call_us"] is not None:
+                line += f"  {(result['per_call_us'] - previous) / previous * 100:+.1f}% vs baseline"
+            if result.get("errors"):
+                line += f"  {result['errors']} errors, first: {result['first_error']}"
+            self.stdout.write(line)
+
+    def run_benchmarks(self, groups, table_sizes, options):
+        user = User.objects.create_user(username="simplemfa-benchmark", email="benchmark@example.com")
+        results = {}
+        if "middleware" in groups:
+            results.update(self.run_middleware_benchmarks(user, options))
+        if "request" in groups:
+            results.update(self.run_request_benchmarks(user, options["flow_iterations"]))
+        if "verify" in groups:
+            results.update(self.run_verify_benchmarks(user, options["flow_iterations"]))
+        if "cleanup" in groups:
+            results.update(self.run_cleanup_benchmarks(table_sizes))
+        if "codes" in groups:
+            results.update(self.run_code_benchmarks(options["iterations"]))
+        if "totp" in groups:
+            results.update(self.run_totp_benchmarks(options["iterations"]))
+        if "delivery" in groups:
+            results.update(self.run_delivery_benchmarks(user, options["deliveries"], options["provider_latency"]))
+        if "load" in groups:
+            results.update(self.run_load_benchmarks(options))
+        return results
+
+    def run_middleware_benchmarks(self, user, options):
+        iterations = options["iterations"]
+        factory = RequestFactory()
+        engine = import_module(settings.SESSION_ENGINE)
+
+        session = engine.SessionStore()
+        session["_simplemfa_authenticated"] = True
+        session.save()
+        session_key = session.session_key
+
+        def view(request):
+            return HttpResponse()
+
+        middleware = ValidateMFAMiddleware(view)
+
+        def build_request(path, authenticated):
+            request = factory.get(path)
+            try:
+                request.resolver_match = resolve(path)
+            except Resolver404:
+                request.resolver_match = None
+            request.user = user if authenticated else AnonymousUser()
+            return request
+
+        trusted_request = build_request(options["path"], True)
+        trusted_response = HttpResponse()
+        trust_device(trusted_request, trusted_response)
+        trusted_request.COOKIES[DEVICE_COOKIE_NAME] = trusted_response.cookies[DEVICE_COOKIE_NAME].value
+
+        scenarios = {
+            "exempt path (login), anonymous": (build_request(reverse("login"), False), None),
+            "protected path, anonymous": (build_request(options["path"], False), None),
+            "protected path, MFA authenticated": (build_request(options["path"], True), session_key),
+            "protected path, trusted device": (trusted_request, None),
+        }
+
+        results = {}
+        for label, (request, key) in scenarios.items():
+            view_func = request.resolver_match.func if request.resolver_match is not None else view
+            for impl_label, impl in (("before", lambda r: legacy_process_view(r, view_func)),
+                                     ("after", lambda r: middleware.process_view(r, view_func, (), {}))):
+                def call(impl=impl, request=request, key=key):
+                    # a fresh, unloaded session per call as SessionMiddleware would provide
+                    request.session = engine.SessionStore(session_key=key)
+                    impl(request)
+                results[f"{impl_label}: {label}"] = time_calls(call, iterations)
+
+        # no session at all: the signed assertion replaces the session lookup. request.user is set directly,
+        # so this leaves out the session load AuthenticationMiddleware does for session-authenticated users
+        with override_settings(MFA_ASSERTION_ENABLED=True):
+            request = build_request(options["path"], True)
+            request.COOKIES[ASSERTION_COOKIE_NAME] = issue_assertion(user.pk)
+            view_func = request.resolver_match.func if request.resolver_match is not None else view
+
+            def call():
+                request.session = engine.SessionStore()
+                middleware.process_view(request, view_func, (), {})
+            results["after: protected path, MFA assertion"] = time_calls(call, iterations)
+
+        return results
+
+    def build_view_request(self, user, path):
+        request = RequestFactory().get(path, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        request.user = user
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+        return request
+
+    def run_request_benchmarks(self, user, iterations):
+        """
+        MFARequestView issuing a new code: code generation, hashing, storage and delivery through the
+        fake providers (email is rendered and sent to Django's locmem outbox)
+        """
+        view = MFARequestView.as_view()
+        results = {}
+        for store_label, store in STORES.items():
+            with override_settings(MFA_CODE_STORE=store):
+                for mode in ("EMAIL", "TEXT"):
+                    path = f"{reverse('simplemfa:mfa-request')}?sent_via={mode}"
+                    results[f"request: issue {mode} code, {store_label}"] = time_calls(
+                        view, iterations, setup=lambda path=path: self.build_view_request(user, path))
+                    mail.outbox = []
+                    outbox.clear()
+        return results
+
+    def run_verify_benchmarks(self, user, iterations):
+        """
+        MFAAuth verifying a submitted code, valid (the code is then consumed) and wrong
+        """
+        results = {}
+
+        def verify(code):
+            data = {"user_id": user.id, "auth_code": code, "next": "/", "trusted_device": "false"}
+            return MFAAuth(data, user=user).authenticate()
+
+        for store_label, store in STORES.items():
+            with override_settings(MFA_CODE_STORE=store):
+                code_store = get_code_store()
+                results[f"verify: valid code, {store_label}"] = time_calls(
+                    verify, iterations, setup=lambda: code_store.create_code_for_user(user.id, sent_via="EMAIL"))
+                code = code_store.create_code_for_user(user.id, sent_via="EMAIL")
+                wrong = str((int(code) + 1) % 10 ** len(code)).zfill(len(code))
+                results[f"verify: wrong code, {store_label}"] = time_calls(lambda: verify(wrong), iterations)
+                code_store.delete_all_codes_for_user(user.id)
+        return results
+
+    def run_cleanup_benchmarks(self, table_sizes):
+        """
+        simplemfa_purge and code issuance with the AuthCode table at the given sizes, half of it expired
+        """
+        results = {}
+        users = self.create_users(max(table_sizes, default=0))
+        for size in table_sizes:
+            self.fill_code_table(users[:size])
+            sample = random.sample(users[:size], min(size, 1000))
+            results[f"cleanup: issue code with {size} rows"] = time_calls(
+                lambda user_id: AuthCode.create_code_for_user(user_id, sent_via="EMAIL"), len(sample),
+                setup=iter(sample).__next__)
+
+            self.fill_code_table(users[:size])
+            start = time.perf_counter()
+            call_command("simplemfa_purge", skip_jobs=True, verbosity=0, stdout=StringIO())
+            elapsed = time.perf_counter() - start
+            deleted = size - AuthCode.objects.count()
+            results[f"cleanup: purge {size} rows"] = {
+                "iterations": deleted,
+                "total_seconds": elapsed,
+                "per_call_us": elapsed / deleted * 1000000 if deleted else None,
+                "calls_per_second": deleted / elapsed if elapsed else None,
+            }
+        AuthCode.objects.all().delete()
+        return results
+
+    def fill_code_table(self, user_ids):
+        AuthCode.objects.all().delete()
+        now = timezone.now()
+        expired = now - timezone.timedelta(minutes=1)
+        valid = now + timezone.timedelta(minutes=15)
+        AuthCode.objects.bulk_create([AuthCode(user_id=user_id, code="x", expires=expired if i % 2 else valid)
+                                      for i, user_id in enumerate(user_ids)], batch_size=1000)
+
+    def create_users(self, count):
+        existing = list(User.objects.filter(username__startswith="simplemfa-benchmark-")
+                        .order_by("id").values_list("id", flat=True))
+        if len(existing) < count:
+            User.objects.bulk_create([User(username=f"simplemfa-benchmark-{i}")
+                                      for i in range(len(existing), count)], batch_size=1000)
+            existing = list(User.objects.filter(username__startswith="simplemfa-benchmark-")
+                            .order_by("id").values_list("id", flat=True))
+        return existing[:count]
+
+    def run_load_benchmarks(self, options):
+        """
+        A concurrent load driver: worker threads, each with its own user, repeatedly hit a protected path
+        (redirected to MFA), request a text code from a fake provider with --provider-latency, and verify it
+        """
+        concurrency = options["concurrency"]
+        cycles = options["load_cycles"]
+        users = list(User.objects.filter(id__in=self.create_users(concurrency)))
+        request_view = MFARequestView.as_view()
+        middleware = ValidateMFAMiddleware(lambda request: HttpResponse())
+        request_path = f"{reverse('simplemfa:mfa-request')}?sent_via=TEXT"
+        protected_path = options["path"]
+
+        def cycle(user):
+            try:
+                start = time.perf_counter()
+                request = self.build_view_request(user, protected_path)
+                middleware.process_view(request, lambda r: None, (), {})
+                request_view(self.build_view_request(user, request_path))
+                code = next(entry["code"] for entry in reversed(outbox) if entry["user_id"] == user.id)
+                data = {"user_id": user.id, "auth_code": code, "next": "/", "trusted_device": "false"}
+                if not MFAAuth(data, user=user).authenticate():
+                    raise ValueError("verification failed")
+                return time.perf_counter() - start, None
+            except Exception as e:
+                return None, f"{type(e).__name__}: {e}"
+
+        def worker(index):
+            # one user per worker, so a worker's cycles never race each other's codes
+            try:
+                return [cycle(users[index]) for _ in range(index, cycles, concurrency)]
+            finally:
+                connections.close_all()
+
+        LocMemBackend.delay = options["provider_latency"]
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = [outcome for outcomes in executor.map(worker, range(concurrency)) for outcome in outcomes]
+            wall = time.perf_counter() - start
+        finally:
+            LocMemBackend.delay = 0
+            outbox.clear()
+
+        result = summarize([duration for duration, error in outcomes if error is None], wall_seconds=wall)
+        errors = [error for duration, error in outcomes if error is not None]
+        result["errors"] = len(errors)
+        if errors:
+            result["first_error"] = errors[0]
+        return {f"load: {concurrency} workers, request + verify cycle": result}
+
+    def run_delivery_benchmarks(self, user, deliveries, latency):
+        """
+        Sends codes through LocMemBackend with simulated provider latency: one after the other, as sync
+        views do per worker thread, and concurrently on one event loop, as the async views do
+        """
+        context = {"code": "000000"}
+
+        async def deliver_concurrently():
+            await asyncio.gather(*[adeliver_mfa_code(user, context, mode="TEXT") for _ in range(deliveries)])
+
+        backends = {mode: "simplemfa.backends.LocMemBackend" for mode in ("EMAIL", "TEXT", "PHONE")}
+        results = {}
+        with override_settings(MFA_DELIVERY_BACKENDS=backends, MFA_CIRCUIT_BREAKER={"ENABLED": False}):
+            LocMemBackend.delay = latency
+            try:
+                for label, run in (("sync, sequential", lambda: [deliver_mfa_code(user, context, mode="TEXT")
+                                                                   for _ in range(deliveries)]),
+                                   ("async, concurrent", lambda: asyncio.run(deliver_concurrently()))):
+                    start = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - start
+                    results[f"delivery ({latency * 1000:.0f} ms provider): {label}"] = {
+                        "iterations": deliveries,
+                        "total_seconds": elapsed,
+                        "per_call_us": elapsed / deliveries * 1000000,
+                        "calls_per_second": deliveries / elapsed if elapsed else None,
+                    }
+            finally:
+                LocMemBackend.delay = 0
+                outbox.clear()
+        return results
+
+    def run_code_benchmarks(self, iterations):
+        """
+        Generating codes one at a time and in batches of 1000 (e.g. bulk enrollment or recovery codes)
+        """
+        results = {}
+        for impl_label, impl in (("before", naive_random_code), ("after", random_code)):
+            results[f"{impl_label}: generate one code"] = time_calls(lambda impl=impl: impl(6), iterations)
+        batches = max(iterations // 1000, 1)
+        results["before: generate 1000 codes one at a time"] = time_calls(
+            lambda: [naive_random_code(6) for _ in range(1000)], batches)
+        results["after: generate 1000 codes in one batch"] = time_calls(lambda: random_codes(1000, 6), batches)
+        return results
+
+    def run_totp_benchmarks(self, iterations):
+        secret = generate_secret()
+        now = time.time()
+        results = {}
+        for drift in (1, 2):
+            # a wrong code is the worst case for both: every step in the window is computed
+            wrong = str((int(totp_code(secret, now)) + 1) % 1000000).zfill(6)
+            for impl_label, impl in (("before", naive_match_totp), ("after", match_totp)):
+                results[f"{impl_label}: totp drift window +/-{drift}"] = time_calls(
+                    lambda impl=impl, drift=drift: impl(secret, wrong, timestamp=now, drift=drift), iterations)
+        return results
@@ -0,0 +1,130 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.contrib.auth import get_user_model
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from simplemfa.helpers import deliver_queued_mfa_code, deliver_queued_mfa_codes_email, get_delivery_channels
+from simplemfa.models import DeliveryJob
+from simplemfa.routers import get_mfa_database, get_user_database
+from simplemfa.stores import get_code_store
+
+
+class Command(BaseCommand):
+    help = "Delivers MFA codes queued in the outbox when MFA_ASYNC_DELIVERY is enabled"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Jobs claimed per batch")
+        parser.add_argument("--loop", action="store_true", help="Keep polling the outbox instead of exiting "
+                                                                "once it is empty")
+        parser.add_argument("--sleep", type=float, default=1.0, help="Seconds to wait between polls in --loop mode")
+        parser.add_argument("--lease", type=int, default=60, help="Seconds a claimed job is hidden from other "
+                                                                  "workers before it can be retried")
+        parser.add_argument("--max-attempts", type=int, default=None,
+                            help="Defaults to MFA_DELIVERY_MAX_ATTEMPTS")
+        parser.add_argument("--backoff", type=float, default=None,
+                            help="Base retry delay in seconds, doubled after each failed attempt (defaults to "
+                                 "MFA_DELIVERY_RETRY_BACKOFF)")
+
+    def handle(self, *args, **options):
+        while True:
+            jobs = self.claim_batch(options["batch_size"], options["lease"])
+            self.process_batch(jobs, options)
+
+            if jobs and options["verbosity"] > 1:
+                self.stdout.write(f"Processed {len(jobs)} delivery job(s)")
+
+            if not options["loop"]:
+                if len(jobs) < options["batch_size"]:
+                    break
+            elif not jobs:
+                time.sleep(options["sleep"])
+
+    def claim_batch(self, batch_size, lease):
+        """
+        Claims due jobs by pushing their next_attempt past the lease, so concurrent workers (and the
+        retry of a worker that died mid-batch) never pick up the same job at the same time
+        """
+        now = timezone.now()
+        using = get_mfa_database()
+        with transaction.atomic(using=using):
+            queryset = DeliveryJob.objects.filter(status="PENDING", next_attempt__lte=now).order_by("next_attempt")
+            if connections[using].features.has_select_for_update_skip_locked:
+                queryset = queryset.select_for_update(skip_locked=True)
+            job_ids = list(queryset.values_list("id", flat=True)[:batch_size])
+            if not job_ids:
+                return []
+            DeliveryJob.objects.filter(id__in=job_ids).update(next_attempt=now + timezone.timedelta(seconds=lease),
+                                                               attempts=F("attempts") + 1)
+        return self.attach_users(list(DeliveryJob.objects.filter(id__in=job_ids)))
+
+    def attach_users(self, jobs):
+        """
+        Loads the jobs' users in one query on the user database, which may differ from MFA_DATABASE
+        """
+        users = get_user_model()._default_manager.using(get_user_database()).in_bulk({job.user_id for job in jobs})
+        field = DeliveryJob._meta.get_field("user")
+        for job in jobs:
+            if job.user_id in users:
+                field.set_cached_value(job, users[job.user_id])
+        return jobs
+
+    def process_batch(self, jobs, options):
+        now = timezone.now()
+        email_jobs = []
+        # email that fans out to other channels is delivered one job at a time, like the other modes
+        batch_email = get_delivery_channels("EMAIL") == ["EMAIL"]
+        for job in jobs:
+            if job.expires <= now:
+                job.mark_failed("The code expired before it could be delivered.")
+            elif not DeliveryJob._meta.get_field("user").is_cached(job) or not self.issue_code(job):
+                # the user was deleted, so there is nobody to deliver to
+                job.mark_failed("The user no longer exists.", max_attempts=0)
+            elif job.sent_via == "EMAIL" and batch_email:
+                email_jobs.append(job)
+            else:
+                self.process(job, options)
+
+        if email_jobs:
+            # queued emails go out together over one connection
+            try:
+                results = deliver_queued_mfa_codes_email(email_jobs)
+            except Exception as e:
+                results = [False] * len(email_jobs)
+                error = str(e)
+            else:
+                error = ""
+            for job, result in zip(email_jobs, results):
+                self.record(job, result, error, options)
+
+    def issue_code(self, job):
+        """
+        Creates the job's code in the code store now, so the outbox never holds it. Jobs queued by earlier
+        versions bring their code along on their first attempt.
+        """
+        if not job.code:
+            job.code = get_code_store().create_code_for_user(job.user_id, sent_via=job.sent_via)
+        return job.code
+
+    def process(self, job, options):
+        error = ""
+        try:
+            # TEXT and PHONE fall back to email, the same as inline delivery
+            channel = deliver_queued_mfa_code(job)
+        except Exception as e:
+            channel = None
+            error = str(e)
+        if channel is not None and channel != job.sent_via:
+            get_code_store().record_delivery(job.user_id, channel)
+        self.record(job, channel is not None, error, options)
+
+    def record(self, job, result, error, options):
+        if result:
+            job.mark_sent()
+        else:
+            job.mark_failed(error or "Delivery failed.", max_attempts=options["max_attempts"],
+                            backoff=options["backoff"])
+            if options["verbosity"] > 0:
+                self.stderr.write(f"Delivery job {job.id} failed (attempt {job.attempts}): {job.last_error}")
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from simplemfa.models import AuthCode, DeliveryJob, TrustedDevice
+
+
+class Command(BaseCommand):
+    help = "Deletes expired MFA codes (and finished delivery jobs and expired trusted devices) in small " \
+           "chunks of primary keys"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Maximum rows deleted per statement")
+        parser.add_argument("--sleep", type=float, default=0.0, help="Seconds to pause between chunks to "
+                                                                     "throttle load on the database")
+        parser.add_argument("--max-chunks", type=int, default=None, help="Stop after this many chunks per table "
+                                                                         "(the next run picks up the rest)")
+        parser.add_argument("--skip-jobs", action="store_true", help="Only purge AuthCode rows")
+
+    def handle(self, *args, **options):
+        # a fixed cutoff keeps each run bounded even while new codes keep expiring
+        cutoff = timezone.now()
+
+        # codes and devices are walked in the order of their expires index
+        deleted = self.purge(AuthCode, Q(expires__lte=cutoff), options, ordering=("expires", "pk"))
+        self.report(AuthCode, deleted, options)
+
+        if not options["skip_jobs"]:
+            finished = Q(expires__lte=cutoff) | Q(status__in=["SENT", "FAILED"])
+            deleted = self.purge(DeliveryJob, finished, options)
+            self.report(DeliveryJob, deleted, options)
+
+        deleted = self.purge(TrustedDevice, Q(expires__lte=cutoff), options, ordering=("expires", "pk"))
+        self.report(TrustedDevice, deleted, options)
+
+    def purge(self, model, condition, options, ordering=("pk",)):
+        total = 0
+        chunks = 0
+        while options["max_chunks"] is None or chunks < options["max_chunks"]:
+            # only primary keys are read, never whole objects. Deleted rows no longer match, so every chunk
+            # starts at the front of the index instead of re-sorting the rows already seen.
+            pks = list(model.objects.filter(condition).order_by(*ordering)
+                       .values_list("pk", flat=True)[:options["chunk_size"]])
+            if not pks:
+                break
+
+            # the condition is checked again, so rows that changed in between survive
+            deleted, _ = model.objects.filter(condition, pk__in=pks).delete()
+            total += deleted
+            chunks += 1
+
+            if options["verbosity"] > 1:
+                self.stdout.write(f"{model._meta.verbose_name_plural}: deleted {deleted} row(s) ({total} so far)")
+            if len(pks) < options["chunk_size"]:
+                break
+            if options["sleep"]:
+                time.sleep(options["sleep"])
+        return total
+
+    def report(self, model, deleted, options):
+        if options["verbosity"] > 0:
+            self.stdout.write(f"Purged {deleted} {model._meta.verbose_name_plural}")
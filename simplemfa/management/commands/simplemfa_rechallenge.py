@@ -0,0 +1,56 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from simplemfa.rechallenge import rechallenge_users, rechallenge_all, CHUNK_SIZE
+from simplemfa.routers import get_user_database
+
+
+class Command(BaseCommand):
+    help = "Forces users to complete MFA again on their next request, e.g. after a suspected compromise"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", action="append", default=[], help="Username to re-challenge (may be repeated)")
+        parser.add_argument("--file", help="A file with one username per line to re-challenge")
+        parser.add_argument("--all", action="store_true", help="Re-challenge every user")
+        parser.add_argument("--keep-devices", action="store_true", help="Do not revoke the users' trusted devices")
+        parser.add_argument("--keep-codes", action="store_true", help="Do not delete outstanding codes and "
+                                                                      "pending deliveries")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Users updated per statement")
+
+    def handle(self, *args, **options):
+        if not (options["user"] or options["file"] or options["all"]):
+            raise CommandError("Pass --user, --file or --all.")
+
+        start = time.monotonic()
+        codes, devices = not options["keep_codes"], not options["keep_devices"]
+        if options["all"]:
+            rechallenge_all(codes=codes, devices=devices)
+            message = "Re-challenged all users"
+        else:
+            count = rechallenge_users(self.get_user_ids(options), chunk_size=options["chunk_size"],
+                                      codes=codes, devices=devices)
+            message = f"Re-challenged {count} user(s)"
+        if options["verbosity"] > 0:
+            self.stdout.write(f"{message} in {time.monotonic() - start:.2f}s")
+
+    def get_user_ids(self, options):
+        user_model = get_user_model()
+        usernames = list(options["user"])
+        if options["file"]:
+            try:
+                with open(options["file"]) as f:
+                    usernames += [line.strip() for line in f if line.strip()]
+            except OSError as e:
+                raise CommandError(f"Cannot read {options['file']}: {e}")
+
+        user_ids = []
+        field = f"{user_model.USERNAME_FIELD}__in"
+        for offset in range(0, len(usernames), options["chunk_size"]):
+            chunk = usernames[offset:offset + options["chunk_size"]]
+            user_ids += user_model.objects.using(get_user_database()).filter(**{field: chunk}) \
+                .values_list("pk", flat=True)
+        if len(user_ids) < len(set(usernames)) and options["verbosity"] > 0:
+            self.stderr.write(f"{len(set(usernames)) - len(user_ids)} username(s) do not exist and were skipped")
+        return user_ids
@@ -0,0 +1,37 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from simplemfa.devices import revoke_device, revoke_user_devices, revoke_all_devices
+from simplemfa.routers import get_user_database
+
+
+class Command(BaseCommand):
+    help = "Revokes trusted devices, so MFA is required again on them"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--user", action="append", default=[], help="Username whose devices are revoked "
+                                                                        "(may be repeated)")
+        parser.add_argument("--device", action="append", type=int, default=[], help="TrustedDevice id to revoke "
+                                                                                    "(may be repeated)")
+        parser.add_argument("--all", action="store_true", help="Revoke every trusted device of every user")
+
+    def handle(self, *args, **options):
+        if not (options["user"] or options["device"] or options["all"]):
+            raise CommandError("Pass --user, --device or --all.")
+
+        if options["all"]:
+            epoch = revoke_all_devices()
+            self.stdout.write(f"Revoked all trusted devices (global trust epoch is now {epoch})")
+
+        user_model = get_user_model()
+        for username in options["user"]:
+            try:
+                user = user_model.objects.using(get_user_database()).get(**{user_model.USERNAME_FIELD: username})
+            except user_model.DoesNotExist:
+                raise CommandError(f"User {username!r} does not exist.")
+            revoke_user_devices(user.pk)
+            self.stdout.write(f"Revoked trusted devices of {username}")
+
+        for device_id in options["device"]:
+            revoke_device(device_id)
+            self.stdout.write(f"Revoked trusted device {device_id}")
@@ -1,33 +1,153 @@
-from django.conf import settings
+import asyncio
+import re
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import redirect, reverse
+from django.urls import NoReverseMatch
+
+from simplemfa.assertions import has_valid_assertion, delete_assertion, LOGGED_OUT_ATTRIBUTE
+from simplemfa.conf import get_config
+from simplemfa.devices import is_trusted_device
+from simplemfa.instrumentation import timed, start_request_timings, finish_request_timings, \
+    format_server_timing
+from simplemfa.rechallenge import is_mfa_authenticated
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6 (Django < 4.1)
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
+def build_exempt_matcher(exempt_paths=(), exempt_patterns=()):
+    """
+    Compiles path prefixes (plain strings) and regular expressions into a single anchored pattern
+    so that a request path is tested against all of them in one match() call
+    """
+    alternatives = [re.escape(prefix) for prefix in exempt_paths if prefix]
+    alternatives += [f"(?:{pattern})" for pattern in exempt_patterns if pattern]
+    if not alternatives:
+        return None
+    return re.compile("|".join(alternatives))
 
 
 class ValidateMFAMiddleware:
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            # under ASGI the handler awaits process_view, so exempt requests never leave the event loop
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+        # URL reversal needs the URLconf, which may not be importable yet when middleware is loaded,
+        # so the exempt set is built on the first request and reused until the settings change
+        self._config = None
+        self._exempt_urls = None
+        self._exempt_matcher = None
+        self._mfa_login_url = None
 
     def __call__(self, request):
-        return self.get_response(request)
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not get_config().MFA_SERVER_TIMING:
+            return self.finish_response(request, self.get_response(request))
+        token = start_request_timings()
+        try:
+            response = self.get_response(request)
+        finally:
+            timings = finish_request_timings(token)
+        return self.finish_response(request, self.add_server_timing(response, timings))
 
-    def process_view(self, request, view_func, view_args, view_kwargs):
-        mfa_required = settings.REQUIRE_MFA if hasattr(settings, "REQUIRE_MFA") else False
-        mfa_authenticated = request.session.get("_simplemfa_authenticated", False)
+    async def __acall__(self, request):
+        if not get_config().MFA_SERVER_TIMING:
+            return self.finish_response(request, await self.get_response(request))
+        token = start_request_timings()
+        try:
+            response = await self.get_response(request)
+        finally:
+            timings = finish_request_timings(token)
+        return self.finish_response(request, self.add_server_timing(response, timings))
+
+    def finish_response(self, request, response):
+        # logging out ends the MFA assertion cookie along with the session
+        if getattr(request, LOGGED_OUT_ATTRIBUTE, False):
+            delete_assertion(response)
+        return response
+
+    def add_server_timing(self, response, timings):
+        if timings:
+            existing = response.get("Server-Timing")
+            value = format_server_timing(timings)
+            response["Server-Timing"] = f"{existing}, {value}" if existing else value
+        return response
+
+    def _build_exemptions(self, config):
+        exempt_urls = set()
+        for name in ("simplemfa:mfa-login", "simplemfa:mfa-request", "login", "logout"):
+            try:
+                exempt_urls.add(reverse(name))
+            except NoReverseMatch:
+                pass
+        self._exempt_matcher = build_exempt_matcher(config.MFA_EXEMPT_PATHS, config.MFA_EXEMPT_PATH_PATTERNS)
+        self._mfa_login_url = reverse("simplemfa:mfa-login")
+        self._exempt_urls = frozenset(exempt_urls)
+        self._config = config
+
+    def is_exempt(self, request, view_func):
+        config = get_config()
+        if self._config is not config:
+            self._build_exemptions(config)
 
         if getattr(view_func, 'login_exempt', False):
+            return True
+
+        if request.path in self._exempt_urls:
+            return True
+
+        if self._exempt_matcher is not None and self._exempt_matcher.match(request.path):
+            return True
+
+        if request.resolver_match is not None and 'simplemfa' in request.resolver_match.namespaces:
+            return True
+
+        return False
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not get_config().REQUIRE_MFA:
             return None
+        with timed("mfa.middleware"):
+            if self.is_exempt(request, view_func):
+                return None
+            return self.check_mfa(request)
 
-        if "_simplemfa_trusted_device" in request.COOKIES:
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        if not get_config().REQUIRE_MFA:
             return None
+        with timed("mfa.middleware"):
+            if self.is_exempt(request, view_func):
+                return None
+            # loading the user and the session may query the database
+            return await sync_to_async(self.check_mfa)(request)
 
-        if 'simplemfa' in request.resolver_match.namespaces:
+    def check_mfa(self, request):
+        if not request.user.is_authenticated:
             return None
 
-        if request.path in [reverse("simplemfa:mfa-login"), reverse("simplemfa:mfa-request"),
-                            reverse("login"), reverse("logout")]:
+        # a signed assertion needs no session, so it goes before the session check
+        if has_valid_assertion(request):
             return None
 
-        if request.user.is_authenticated and mfa_required and not mfa_authenticated:
-            url = f"{reverse('simplemfa:mfa-login')}?next={request.path}"
+        # the session is only read once we know this request actually needs the MFA check
+        if not is_mfa_authenticated(request):
+            if is_trusted_device(request):
+                return None
+            url = f"{self._mfa_login_url}?next={request.path}"
             return redirect(url, request)
 
         return None
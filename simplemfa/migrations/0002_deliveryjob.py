@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:46
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import simplemfa.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('simplemfa', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='authcode',
+            options={'verbose_name': 'MFA Authentication Code', 'verbose_name_plural': 'MFA Authentication Codes'},
+        ),
+        migrations.CreateModel(
+            name='DeliveryJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sent_via', models.CharField(choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email')], default='EMAIL', max_length=15)),
+                ('code', models.CharField(blank=True, max_length=255)),
+                ('app_name', models.CharField(blank=True, max_length=255)),
+                ('url', models.CharField(blank=True, max_length=2048)),
+                ('host', models.CharField(blank=True, max_length=255)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='PENDING', max_length=15)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires', models.DateTimeField(default=simplemfa.models.get_expiration)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'MFA Delivery Job',
+                'verbose_name_plural': 'MFA Delivery Jobs',
+                'indexes': [models.Index(fields=['status', 'next_attempt'], name='simplemfa_job_status_next')],
+            },
+        ),
+    ]
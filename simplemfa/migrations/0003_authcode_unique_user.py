@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:47
+
+from django.db import migrations, models
+import simplemfa.models
+
+
+def delete_duplicate_codes(apps, schema_editor):
+    # keep only the newest code per user so the unique constraint can be created
+    AuthCode = apps.get_model('simplemfa', 'AuthCode')
+    db_alias = schema_editor.connection.alias
+    newest_ids = AuthCode.objects.using(db_alias).values('user_id').annotate(newest=models.Max('id')) \
+        .values_list('newest', flat=True)
+    AuthCode.objects.using(db_alias).exclude(id__in=list(newest_ids)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0002_deliveryjob'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_codes, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='authcode',
+            name='expires',
+            field=models.DateTimeField(db_index=True, default=simplemfa.models.get_expiration),
+        ),
+        migrations.AddConstraint(
+            model_name='authcode',
+            constraint=models.UniqueConstraint(fields=('user',), name='simplemfa_authcode_unique_user'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:52
+
+from django.db import migrations, models
+import simplemfa.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0003_authcode_unique_user'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='authcode',
+            name='sent_via',
+            field=models.CharField(choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email')], default=simplemfa.models.get_default_delivery_mode, max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='deliveryjob',
+            name='sent_via',
+            field=models.CharField(choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email')], default=simplemfa.models.get_default_delivery_mode, max_length=15),
+        ),
+    ]
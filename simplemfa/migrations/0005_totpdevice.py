@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import simplemfa.models
+import simplemfa.totp
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('simplemfa', '0004_default_delivery_mode'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='authcode',
+            name='sent_via',
+            field=models.CharField(choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email'), ('TOTP', 'Authenticator App')], default=simplemfa.models.get_default_delivery_mode, max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='deliveryjob',
+            name='sent_via',
+            field=models.CharField(choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email'), ('TOTP', 'Authenticator App')], default=simplemfa.models.get_default_delivery_mode, max_length=15),
+        ),
+        migrations.CreateModel(
+            name='TOTPDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('secret', models.CharField(default=simplemfa.totp.generate_secret, max_length=64)),
+                ('confirmed', models.BooleanField(default=False)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='simplemfa_totp_device', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'MFA Authenticator App',
+                'verbose_name_plural': 'MFA Authenticator Apps',
+            },
+        ),
+    ]
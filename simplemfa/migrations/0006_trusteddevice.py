@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:03
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('simplemfa', '0005_totpdevice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MFAEpoch',
+            fields=[
+                ('name', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'MFA Epoch',
+                'verbose_name_plural': 'MFA Epochs',
+            },
+        ),
+        migrations.CreateModel(
+            name='MFAUserState',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='simplemfa_state', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('trust_epoch', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'MFA User State',
+                'verbose_name_plural': 'MFA User States',
+            },
+        ),
+        migrations.CreateModel(
+            name='TrustedDevice',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('expires', models.DateTimeField(db_index=True)),
+                ('user_agent', models.CharField(blank=True, max_length=255)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'MFA Trusted Device',
+                'verbose_name_plural': 'MFA Trusted Devices',
+            },
+        ),
+    ]
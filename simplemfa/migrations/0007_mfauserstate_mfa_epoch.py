@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0006_trusteddevice'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mfauserstate',
+            name='mfa_epoch',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
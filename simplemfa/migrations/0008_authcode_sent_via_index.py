@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0007_mfauserstate_mfa_epoch'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='authcode',
+            index=models.Index(fields=['sent_via', 'expires'], name='simplemfa_code_via_expires'),
+        ),
+    ]
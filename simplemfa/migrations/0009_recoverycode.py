@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('simplemfa', '0008_authcode_sent_via_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecoveryCode',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simplemfa_recovery_codes', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'MFA Recovery Code',
+                'verbose_name_plural': 'MFA Recovery Codes',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='recoverycode',
+            constraint=models.UniqueConstraint(fields=('user', 'digest'), name='simplemfa_recovery_unique_digest'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0010_user_db_constraint'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='authcode',
+            name='code',
+            field=models.CharField(max_length=255),
+        ),
+    ]
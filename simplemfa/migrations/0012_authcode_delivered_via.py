@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('simplemfa', '0011_authcode_code_no_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authcode',
+            name='delivered_via',
+            field=models.CharField(blank=True, choices=[('TEXT', 'Text Message'), ('PHONE', 'Phone Call'), ('EMAIL', 'Email'), ('TOTP', 'Authenticator App')], default='', max_length=15),
+        ),
+    ]
@@ -1,94 +1,374 @@
-from django.db import models
+from django.db import models, connections, transaction, IntegrityError
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
-from django.conf import settings
-import random
-from random import randint
 import string
-from django.contrib.auth.hashers import make_password
+from simplemfa.codes import random_chars, random_code
+from simplemfa.conf import get_config
+from simplemfa.hashers import make_code_hash
+from simplemfa.instrumentation import timed
+from simplemfa.routers import get_mfa_database
+from simplemfa.totp import generate_secret
 
 
-CODE_STRING_LENGTH = settings.MFA_CODE_LENGTH if hasattr(settings, 'MFA_CODE_LENGTH') else 6
-CODE_EXPIRATION_LENGTH = settings.MFA_CODE_EXPIRATION if hasattr(settings, 'MFA_CODE_EXPIRATION') else 15*60
-CODE_DELIVERY_DEFAULT = settings.MFA_CODE_DELIVERY_DEFAULT if hasattr(settings, 'MFA_CODE_DELIVERY_DEFAULT') else "EMAIL"
 AUTH_CODE_DELIVERY_CHOICES = [
     ('TEXT', "Text Message"),
     ('PHONE', "Phone Call"),
-    ('EMAIL', "Email")
+    ('EMAIL', "Email"),
+    ('TOTP', "Authenticator App")
 ]
 
 
-def random_string(string_length=CODE_STRING_LENGTH, all_uppercase=True, all_lowercase=False, mixed_case=False,
+def random_string(string_length=None, all_uppercase=True, all_lowercase=False, mixed_case=False,
                   include_numbers=True, only_numbers=False):
+    if string_length is None:
+        string_length = get_config().MFA_CODE_LENGTH
 
     if only_numbers:
-        range_start = 10 ** (string_length - 1)
-        range_end = (10 ** string_length) - 1
-        return str(randint(range_start, range_end))
+        return random_code(string_length)
 
     letters = string.ascii_letters
     if include_numbers:
         letters += string.octdigits
 
     if all_uppercase:
-        return ''.join(random.choice(letters.upper()) for i in range(string_length))
+        letters = letters.upper()
     elif all_lowercase:
-        return ''.join(random.choice(letters.lower()) for i in range(string_length))
-    elif mixed_case:
-        return ''.join(random.choice(letters) for i in range(string_length))
-    else:
-        return ''.join(random.choice(letters.upper()) for i in range(string_length))
+        letters = letters.lower()
+    elif not mixed_case:
+        letters = letters.upper()
+    # the case conversions repeat letters; duplicates would skew the distribution
+    return random_chars(string_length, "".join(dict.fromkeys(letters)))
 
 
 def hash_this(input):
     try:
-        return make_password(input)
+        return make_code_hash(input)
     except:
         print("Caught error making hash")
         return input
 
 
-def generate_code(code=random_string()):
+def generate_code(code=None):
+    if code is None:
+        code = random_code()
     return hash_this(code)
 
 
-def get_expiration(seconds=CODE_EXPIRATION_LENGTH):
+def get_expiration(seconds=None):
+    if seconds is None:
+        seconds = get_config().MFA_CODE_EXPIRATION
     return timezone.now() + timezone.timedelta(seconds=seconds)
 
 
+def get_default_delivery_mode():
+    return get_config().MFA_CODE_DELIVERY_DEFAULT
+
+
+class MFAManager(models.Manager):
+    """
+    Runs every query against MFA_DATABASE (see routers.py)
+    """
+
+    def get_queryset(self):
+        return super().get_queryset().using(get_mfa_database())
+
+
 class AuthCode(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     created = models.DateTimeField(default=timezone.now)
-    expires = models.DateTimeField(default=get_expiration)
-    code = models.CharField(max_length=255, default=generate_code)
-    sent_via = models.CharField(max_length=15, choices=AUTH_CODE_DELIVERY_CHOICES, default=CODE_DELIVERY_DEFAULT)
+    expires = models.DateTimeField(default=get_expiration, db_index=True)
+    code = models.CharField(max_length=255)
+    sent_via = models.CharField(max_length=15, choices=AUTH_CODE_DELIVERY_CHOICES, default=get_default_delivery_mode)
+    # the channel that confirmed delivery, when it was not sent_via (fan-out delivery or the email fallback)
+    delivered_via = models.CharField(max_length=15, choices=AUTH_CODE_DELIVERY_CHOICES, blank=True, default="")
+
+    objects = MFAManager()
 
     class Meta:
         verbose_name = "MFA Authentication Code"
         verbose_name_plural = "MFA Authentication Codes"
+        constraints = [
+            models.UniqueConstraint(fields=["user"], name="simplemfa_authcode_unique_user"),
+        ]
+        indexes = [
+            # the admin's delivery mode filter, alone or combined with the active/expired filter
+            models.Index(fields=["sent_via", "expires"], name="simplemfa_code_via_expires"),
+        ]
 
     def __str__(self):
-        return f"User: {self.user.username} | Created: {self.created} | Sent Via: {self.sent_via}"
+        return f"User: {self.user_id} | Created: {self.created} | Sent Via: {self.sent_via}"
 
     @classmethod
     def delete_all_codes_for_user(cls, user_id):
-        auths = cls.objects.filter(user_id=user_id)
-        for auth in auths.all():
-            auth.delete()
+        cls.objects.filter(user_id=user_id).delete()
 
     @classmethod
     def create_code_for_user(cls, user_id, sent_via="EMAIL"):
+        with timed("mfa.generate"):
+            code = random_code()
+        with timed("mfa.hash"):
+            hashed_code = generate_code(code=code)
         try:
-            user = User.objects.get(id=user_id)
-        except User.DoesNotExist:
+            with timed("mfa.store"):
+                cls.replace_code_for_user(user_id, hashed_code, sent_via=sent_via)
+        except IntegrityError:
+            # the user does not exist
             return None
-        else:
-            obj = cls.objects.create(user=user, sent_via=sent_via)
-            return obj.create_code()
+        return code
+
+    @classmethod
+    def replace_code_for_user(cls, user_id, hashed_code, sent_via="EMAIL"):
+        """
+        Stores hashed_code as the user's only code in a single upsert, so concurrent requests for the
+        same user cannot leave more than one code behind
+        """
+        fields = {"created": timezone.now(), "expires": get_expiration(), "code": hashed_code, "sent_via": sent_via}
+        using = get_mfa_database()
+        if getattr(connections[using].features, "supports_update_conflicts_with_target", False):
+            cls.objects.bulk_create([cls(user_id=user_id, **fields)], update_conflicts=True,
+                                    unique_fields=["user"], update_fields=list(fields))
+            return
+
+        # databases (or Django versions) without INSERT ... ON CONFLICT support
+        try:
+            with transaction.atomic(using=using):
+                cls.objects.update_or_create(user_id=user_id, defaults=fields)
+        except IntegrityError:
+            # a concurrent request inserted the row first; overwrite it
+            if not cls.objects.filter(user_id=user_id).update(**fields):
+                raise
 
     def create_code(self):
-        code = random_string(only_numbers=True)
+        code = random_code()
         self.code = generate_code(code=code)
         self.expires = get_expiration()
-        self.save()
+        self.save(using=self._state.db or get_mfa_database())
         return code
+
+
+class RecoveryCode(models.Model):
+    """
+    An unused one-time recovery code, stored as a keyed digest (see recovery.py). The unique
+    (user, digest) constraint is also the index a code is looked up by.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False,
+                             related_name="simplemfa_recovery_codes")
+    digest = models.CharField(max_length=64)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA Recovery Code"
+        verbose_name_plural = "MFA Recovery Codes"
+        constraints = [
+            models.UniqueConstraint(fields=["user", "digest"], name="simplemfa_recovery_unique_digest"),
+        ]
+
+    def __str__(self):
+        return f"User: {self.user_id} | Recovery Code {self.id}"
+
+
+DELIVERY_STATUS_CHOICES = [
+    ('PENDING', "Pending"),
+    ('SENT', "Sent"),
+    ('FAILED', "Failed")
+]
+
+
+class DeliveryJob(models.Model):
+    """
+    An outbox entry for asynchronous code delivery (MFA_ASYNC_DELIVERY = True), drained by the
+    simplemfa_deliver management command. The worker creates the code when it sends it, so no plain-text
+    code is stored. code only holds codes queued by earlier versions, until their job is attempted.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    sent_via = models.CharField(max_length=15, choices=AUTH_CODE_DELIVERY_CHOICES, default=get_default_delivery_mode)
+    code = models.CharField(max_length=255, blank=True)
+    app_name = models.CharField(max_length=255, blank=True)
+    url = models.CharField(max_length=2048, blank=True)
+    host = models.CharField(max_length=255, blank=True)
+    status = models.CharField(max_length=15, choices=DELIVERY_STATUS_CHOICES, default="PENDING")
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(default=timezone.now)
+    expires = models.DateTimeField(default=get_expiration)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA Delivery Job"
+        verbose_name_plural = "MFA Delivery Jobs"
+        indexes = [
+            models.Index(fields=["status", "next_attempt"], name="simplemfa_job_status_next"),
+        ]
+
+    def __str__(self):
+        return f"User: {self.user_id} | Created: {self.created} | Sent Via: {self.sent_via} | Status: {self.status}"
+
+    @classmethod
+    def enqueue(cls, user_id, sent_via, app_name, url, host=None):
+        return cls.objects.create(user_id=user_id, sent_via=sent_via, app_name=app_name, url=url, host=host or "")
+
+    @classmethod
+    def cancel_pending_for_user(cls, user_id):
+        return cls.objects.filter(user_id=user_id, status="PENDING").delete()
+
+    def mark_sent(self):
+        self.status = "SENT"
+        self.code = ""
+        self.last_error = ""
+        self.save(update_fields=["status", "code", "last_error"])
+
+    def mark_failed(self, error="", max_attempts=None, backoff=None):
+        config = get_config()
+        max_attempts = config.MFA_DELIVERY_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        backoff = config.MFA_DELIVERY_RETRY_BACKOFF if backoff is None else backoff
+        now = timezone.now()
+        self.last_error = error
+        # a retry creates a new code, so the one held in memory for this attempt is never saved
+        self.code = ""
+        if self.attempts >= max_attempts or self.expires <= now:
+            self.status = "FAILED"
+        else:
+            # exponential backoff: backoff, 2 x backoff, 4 x backoff, ... seconds
+            self.next_attempt = now + timezone.timedelta(seconds=backoff * 2 ** max(self.attempts - 1, 0))
+        self.save(update_fields=["status", "code", "last_error", "next_attempt"])
+
+
+class TOTPDevice(models.Model):
+    """
+    An authenticator app enrolled for the TOTP mode. Codes are computed from the shared secret on both
+    sides, so nothing is stored or sent per login. The secret is only used once the user has confirmed
+    enrollment with a valid code.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False,
+                                related_name="simplemfa_totp_device")
+    secret = models.CharField(max_length=64, default=generate_secret)
+    confirmed = models.BooleanField(default=False)
+    created = models.DateTimeField(default=timezone.now)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA Authenticator App"
+        verbose_name_plural = "MFA Authenticator Apps"
+
+    def __str__(self):
+        return f"User: {self.user_id} | Created: {self.created} | Confirmed: {self.confirmed}"
+
+    @classmethod
+    def get_secret_for_user(cls, user_id):
+        return cls.objects.filter(user_id=user_id, confirmed=True).values_list("secret", flat=True).first()
+
+    @classmethod
+    def get_or_start_enrollment(cls, user_id):
+        device, created = cls.objects.get_or_create(user_id=user_id)
+        return device
+
+    def confirm(self):
+        self.confirmed = True
+        self.save(update_fields=["confirmed"])
+
+
+class TrustedDevice(models.Model):
+    """
+    A device the user chose to remember, so MFA is not asked for again until it expires. The device's
+    cookie is a signed token naming this row (see simplemfa.devices); deleting the row revokes it.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    created = models.DateTimeField(default=timezone.now)
+    expires = models.DateTimeField(db_index=True)
+    user_agent = models.CharField(max_length=255, blank=True)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA Trusted Device"
+        verbose_name_plural = "MFA Trusted Devices"
+
+    def __str__(self):
+        return f"User: {self.user_id} | Created: {self.created} | Expires: {self.expires}"
+
+    @classmethod
+    def get_expiration_for_device(cls, device_id):
+        return cls.objects.filter(id=device_id).values_list("expires", flat=True).first()
+
+
+class MFAUserState(models.Model):
+    """
+    Per-user MFA counters. Raising trust_epoch invalidates every device the user trusted before, in
+    one write and without touching the TrustedDevice rows. Raising mfa_epoch invalidates every MFA
+    authenticated session of the user (see rechallenge.py).
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, db_constraint=False, primary_key=True,
+                                related_name="simplemfa_state")
+    trust_epoch = models.PositiveIntegerField(default=0)
+    mfa_epoch = models.PositiveIntegerField(default=0)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA User State"
+        verbose_name_plural = "MFA User States"
+
+    def __str__(self):
+        return f"User: {self.user_id} | Trust Epoch: {self.trust_epoch} | MFA Epoch: {self.mfa_epoch}"
+
+    @classmethod
+    def get_epoch(cls, user_id, field="trust_epoch"):
+        return cls.objects.filter(user_id=user_id).values_list(field, flat=True).first() or 0
+
+    @classmethod
+    def bump_epoch(cls, user_id, field="trust_epoch"):
+        if not cls.objects.filter(user_id=user_id).update(**{field: F(field) + 1}):
+            try:
+                with transaction.atomic(using=get_mfa_database()):
+                    cls.objects.create(user_id=user_id, **{field: 1})
+            except IntegrityError:
+                # created concurrently
+                cls.objects.filter(user_id=user_id).update(**{field: F(field) + 1})
+        return cls.get_epoch(user_id, field=field)
+
+
+class MFAEpoch(models.Model):
+    """
+    Site-wide counters, e.g. the global trust epoch: raising it invalidates every trusted device at once
+    """
+    name = models.CharField(max_length=32, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    objects = MFAManager()
+
+    class Meta:
+        verbose_name = "MFA Epoch"
+        verbose_name_plural = "MFA Epochs"
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+    @classmethod
+    def get_value(cls, name):
+        return cls.objects.filter(name=name).values_list("value", flat=True).first() or 0
+
+    @classmethod
+    def bump(cls, name):
+        if not cls.objects.filter(name=name).update(value=F("value") + 1):
+            try:
+                with transaction.atomic(using=get_mfa_database()):
+                    cls.objects.create(name=name, value=1)
+            except IntegrityError:
+                cls.objects.filter(name=name).update(value=F("value") + 1)
+        return cls.get_value(name)
+
+
+@receiver(post_delete, sender=User)
+def delete_user_mfa_data(sender, instance, using, **kwargs):
+    # without database constraints or a shared database, Django's cascade cannot reach MFA_DATABASE
+    mfa_database = get_mfa_database()
+    if using != mfa_database:
+        for model in (AuthCode, RecoveryCode, DeliveryJob, TOTPDevice, TrustedDevice, MFAUserState):
+            model.objects.filter(user_id=instance.pk).delete()
@@ -0,0 +1,101 @@
+"""
+Cache-backed rate limiting for code requests and verification attempts
+
+Limits are configured per scope ("REQUEST" for new codes, "VERIFY" for code guesses) and per key
+("USER" for the account, "IP" for get_request_ip()) as (max_calls, window_seconds) in
+MFA_RATE_LIMITS, which is empty (no limits) by default. Each limit is a sliding window approximated
+from two fixed-window counters, kept with atomic cache increments so every worker sharing the cache
+sees the same counts. Limits are checked before any hashing, database access or provider call.
+"""
+import time
+
+from django.core.cache import caches
+
+from simplemfa.conf import get_config
+
+
+def get_request_ip(request, proxy_count=0):
+    """
+    The client address limits are keyed on. Clients can send any X-Forwarded-For header, so it is only
+    read behind proxy_count trusted proxies, and then only the entry the outermost of them added.
+    """
+    if proxy_count:
+        forwarded = [ip.strip() for ip in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+        if len(forwarded) >= proxy_count:
+            return forwarded[-proxy_count]
+    return request.META.get("REMOTE_ADDR")
+
+
+class RateLimiter:
+    key_prefix = "simplemfa:ratelimit"
+
+    def __init__(self, scope, limits, cache_alias="default"):
+        self.scope = scope
+        self.limits = limits
+        self.cache_alias = cache_alias
+
+    @classmethod
+    def for_scope(cls, scope):
+        config = get_config()
+        return cls(scope, config.MFA_RATE_LIMITS.get(scope, {}), cache_alias=config.MFA_RATE_LIMIT_CACHE)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def get_identities(self, request):
+        identities = {}
+        if "USER" in self.limits and request.user.is_authenticated:
+            identities["USER"] = request.user.pk
+        if "IP" in self.limits:
+            ip = get_request_ip(request, get_config().MFA_RATE_LIMIT_PROXY_COUNT)
+            if ip:
+                identities["IP"] = ip
+        return identities
+
+    def make_key(self, kind, identity, bucket):
+        return f"{self.key_prefix}:{self.scope}:{kind}:{identity}:{bucket}"
+
+    def hit(self, request):
+        """
+        Counts one call against every configured limit. Returns None if the call is allowed, otherwise the
+        number of seconds after which it is worth retrying.
+        """
+        now = time.time()
+        retry_after = None
+        for kind, identity in self.get_identities(request).items():
+            max_calls, window = self.limits[kind]
+            bucket, offset = divmod(now, window)
+            key = self.make_key(kind, identity, int(bucket))
+            # the counter must outlive its own window to weigh in on the next one
+            self.cache.add(key, 0, timeout=int(window * 2) + 1)
+            try:
+                current = self.cache.incr(key)
+            except ValueError:
+                current = 1
+                self.cache.set(key, current, timeout=int(window * 2) + 1)
+            previous = self.cache.get(self.make_key(kind, identity, int(bucket) - 1), 0)
+
+            estimated = previous * (1 - offset / window) + current
+            if estimated > max_calls:
+                wait = int(window - offset) + 1
+                retry_after = max(retry_after or 0, wait)
+        return retry_after
+
+    def reset(self, request, kinds=("USER",)):
+        now = time.time()
+        keys = []
+        for kind, identity in self.get_identities(request).items():
+            if kind in kinds:
+                bucket = int(now // self.limits[kind][1])
+                keys += [self.make_key(kind, identity, bucket), self.make_key(kind, identity, bucket - 1)]
+        if keys:
+            self.cache.delete_many(keys)
+
+
+def check_rate_limit(request, scope):
+    return RateLimiter.for_scope(scope).hit(request)
+
+
+def reset_rate_limit(request, scope, kinds=("USER",)):
+    RateLimiter.for_scope(scope).reset(request, kinds=kinds)
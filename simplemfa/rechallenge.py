@@ -0,0 +1,144 @@
+"""
+Forcing users to complete MFA again
+
+A successful MFA login stores the user's MFA epoch (MFAUserState.mfa_epoch) and the global MFA epoch
+in the session next to the _simplemfa_authenticated flag, and the middleware only honours the flag
+while both are unchanged. Re-challenging users therefore never touches their sessions: it raises their
+MFA and trust epochs and deletes their outstanding codes and queued deliveries in set-based statements,
+a chunk of users at a time. Re-challenging everyone raises the global epochs instead, in one write.
+Epochs are cached, so the check costs one cache round trip per request.
+"""
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F, QuerySet
+
+from simplemfa.conf import get_config
+from simplemfa.devices import get_device_cache, user_epoch_key, revoke_all_devices
+from simplemfa.models import MFAUserState, MFAEpoch, DeliveryJob
+from simplemfa.routers import get_mfa_database
+from simplemfa.stores import get_code_store
+
+
+KEY_PREFIX = "simplemfa:mfa_epoch"
+GLOBAL_EPOCH = "mfa"
+SESSION_FLAG = "_simplemfa_authenticated"
+SESSION_EPOCH = "_simplemfa_epoch"
+CACHE_TIMEOUT = 24 * 60 * 60
+CHUNK_SIZE = 1000
+
+
+def get_epoch_cache():
+    return caches[get_config().MFA_RECHALLENGE_CACHE]
+
+
+def mfa_epoch_key(user_id):
+    return f"{KEY_PREFIX}:{user_id}"
+
+
+def global_epoch_key():
+    return f"{KEY_PREFIX}:global"
+
+
+def get_mfa_epochs(user_id):
+    """
+    Returns the user's and the global MFA epoch as a list (the form kept in the session)
+    """
+    cache = get_epoch_cache()
+    keys = (mfa_epoch_key(user_id), global_epoch_key())
+    cached = cache.get_many(keys)
+    if keys[0] not in cached:
+        cached[keys[0]] = MFAUserState.get_epoch(user_id, field="mfa_epoch")
+        # add(), not set(): never overwrite a newer value; re-challenges set() theirs after committing
+        cache.add(keys[0], cached[keys[0]], timeout=CACHE_TIMEOUT)
+    if keys[1] not in cached:
+        cached[keys[1]] = MFAEpoch.get_value(GLOBAL_EPOCH)
+        cache.add(keys[1], cached[keys[1]], timeout=CACHE_TIMEOUT)
+    return [cached[keys[0]], cached[keys[1]]]
+
+
+def set_mfa_authenticated(request, authenticated=True):
+    """
+    Marks the session as MFA authenticated (or not) for request.user at the current MFA epochs
+    """
+    request.session[SESSION_FLAG] = authenticated
+    if authenticated:
+        request.session[SESSION_EPOCH] = get_mfa_epochs(request.user.pk)
+    else:
+        request.session.pop(SESSION_EPOCH, None)
+
+
+def is_mfa_authenticated(request):
+    """
+    True if the session completed MFA and the user has not been re-challenged since. A stale flag is
+    cleared, so the next check does not need the epoch.
+    """
+    session = request.session
+    if not session.get(SESSION_FLAG, False):
+        return False
+    # sessions authenticated before epochs existed carry none, which matches users never re-challenged
+    if session.get(SESSION_EPOCH, [0, 0]) == get_mfa_epochs(request.user.pk):
+        return True
+    session[SESSION_FLAG] = False
+    session.pop(SESSION_EPOCH, None)
+    return False
+
+
+def get_user_ids(users):
+    if isinstance(users, QuerySet):
+        return list(users.order_by().values_list("pk", flat=True))
+    return [getattr(user, "pk", user) for user in users]
+
+
+def rechallenge_users(users, chunk_size=CHUNK_SIZE, codes=True, devices=True):
+    """
+    Forces every user in users (a User queryset, or users or user ids) to complete MFA again on their
+    next request: their MFA authenticated sessions stop counting and, unless devices is False, their
+    trusted devices are revoked. Unless codes is False, outstanding codes and pending deliveries are
+    deleted too. Returns the number of users.
+    """
+    user_ids = get_user_ids(users)
+    fields = {"mfa_epoch": F("mfa_epoch") + 1}
+    if devices:
+        fields["trust_epoch"] = F("trust_epoch") + 1
+    store = get_code_store()
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        with transaction.atomic(using=get_mfa_database()):
+            # rows that already exist are left alone by the insert and raised by the update
+            MFAUserState.objects.bulk_create([MFAUserState(user_id=user_id) for user_id in chunk],
+                                             ignore_conflicts=True)
+            MFAUserState.objects.filter(user_id__in=chunk).update(**fields)
+            epochs = list(MFAUserState.objects.filter(user_id__in=chunk)
+                          .values_list("user_id", "mfa_epoch", "trust_epoch"))
+            if codes:
+                DeliveryJob.objects.filter(user_id__in=chunk, status="PENDING").delete()
+        if codes:
+            store.delete_codes_for_users(chunk)
+
+        # the new epochs are written over the cached ones once committed. Deleting the keys instead would
+        # let a request that read the old epochs before the commit add them back (cache.add) afterwards.
+        get_epoch_cache().set_many({mfa_epoch_key(user_id): mfa_epoch for user_id, mfa_epoch, _ in epochs},
+                                   timeout=CACHE_TIMEOUT)
+        if devices:
+            get_device_cache().set_many({user_epoch_key(user_id): trust_epoch for user_id, _, trust_epoch in epochs},
+                                        timeout=CACHE_TIMEOUT)
+    return len(user_ids)
+
+
+def rechallenge_user(user_id, **kwargs):
+    return rechallenge_users([user_id], **kwargs)
+
+
+def rechallenge_all(codes=True, devices=True):
+    """
+    Forces every user to complete MFA again, with the same options as rechallenge_users()
+    """
+    epoch = MFAEpoch.bump(GLOBAL_EPOCH)
+    get_epoch_cache().set(global_epoch_key(), epoch, timeout=CACHE_TIMEOUT)
+    if devices:
+        revoke_all_devices()
+    if codes:
+        DeliveryJob.objects.filter(status="PENDING").delete()
+        get_code_store().delete_all_codes()
+    return epoch
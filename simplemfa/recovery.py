@@ -0,0 +1,82 @@
+"""
+One-time recovery codes
+
+Recovery codes let a user log in when no code can be delivered to them. A user's whole set is
+generated at once and stored as keyed HMAC-SHA256 digests of (user id, code). The digest is
+deterministic, so checking a code is one indexed equality lookup rather than a hash comparison per
+stored code, and using a code is a single conditional DELETE, so it can only ever be used once.
+The digests are keyed from SECRET_KEY: changing it invalidates every recovery code.
+"""
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.db import transaction
+
+from simplemfa.codes import random_codes
+from simplemfa.conf import get_config
+from simplemfa.models import RecoveryCode
+from simplemfa.routers import get_mfa_database
+
+
+# no 0/O, 1/I/L or 2/Z, which are easily confused when read back from paper
+ALPHABET = "ABCDEFGHJKMNPQRSTUVWXY3456789"
+KEY_SALT = "simplemfa.recovery"
+
+
+def get_key():
+    return hashlib.sha256(f"{KEY_SALT}{settings.SECRET_KEY}".encode()).digest()
+
+
+def normalize_recovery_code(code):
+    return str(code).replace("-", "").replace(" ", "").strip().upper()
+
+
+def looks_like_recovery_code(code):
+    code = normalize_recovery_code(code)
+    return len(code) == get_config().MFA_RECOVERY_CODE_LENGTH and all(char in ALPHABET for char in code)
+
+
+def format_recovery_code(code):
+    # grouped in fives for legibility; dashes and spaces are ignored when the code is entered
+    return "-".join(code[i:i + 5] for i in range(0, len(code), 5))
+
+
+def recovery_code_digest(user_id, code, key=None):
+    return hmac.new(key or get_key(), f"{user_id}${normalize_recovery_code(code)}".encode(), hashlib.sha256).hexdigest()
+
+
+def generate_recovery_codes(user_id, count=None):
+    """
+    Replaces the user's recovery codes with a new set and returns the plain-text codes, which are not
+    stored anywhere and must be shown to the user now
+    """
+    config = get_config()
+    if count is None:
+        count = config.MFA_RECOVERY_CODE_COUNT
+    key = get_key()
+    codes = sorted(random_codes(count, config.MFA_RECOVERY_CODE_LENGTH, alphabet=ALPHABET, unique=True))
+    with transaction.atomic(using=get_mfa_database()):
+        RecoveryCode.objects.filter(user_id=user_id).delete()
+        RecoveryCode.objects.bulk_create([RecoveryCode(user_id=user_id, digest=recovery_code_digest(user_id, code, key))
+                                          for code in codes])
+    return [format_recovery_code(code) for code in codes]
+
+
+def use_recovery_code(user_id, code):
+    """
+    Consumes code if it is one of the user's unused recovery codes. Of several concurrent attempts with
+    the same code, only the one whose DELETE removed the row succeeds.
+    """
+    if not code or not looks_like_recovery_code(code):
+        return False
+    deleted, _ = RecoveryCode.objects.filter(user_id=user_id, digest=recovery_code_digest(user_id, code)).delete()
+    return deleted > 0
+
+
+def count_recovery_codes(user_id):
+    return RecoveryCode.objects.filter(user_id=user_id).count()
+
+
+def delete_recovery_codes(user_id):
+    RecoveryCode.objects.filter(user_id=user_id).delete()
@@ -0,0 +1,97 @@
+"""
+Per-process caches for the templates used on every login
+
+Resolved and compiled templates are kept for the life of the process, so message rendering and the
+login view's template fallback never touch the filesystem or re-parse a template after the first
+use. The caches are cleared whenever the autoreloader sees a file change or TEMPLATES is changed.
+"""
+from xml.sax.saxutils import escape
+
+from django import template
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.loader import get_template
+from django.utils.autoreload import file_changed
+
+from simplemfa.instrumentation import timed
+
+
+_template_cache = {}
+_fallback_cache = {}
+
+
+def get_cached_template(name):
+    try:
+        return _template_cache[name]
+    except KeyError:
+        compiled = get_template(name)
+        _template_cache[name] = compiled
+        return compiled
+
+
+def resolve_template_fallback(names):
+    """
+    Returns the first of names that exists (caching the answer), or raises TemplateDoesNotExist
+    """
+    key = tuple(names)
+    try:
+        return _fallback_cache[key]
+    except KeyError:
+        pass
+    for name in key:
+        try:
+            get_cached_template(name)
+        except template.TemplateDoesNotExist:
+            continue
+        _fallback_cache[key] = name
+        return name
+    raise template.TemplateDoesNotExist(", ".join(key))
+
+
+def render_cached_template(name, context):
+    with timed("mfa.render"):
+        return get_cached_template(name).render(context)
+
+
+def reset_template_caches():
+    _template_cache.clear()
+    _fallback_cache.clear()
+
+
+@receiver(file_changed)
+def reset_template_caches_on_file_change(**kwargs):
+    reset_template_caches()
+    # returning None leaves the decision to reload (or not) to Django's own receivers
+
+
+@receiver(setting_changed)
+def reset_template_caches_on_setting_change(**kwargs):
+    if kwargs["setting"] in ("TEMPLATES", "INSTALLED_APPS"):
+        reset_template_caches()
+
+
+# TwiML for the voice call. The document around the code never changes, so it is built once and only the
+# message and the spelled-out code characters are interpolated per call. The output is identical to what
+# twilio.twiml.voice_response.VoiceResponse produced for the same message.
+
+TWIML_CHARACTER = '<say-as interpret-as="spell-out">,,,,,,,,...{},,,,,,,,...</say-as>'
+TWIML_SKELETON = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<Response><Say>'
+    '<p>,,,,,,,,,{message},,,,,,,,,...</p>{code}'
+    '<p>,,,,,,,,,...Again, {message},,,,,,,,,</p>{code}'
+    '<p>,,,,,,Goodbye!</p>'
+    '</Say></Response>'
+)
+_twiml_characters = {}
+
+
+def build_voice_twiml(message, code):
+    spelled = []
+    for char in str(code):
+        fragment = _twiml_characters.get(char)
+        if fragment is None:
+            fragment = _twiml_characters.setdefault(char, TWIML_CHARACTER.format(escape(char)))
+        spelled.append(fragment)
+    spelled = "".join(spelled)
+    return TWIML_SKELETON.format(message=escape(message), code=spelled)
@@ -0,0 +1,67 @@
+"""
+Database selection for the simplemfa models
+
+Every simplemfa query runs against MFA_DATABASE through an explicit using() (see models.MFAManager),
+so short-lived code, delivery and device churn can live on its own database. User rows are read from
+MFA_USER_DATABASE, which may be a read replica. Django cannot join or cascade across databases, so the
+simplemfa models reference users without database-level foreign key constraints, and deleting a user
+deletes their simplemfa rows from MFA_DATABASE explicitly.
+
+SimpleMFARouter is optional. Add it to DATABASE_ROUTERS when MFA_DATABASE is a separate database, so
+that `migrate --database <MFA_DATABASE>` only creates the simplemfa tables there and related users
+are loaded from MFA_USER_DATABASE.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, router
+
+from simplemfa.conf import get_config
+
+
+APP_LABEL = "simplemfa"
+
+
+def get_mfa_database():
+    return get_config().MFA_DATABASE
+
+
+def get_user_database():
+    alias = get_config().MFA_USER_DATABASE
+    return alias if alias is not None else router.db_for_read(get_user_model())
+
+
+def is_mfa_model(model):
+    return model._meta.app_label == APP_LABEL
+
+
+def is_user_model(model):
+    return model._meta.label == settings.AUTH_USER_MODEL
+
+
+class SimpleMFARouter:
+
+    def db_for_read(self, model, **hints):
+        if is_mfa_model(model):
+            return get_mfa_database()
+        instance = hints.get("instance")
+        if instance is not None and is_mfa_model(instance) and is_user_model(model):
+            # e.g. code.user: the user lives in the user database, not next to the code
+            return get_user_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if is_mfa_model(model):
+            return get_mfa_database()
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_mfa_model(obj1) or is_mfa_model(obj2):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # keep every other app out of a dedicated MFA database. The simplemfa tables are left to
+        # Django's default (created everywhere), as user deletions look for them in the user database.
+        if app_label != APP_LABEL and db == get_mfa_database() != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -0,0 +1,11 @@
+from django.dispatch import Signal
+
+
+# sent with sender=CircuitBreaker, channel, failures and reset_timeout when a delivery channel is cut off
+circuit_opened = Signal()
+
+# sent with sender=CircuitBreaker and channel when a delivery channel recovers
+circuit_closed = Signal()
+
+# sent with sender=None, stage (e.g. "mfa.hash") and duration (seconds) each time an instrumented step finishes
+timing_recorded = Signal()
@@ -0,0 +1,160 @@
+"""
+Pluggable storage for outstanding MFA codes
+
+Each user has at most one outstanding code. DatabaseCodeStore keeps it in the AuthCode table (the
+default); CacheCodeStore keeps it in a Django cache with a TTL of MFA_CODE_EXPIRATION so issuing
+and verifying a code needs no SQL at all.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from simplemfa.codes import random_code
+from simplemfa.conf import get_config
+from simplemfa.constants import CodeVerificationResult
+from simplemfa.hashers import check_code_hash, make_code_hash
+from simplemfa.instrumentation import timed
+from simplemfa.models import AuthCode
+from simplemfa.routers import get_user_database
+
+
+class BaseCodeStore:
+
+    def create_code_for_user(self, user_id, sent_via=None):
+        """
+        Replaces any outstanding code for the user with a new one and returns the plain-text code
+        (or None if no code could be created)
+        """
+        raise NotImplementedError("Subclasses of BaseCodeStore must provide a create_code_for_user() method")
+
+    def verify(self, user_id, code):
+        """
+        Returns one of the CodeVerificationResult values. Expired codes are removed.
+        """
+        raise NotImplementedError("Subclasses of BaseCodeStore must provide a verify() method")
+
+    def delete_all_codes_for_user(self, user_id):
+        raise NotImplementedError("Subclasses of BaseCodeStore must provide a delete_all_codes_for_user() method")
+
+    def record_delivery(self, user_id, channel):
+        """
+        Notes that the user's code was delivered through channel rather than the mode it was requested
+        with (fan-out delivery or the email fallback). Stores without a place for it ignore it.
+        """
+
+    def delete_codes_for_users(self, user_ids):
+        for user_id in user_ids:
+            self.delete_all_codes_for_user(user_id)
+
+    def delete_all_codes(self, chunk_size=1000):
+        """
+        Deletes the outstanding codes of every user
+        """
+        user_ids = list(get_user_model().objects.using(get_user_database()).order_by("pk")
+                        .values_list("pk", flat=True))
+        for start in range(0, len(user_ids), chunk_size):
+            self.delete_codes_for_users(user_ids[start:start + chunk_size])
+
+
+class DatabaseCodeStore(BaseCodeStore):
+
+    def create_code_for_user(self, user_id, sent_via=None):
+        # a single upsert replaces any previous code for the user
+        return AuthCode.create_code_for_user(user_id, sent_via=sent_via or get_config().MFA_CODE_DELIVERY_DEFAULT)
+
+    def record_delivery(self, user_id, channel):
+        AuthCode.objects.filter(user_id=user_id).update(delivered_via=channel)
+
+    def verify(self, user_id, code):
+        with timed("mfa.store"):
+            auth = AuthCode.objects.filter(user_id=user_id).only("id", "code", "expires").first()
+        if auth is None:
+            return CodeVerificationResult.NOT_FOUND
+
+        if auth.expires <= timezone.now():
+            with timed("mfa.store"):
+                auth.delete()
+            return CodeVerificationResult.EXPIRED
+        with timed("mfa.hash"):
+            matches = check_code_hash(code, auth.code)
+        return CodeVerificationResult.VALID if matches else CodeVerificationResult.INVALID
+
+    def delete_all_codes_for_user(self, user_id):
+        AuthCode.delete_all_codes_for_user(user_id)
+
+    def delete_codes_for_users(self, user_ids):
+        AuthCode.objects.filter(user_id__in=user_ids).delete()
+
+    def delete_all_codes(self, chunk_size=1000):
+        AuthCode.objects.all().delete()
+
+
+class CacheCodeStore(BaseCodeStore):
+    """
+    Stores (hash, expiry timestamp, delivery mode) per user in the cache named by MFA_CODE_STORE_CACHE
+    """
+    key_prefix = "simplemfa:code"
+
+    def __init__(self, alias=None):
+        if alias is None:
+            alias = get_config().MFA_CODE_STORE_CACHE
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def make_key(self, user_id):
+        return f"{self.key_prefix}:{user_id}"
+
+    def create_code_for_user(self, user_id, sent_via=None):
+        config = get_config()
+        with timed("mfa.generate"):
+            code = random_code()
+        expires = timezone.now().timestamp() + config.MFA_CODE_EXPIRATION
+        with timed("mfa.hash"):
+            entry = (make_code_hash(code), expires, sent_via or config.MFA_CODE_DELIVERY_DEFAULT)
+        with timed("mfa.store"):
+            self.cache.set(self.make_key(user_id), entry, config.MFA_CODE_EXPIRATION)
+        return code
+
+    def verify(self, user_id, code):
+        key = self.make_key(user_id)
+        with timed("mfa.store"):
+            entry = self.cache.get(key)
+        if entry is None:
+            return CodeVerificationResult.NOT_FOUND
+
+        encoded, expires, sent_via = entry
+        if expires <= timezone.now().timestamp():
+            self.cache.delete(key)
+            return CodeVerificationResult.EXPIRED
+        with timed("mfa.hash"):
+            matches = check_code_hash(code, encoded)
+        return CodeVerificationResult.VALID if matches else CodeVerificationResult.INVALID
+
+    def delete_all_codes_for_user(self, user_id):
+        self.cache.delete(self.make_key(user_id))
+
+    def delete_codes_for_users(self, user_ids):
+        self.cache.delete_many([self.make_key(user_id) for user_id in user_ids])
+
+
+_store_cache = {}
+
+
+def get_code_store(path=None):
+    if path is None:
+        path = get_config().MFA_CODE_STORE
+    if path not in _store_cache:
+        _store_cache[path] = import_string(path)()
+    return _store_cache[path]
+
+
+@receiver(setting_changed)
+def reset_code_stores(**kwargs):
+    if kwargs["setting"] in ("MFA_CODE_STORE", "MFA_CODE_STORE_CACHE"):
+        _store_cache.clear()
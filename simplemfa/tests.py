@@ -1,2 +1,1608 @@
-from django.test import TestCase
+import json
+import os
+import re
+import tempfile
+from io import StringIO
+from unittest import mock
 
+from asgiref.sync import sync_to_async
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.signals import user_logged_out
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.backends.locmem import EmailBackend as LocMemEmailBackend
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.db import IntegrityError, connection, transaction
+from django.template import TemplateDoesNotExist
+from django.test import TestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path
+from django.utils import timezone
+
+from simplemfa.assertions import COOKIE_NAME, issue_assertion, verify_assertion
+from simplemfa.backends import BaseDeliveryBackend, EmailBackend, LocMemBackend, TwilioBackend, get_delivery_backend, \
+    outbox
+from simplemfa.breakers import CircuitBreaker
+from simplemfa.coalesce import claim_code_request, release_code_request
+from simplemfa.codes import get_translation, random_chars, random_code, random_codes
+from simplemfa.constants import CodeVerificationResult, MessageConstants
+from simplemfa.devices import COOKIE_NAME as DEVICE_COOKIE_NAME, get_device_cache, get_epochs, is_trusted_device, \
+    revoke_all_devices, revoke_device, revoke_user_devices, trust_device, user_epoch_key
+from simplemfa.forms import MFAAuth
+from simplemfa.hashers import HMACSHA256CodeHasher, DjangoPasswordCodeHasher, check_code_hash, get_code_hasher, \
+    make_code_hash
+from simplemfa.helpers import build_message_context, deliver_mfa_code
+from simplemfa.instrumentation import get_metrics, timed
+from simplemfa.middleware import ValidateMFAMiddleware, build_exempt_matcher
+from simplemfa.signals import circuit_closed, circuit_opened
+from simplemfa.models import AuthCode, DeliveryJob, MFAUserState, TOTPDevice, TrustedDevice
+from simplemfa.conf import DEFAULTS, SimpleMFAConfig, get_config
+from simplemfa.ratelimit import RateLimiter, get_request_ip
+from simplemfa.rechallenge import SESSION_FLAG, get_epoch_cache, get_mfa_epochs, mfa_epoch_key, rechallenge_all, \
+    rechallenge_user, rechallenge_users
+from simplemfa.rendering import build_voice_twiml, get_cached_template, resolve_template_fallback
+from simplemfa.recovery import count_recovery_codes, generate_recovery_codes, use_recovery_code
+from simplemfa.routers import SimpleMFARouter, get_mfa_database, get_user_database
+from simplemfa.stores import CacheCodeStore, get_code_store
+from simplemfa.totp import hotp_code, match_totp, totp_code, verify_totp
+from simplemfa.views import AsyncMFALoginView, AsyncMFARequestView
+
+
+# the tests never depend on the host project's cache or email configuration
+TEST_SETTINGS = {
+    "CACHES": {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                           "LOCATION": "simplemfa-tests"}},
+    "EMAIL_BACKEND": "django.core.mail.backends.locmem.EmailBackend",
+}
+
+# for the tests that go through the middleware and the views, with the URLs below
+VIEW_SETTINGS = {
+    "ROOT_URLCONF": "simplemfa.tests",
+    "MIDDLEWARE": [
+        "django.contrib.sessions.middleware.SessionMiddleware",
+        "django.contrib.auth.middleware.AuthenticationMiddleware",
+        "django.contrib.messages.middleware.MessageMiddleware",
+        "simplemfa.middleware.ValidateMFAMiddleware",
+    ],
+    "TEMPLATES": [{
+        "BACKEND": "django.template.backends.django.DjangoTemplates",
+        "APP_DIRS": True,
+        "OPTIONS": {"context_processors": ["django.template.context_processors.request",
+                                           "django.contrib.auth.context_processors.auth",
+                                           "django.contrib.messages.context_processors.messages"]},
+    }],
+    "LOGIN_URL": "/login/",
+    "LOGIN_REDIRECT_URL": "home",
+    "REQUIRE_MFA": True,
+}
+
+# RFC 6238, appendix B: the SHA-1 secret "12345678901234567890" in base32
+RFC6238_SECRET = "GEZDGNBVGY3TQOJQGEZDGNBVGY3TQOJQ"
+RFC6238_VECTORS = {
+    59: "94287082",
+    1111111109: "07081804",
+    1111111111: "14050471",
+    1234567890: "89005924",
+    2000000000: "69279037",
+    20000000000: "65353130",
+}
+
+
+class FailingBackend(BaseDeliveryBackend):
+
+    def send(self, user, context):
+        return False
+
+
+class RaisingBackend(BaseDeliveryBackend):
+
+    def send(self, user, context):
+        raise ConnectionError("provider unreachable")
+
+
+class RefusingEmailBackend(LocMemEmailBackend):
+    """
+    Refuses every message to an address starting with "refused", as an SMTP server refuses a recipient
+    """
+
+    def send_messages(self, messages):
+        for message in messages:
+            if any(address.startswith("refused") for address in message.to):
+                raise ConnectionError("recipient refused")
+        return super().send_messages(messages)
+
+
+class CountingEmailBackend(LocMemEmailBackend):
+    """
+    Counts the connections created
+    """
+    connections = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        CountingEmailBackend.connections += 1
+
+
+def page(request):
+    return HttpResponse("page")
+
+
+def login_exempt_page(request):
+    return HttpResponse("page")
+
+
+login_exempt_page.login_exempt = True
+
+
+urlpatterns = [
+    path("", page, name="home"),
+    path("login/", page, name="login"),
+    path("logout/", page, name="logout"),
+    path("mfa/", include("simplemfa.urls", namespace="simplemfa")),
+    # the message context reverses "mfa:mfa-login"
+    path("mfa/", include("simplemfa.urls", namespace="mfa")),
+    path("protected/", page),
+    path("public/page/", page),
+    path("a.b/", page),
+    path("axb/", page),
+    path("health/", page),
+    path("health/deep/", page),
+    path("exempt/", login_exempt_page),
+    path("async/mfa_auth/", AsyncMFALoginView.as_view()),
+    path("async/mfa_request/", AsyncMFARequestView.as_view()),
+]
+
+
+@override_settings(**TEST_SETTINGS)
+class SimpleMFATestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        outbox.clear()
+        self.user = User.objects.create_user("alice", "alice@example.com")
+        self.other = User.objects.create_user("bob", "bob@example.com")
+
+
+@override_settings(**VIEW_SETTINGS)
+class ViewTestCase(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+
+    def set_mfa_authenticated(self):
+        session = self.client.session
+        session[SESSION_FLAG] = True
+        session.save()
+
+    def assertRedirectsToMFA(self, response, path):
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], f"/mfa/mfa_auth/?next={path}")
+
+
+class ConfigTests(SimpleMFATestCase):
+
+    def test_config_is_resolved_once(self):
+        config = get_config()
+        self.assertIs(get_config(), config)
+        self.assertEqual(config.MFA_CODE_EXPIRATION, DEFAULTS["MFA_CODE_EXPIRATION"])
+        with self.settings(MFA_CODE_EXPIRATION=60):
+            self.assertEqual(get_config().MFA_CODE_EXPIRATION, 60)
+        self.assertEqual(get_config().MFA_CODE_EXPIRATION, DEFAULTS["MFA_CODE_EXPIRATION"])
+
+    def test_config_is_immutable(self):
+        with self.assertRaises(TypeError):
+            get_config()["REQUIRE_MFA"] = True
+        with self.assertRaises(TypeError):
+            get_config().REQUIRE_MFA = True
+
+    @override_settings(MFA_USER_PHONE_ATTRIBUTE="profile.phone", TWILIO_ACCOUNT_SID="AC1", TWILIO_AUTH_TOKEN="secret")
+    def test_derived_values(self):
+        config = get_config()
+        self.assertEqual(config.USER_PHONE_GETTER(mock.Mock(profile=mock.Mock(phone="+15005550006"))),
+                         "+15005550006")
+        self.assertIsNone(config.USER_MODE_GETTER)
+        # TWILIO_NUMBER is missing
+        self.assertFalse(config.TWILIO_CONFIGURED)
+        self.assertNotIn("secret", repr(config))
+
+    def test_invalid_settings(self):
+        invalid = {
+            "MFA_CODE_EXPIRATION": 0,
+            "MFA_CODE_LENGTH": "6",
+            "MFA_REQUEST_COALESCE_SECONDS": -1,
+            "MFA_RECOVERY_CODE_LENGTH": 4,
+            "MFA_TOTP_DIGITS": 9,
+            "MFA_COOKIE_EXPIRATION_DAYS": -1,
+            "MFA_RATE_LIMIT_PROXY_COUNT": -1,
+            "MFA_RATE_LIMITS": {"VERIFY": {"SESSION": (5, 60)}},
+            "MFA_DELIVERY_BACKENDS": [],
+            "MFA_CODE_DELIVERY_DEFAULT": "PIGEON",
+            "MFA_DELIVERY_FANOUT": ["EMAIL", "TOTP"],
+            "MFA_EXEMPT_PATH_PATTERNS": ["("],
+        }
+        for name, value in invalid.items():
+            with self.subTest(setting=name), self.settings(**{name: value}):
+                with self.assertRaises(ImproperlyConfigured):
+                    SimpleMFAConfig.from_settings()
+
+
+class MiddlewareTests(ViewTestCase):
+
+    def test_unverified_session_is_redirected(self):
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    def test_verified_session(self):
+        self.set_mfa_authenticated()
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+
+    def test_anonymous_requests_are_left_to_the_views(self):
+        self.client.logout()
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+
+    @override_settings(REQUIRE_MFA=False)
+    def test_mfa_not_required(self):
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+
+    def test_builtin_exemptions(self):
+        for path in ("/login/", "/logout/", "/mfa/mfa_auth/", "/exempt/"):
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path).status_code, 200)
+
+    @override_settings(MFA_EXEMPT_PATHS=["/public/", "/a.b/"])
+    def test_exempt_paths(self):
+        self.assertEqual(self.client.get("/public/page/").status_code, 200)
+        self.assertEqual(self.client.get("/a.b/").status_code, 200)
+        # prefixes are not regular expressions
+        self.assertRedirectsToMFA(self.client.get("/axb/"), "/axb/")
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    @override_settings(MFA_EXEMPT_PATH_PATTERNS=[r"/health/?$"])
+    def test_exempt_patterns(self):
+        self.assertEqual(self.client.get("/health/").status_code, 200)
+        self.assertRedirectsToMFA(self.client.get("/health/deep/"), "/health/deep/")
+
+    def test_exemptions_follow_settings(self):
+        self.assertRedirectsToMFA(self.client.get("/public/page/"), "/public/page/")
+        with self.settings(MFA_EXEMPT_PATHS=["/public/"]):
+            self.assertEqual(self.client.get("/public/page/").status_code, 200)
+        self.assertRedirectsToMFA(self.client.get("/public/page/"), "/public/page/")
+
+    def test_rechallenged_session_is_redirected(self):
+        self.set_mfa_authenticated()
+        rechallenge_user(self.user.id)
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    def test_exempt_matcher(self):
+        matcher = build_exempt_matcher(["/static/", ""], [r"/health/?$", ""])
+        self.assertTrue(matcher.match("/static/app.css"))
+        self.assertTrue(matcher.match("/health"))
+        self.assertFalse(matcher.match("/app/static/"))
+        self.assertFalse(matcher.match("/health/deep"))
+        self.assertIsNone(build_exempt_matcher())
+
+
+class ViewTests(ViewTestCase):
+    login_url = "/mfa/mfa_auth/"
+    request_url = "/mfa/mfa_request/"
+
+    def get_sent_code(self):
+        return re.search(r"Your code is: (\w+)", mail.outbox[-1].body).group(1)
+
+    def login_data(self, code, user_id=None, next_url="/protected/"):
+        return {"user_id": user_id or self.user.id, "auth_code": code, "next": next_url, "trusted_device": ""}
+
+    def test_login_form(self):
+        response = self.client.get(self.login_url, {"next": "/protected/"})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "/protected/")
+
+    def test_login_requires_a_session(self):
+        self.client.logout()
+        response = self.client.get(self.login_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response["Location"].startswith("/login/"))
+
+    def test_request_and_verify_code(self):
+        response = self.client.get(self.request_url, {"next": "/protected/"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/mfa/mfa_auth/?next=/protected/")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["alice@example.com"])
+
+        response = self.client.post(self.login_url, self.login_data(self.get_sent_code()))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/protected/")
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+
+    def test_wrong_code(self):
+        self.client.get(self.request_url)
+        response = self.client.post(self.login_url, self.login_data("wrong"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    def test_code_of_another_user(self):
+        code = get_code_store().create_code_for_user(self.other.id)
+        response = self.client.post(self.login_url, self.login_data(code, user_id=self.other.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    def test_ajax_request(self):
+        response = self.client.get(self.request_url, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["code_created"])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(self.client.session["_simplemfa_code_sent"])
+
+    def test_reset(self):
+        self.client.get(self.request_url)
+        code = self.get_sent_code()
+        self.client.get(self.request_url, {"reset": "true"})
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertFalse(self.client.session["_simplemfa_code_sent"])
+        self.assertEqual(get_code_store().verify(self.user.id, code), CodeVerificationResult.NOT_FOUND)
+
+    def test_post_requires_ajax(self):
+        response = self.client.post(self.request_url, {"user_id": self.user.id})
+        self.assertEqual(response.status_code, 400)
+
+    def test_post_for_another_user(self):
+        response = self.client.post(self.request_url, {"user_id": self.other.id},
+                                    HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(MFA_RATE_LIMITS={"REQUEST": {"USER": (1, 300)}, "VERIFY": {"USER": (1, 300)}})
+    def test_rate_limits(self):
+        self.client.get(self.request_url, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.client.get(self.request_url, {"reset": "true"})
+        response = self.client.get(self.request_url, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response["Retry-After"]) > 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+        self.client.post(self.login_url, self.login_data("wrong"))
+        response = self.client.post(self.login_url, self.login_data("wrong"))
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response["Retry-After"]) > 0)
+
+
+# the middleware only exempts the URLs in simplemfa.urls
+@override_settings(MFA_EXEMPT_PATHS=["/async/"])
+class AsyncViewTests(ViewTestCase):
+    login_url = "/async/mfa_auth/"
+    request_url = "/async/mfa_request/"
+
+    def setUp(self):
+        super().setUp()
+        self.async_client.force_login(self.user)
+
+    async def test_request_and_verify_code(self):
+        response = await self.async_client.get(self.request_url, {"next": "/protected/"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/mfa/mfa_auth/?next=/protected/")
+        self.assertEqual(len(mail.outbox), 1)
+
+        code = re.search(r"Your code is: (\w+)", mail.outbox[0].body).group(1)
+        data = {"user_id": self.user.id, "auth_code": code, "next": "/protected/", "trusted_device": ""}
+        response = await self.async_client.post(self.login_url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/protected/")
+        response = await self.async_client.get("/protected/")
+        self.assertEqual(response.status_code, 200)
+
+    async def test_wrong_code(self):
+        data = {"user_id": self.user.id, "auth_code": "wrong", "next": "/protected/", "trusted_device": ""}
+        response = await self.async_client.post(self.login_url, data)
+        self.assertEqual(response.status_code, 200)
+        response = await self.async_client.get("/protected/")
+        self.assertEqual(response.status_code, 302)
+
+    async def test_login_requires_a_session(self):
+        await sync_to_async(self.async_client.logout)()
+        response = await self.async_client.get(self.login_url)
+        self.assertEqual(response.status_code, 302)
+        response = await self.async_client.get(self.request_url)
+        self.assertEqual(response.status_code, 302)
+
+
+@override_settings(MFA_REQUEST_COALESCE_SECONDS=60)
+class CoalesceTests(ViewTestCase):
+
+    def request_code(self, **params):
+        response = self.client.get("/mfa/mfa_request/", params, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @override_settings(MFA_REQUEST_COALESCE_SECONDS=0)
+    def test_disabled(self):
+        self.assertTrue(claim_code_request(self.user.id, "EMAIL"))
+        self.assertTrue(claim_code_request(self.user.id, "EMAIL"))
+
+    def test_claim(self):
+        self.assertTrue(claim_code_request(self.user.id, "EMAIL"))
+        self.assertFalse(claim_code_request(self.user.id, "EMAIL"))
+        self.assertTrue(claim_code_request(self.other.id, "EMAIL"))
+        # another channel replaces the outstanding code
+        self.assertTrue(claim_code_request(self.user.id, "TEXT"))
+        self.assertFalse(claim_code_request(self.user.id, "TEXT"))
+        release_code_request(self.user.id)
+        self.assertTrue(claim_code_request(self.user.id, "TEXT"))
+
+    def test_duplicate_request_is_coalesced(self):
+        first = self.request_code()
+        self.assertTrue(first["code_created"])
+        self.assertNotIn("coalesced", first)
+        code = re.search(r"Your code is: (\w+)", mail.outbox[0].body).group(1)
+
+        second = self.request_code()
+        self.assertTrue(second["coalesced"])
+        self.assertEqual(len(mail.outbox), 1)
+        # the code that was sent still works
+        self.assertEqual(get_code_store().verify(self.user.id, code), CodeVerificationResult.VALID)
+
+    def test_reset_releases_the_claim(self):
+        self.request_code()
+        self.client.get("/mfa/mfa_request/", {"reset": "true"})
+        self.assertNotIn("coalesced", self.request_code())
+        self.assertEqual(len(mail.outbox), 2)
+
+
+class TrustedDeviceTests(ViewTestCase):
+
+    def trust(self, user=None):
+        request = RequestFactory().get("/", HTTP_USER_AGENT="test")
+        request.user = user or self.user
+        response = HttpResponse()
+        device = trust_device(request, response)
+        return device, response.cookies[DEVICE_COOKIE_NAME].value
+
+    def is_trusted(self, value, user=None):
+        request = RequestFactory().get("/")
+        request.COOKIES[DEVICE_COOKIE_NAME] = value
+        request.user = user or self.user
+        return is_trusted_device(request)
+
+    def test_trusted_device(self):
+        device, value = self.trust()
+        self.assertEqual(device.user_agent, "test")
+        self.assertTrue(self.is_trusted(value))
+        self.assertFalse(self.is_trusted(value, user=self.other))
+
+    def test_tampered_cookie(self):
+        device, value = self.trust()
+        self.assertFalse(self.is_trusted(value[:-1] + ("A" if value[-1] != "A" else "B")))
+        self.assertFalse(self.is_trusted(str(timezone.now().timestamp())))
+        self.assertFalse(self.is_trusted(""))
+
+    def test_expired_device(self):
+        device, value = self.trust()
+        later = device.expires.timestamp() + 1
+        with mock.patch("simplemfa.devices.time.time", return_value=later):
+            self.assertFalse(self.is_trusted(value))
+
+    def test_revoke_device(self):
+        device, value = self.trust()
+        other_device, other_value = self.trust()
+        revoke_device(device.id)
+        self.assertFalse(self.is_trusted(value))
+        self.assertTrue(self.is_trusted(other_value))
+        self.assertFalse(TrustedDevice.objects.filter(id=device.id).exists())
+
+    def test_revoke_user_devices(self):
+        device, value = self.trust()
+        other_device, other_value = self.trust(user=self.other)
+        revoke_user_devices(self.user.id)
+        self.assertFalse(self.is_trusted(value))
+        self.assertTrue(self.is_trusted(other_value, user=self.other))
+        # the revocation is stored in the database, not only in the cache
+        get_device_cache().clear()
+        self.assertFalse(self.is_trusted(value))
+        # devices trusted afterwards are not affected
+        self.assertTrue(self.is_trusted(self.trust()[1]))
+
+    def test_revoke_all_devices(self):
+        values = [self.trust()[1], self.trust(user=self.other)[1]]
+        revoke_all_devices()
+        get_device_cache().clear()
+        self.assertFalse(self.is_trusted(values[0]))
+        self.assertFalse(self.is_trusted(values[1], user=self.other))
+
+    def test_trusted_device_skips_mfa(self):
+        self.client.cookies[DEVICE_COOKIE_NAME] = self.trust()[1]
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+        revoke_user_devices(self.user.id)
+        self.assertRedirectsToMFA(self.client.get("/protected/"), "/protected/")
+
+    def test_login_trusts_device(self):
+        code = get_code_store().create_code_for_user(self.user.id)
+        data = {"user_id": self.user.id, "auth_code": code, "next": "/protected/", "trusted_device": "true"}
+        response = self.client.post("/mfa/mfa_auth/", data)
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(self.is_trusted(response.cookies[DEVICE_COOKIE_NAME].value))
+        self.assertEqual(TrustedDevice.objects.filter(user=self.user).count(), 1)
+
+    def test_revoke_devices_command(self):
+        device, value = self.trust()
+        other_device, other_value = self.trust(user=self.other)
+        call_command("simplemfa_revoke_devices", "--device", str(device.id), stdout=StringIO())
+        self.assertFalse(self.is_trusted(value))
+        self.assertTrue(self.is_trusted(other_value, user=self.other))
+
+        call_command("simplemfa_revoke_devices", "--user", "bob", stdout=StringIO())
+        self.assertFalse(self.is_trusted(other_value, user=self.other))
+
+        value = self.trust()[1]
+        call_command("simplemfa_revoke_devices", "--all", stdout=StringIO())
+        self.assertFalse(self.is_trusted(value))
+
+        with self.assertRaises(CommandError):
+            call_command("simplemfa_revoke_devices", "--user", "nobody", stdout=StringIO())
+        with self.assertRaises(CommandError):
+            call_command("simplemfa_revoke_devices", stdout=StringIO())
+
+
+class TOTPViewTests(ViewTestCase):
+    enroll_url = "/mfa/mfa_totp/"
+
+    def login_data(self, code):
+        return {"user_id": self.user.id, "auth_code": code, "next": "/protected/", "trusted_device": ""}
+
+    def test_enrollment_requires_mfa(self):
+        self.assertRedirectsToMFA(self.client.get(self.enroll_url), self.enroll_url)
+
+    def test_enroll(self):
+        self.set_mfa_authenticated()
+        response = self.client.get(self.enroll_url)
+        secret = response.context["secret"]
+        self.assertTrue(response.context["provisioning_uri"].startswith("otpauth://totp/"))
+
+        response = self.client.post(self.enroll_url, {"auth_code": "wrong"})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(TOTPDevice.objects.get(user=self.user).confirmed)
+
+        response = self.client.post(self.enroll_url, {"auth_code": totp_code(secret)})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(TOTPDevice.objects.get(user=self.user).confirmed)
+
+        self.client.post(self.enroll_url, {"action": "remove"})
+        self.assertFalse(TOTPDevice.objects.filter(user=self.user).exists())
+
+    def test_login_with_totp(self):
+        device = TOTPDevice.objects.create(user=self.user, confirmed=True)
+        response = self.client.get("/mfa/mfa_request/", {"sent_via": "TOTP"})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertFalse(AuthCode.objects.exists())
+
+        code = totp_code(device.secret)
+        response = self.client.post("/mfa/mfa_auth/", self.login_data(code))
+        self.assertEqual(response["Location"], "/protected/")
+        self.assertEqual(self.client.get("/protected/").status_code, 200)
+
+        # a code cannot be replayed within its time step
+        self.client.logout()
+        self.client.force_login(self.user)
+        self.client.get("/mfa/mfa_request/", {"sent_via": "TOTP"})
+        response = self.client.post("/mfa/mfa_auth/", self.login_data(code))
+        self.assertEqual(response.status_code, 200)
+
+    def test_totp_without_enrollment(self):
+        self.client.get("/mfa/mfa_request/", {"sent_via": "TOTP"})
+        self.assertFalse(self.client.session["_simplemfa_code_sent"])
+
+
+class CodeHasherTests(SimpleMFATestCase):
+
+    def test_default_hasher(self):
+        self.assertIsInstance(get_code_hasher(), HMACSHA256CodeHasher)
+
+    def test_hmac_round_trip(self):
+        encoded = make_code_hash("123456")
+        self.assertTrue(encoded.startswith("hmac_sha256$"))
+        self.assertTrue(check_code_hash("123456", encoded))
+        self.assertFalse(check_code_hash("123457", encoded))
+
+    def test_hmac_is_salted(self):
+        hasher = HMACSHA256CodeHasher()
+        self.assertNotEqual(hasher.encode("123456"), hasher.encode("123456"))
+
+    def test_hmac_rejects_tampered_hashes(self):
+        algorithm, salt, digest = make_code_hash("123456").split("$")
+        tampered = digest[:-1] + ("0" if digest[-1] != "0" else "1")
+        self.assertFalse(check_code_hash("123456", f"{algorithm}${salt}${tampered}"))
+        self.assertFalse(check_code_hash("123456", f"{algorithm}$other${digest}"))
+        self.assertFalse(check_code_hash("123456", "garbage"))
+        self.assertFalse(check_code_hash(None, make_code_hash("123456")))
+        self.assertFalse(check_code_hash("123456", ""))
+
+    def test_hmac_is_keyed_by_secret_key(self):
+        encoded = make_code_hash("123456")
+        with self.settings(SECRET_KEY="another-secret-key-another-secret-key-another-secret"):
+            self.assertFalse(check_code_hash("123456", encoded))
+
+    def test_password_hashes_still_verify(self):
+        encoded = make_password("123456")
+        self.assertTrue(DjangoPasswordCodeHasher().handles(encoded))
+        self.assertTrue(check_code_hash("123456", encoded))
+        self.assertFalse(check_code_hash("654321", encoded))
+
+    @override_settings(MFA_CODE_HASHER="simplemfa.hashers.DjangoPasswordCodeHasher")
+    def test_hmac_hashes_verify_after_hasher_change(self):
+        encoded = HMACSHA256CodeHasher().encode("123456")
+        self.assertTrue(check_code_hash("123456", encoded))
+        self.assertFalse(check_code_hash("654321", encoded))
+
+
+class CodeGenerationTests(SimpleMFATestCase):
+
+    def test_random_code(self):
+        self.assertRegex(random_code(), r"^\d{%d}$" % DEFAULTS["MFA_CODE_LENGTH"])
+        with self.settings(MFA_CODE_LENGTH=8):
+            self.assertRegex(random_code(), r"^\d{8}$")
+        self.assertRegex(random_code(12, alphabet="ABC"), r"^[ABC]{12}$")
+
+    def test_random_codes(self):
+        codes = random_codes(50, length=4, alphabet="xyz")
+        self.assertEqual(len(codes), 50)
+        self.assertTrue(all(re.match(r"^[xyz]{4}$", code) for code in codes))
+
+    def test_unique_codes(self):
+        self.assertEqual(sorted(random_codes(10, length=1, unique=True)), list("0123456789"))
+        with self.assertRaises(ValueError):
+            random_codes(11, length=1, unique=True)
+
+    def test_no_modulo_bias(self):
+        table, rejected, limit = get_translation("0123456789")
+        self.assertEqual(limit, 250)
+        self.assertEqual(rejected, bytes(range(250, 256)))
+        # every digit is produced by exactly 25 of the accepted bytes
+        self.assertEqual({char: table[:limit].count(char.encode()) for char in "0123456789"},
+                         {char: 25 for char in "0123456789"})
+        with mock.patch("simplemfa.codes.secrets.token_bytes", return_value=bytes([250, 3, 255, 14])):
+            self.assertEqual(random_chars(2), "34")
+
+    def test_invalid_alphabet(self):
+        for alphabet in ("", "é", "x" * 257):
+            with self.subTest(alphabet=alphabet), self.assertRaises(ValueError):
+                random_code(alphabet=alphabet)
+
+
+class TOTPTests(SimpleMFATestCase):
+
+    def test_rfc4226_vectors(self):
+        codes = ["755224", "287082", "359152", "969429", "338314", "254676", "287922", "162583", "399871", "520489"]
+        self.assertEqual([hotp_code(b"12345678901234567890", counter) for counter in range(10)], codes)
+
+    def test_rfc6238_vectors(self):
+        for timestamp, code in RFC6238_VECTORS.items():
+            with self.subTest(timestamp=timestamp):
+                self.assertEqual(totp_code(RFC6238_SECRET, timestamp=timestamp, digits=8), code)
+
+    def test_drift_window(self):
+        self.assertEqual(match_totp(RFC6238_SECRET, "94287082", timestamp=59 + 30, digits=8), 1)
+        self.assertIsNone(match_totp(RFC6238_SECRET, "94287082", timestamp=59 + 60, digits=8))
+        self.assertIsNone(match_totp(RFC6238_SECRET, "94287082", timestamp=59 + 30, digits=8, drift=0))
+
+    def test_malformed_codes(self):
+        for code in (None, "", "9428708", "942870820", "9428708a"):
+            with self.subTest(code=code):
+                self.assertIsNone(match_totp(RFC6238_SECRET, code, timestamp=59, digits=8))
+
+    @override_settings(MFA_TOTP_DIGITS=8)
+    def test_codes_cannot_be_replayed(self):
+        self.assertTrue(verify_totp(self.user.id, RFC6238_SECRET, "94287082", timestamp=59))
+        self.assertFalse(verify_totp(self.user.id, RFC6238_SECRET, "94287082", timestamp=59))
+        # the time step is used per user
+        self.assertTrue(verify_totp(self.other.id, RFC6238_SECRET, "94287082", timestamp=59))
+
+
+class RecoveryCodeTests(SimpleMFATestCase):
+
+    def test_generate(self):
+        codes = generate_recovery_codes(self.user.id, count=8)
+        self.assertEqual(len(set(codes)), 8)
+        self.assertEqual(count_recovery_codes(self.user.id), 8)
+        # a new set replaces the old one
+        generate_recovery_codes(self.user.id, count=3)
+        self.assertEqual(count_recovery_codes(self.user.id), 3)
+        self.assertFalse(use_recovery_code(self.user.id, codes[0]))
+
+    def test_codes_are_single_use(self):
+        code = generate_recovery_codes(self.user.id, count=2)[0]
+        self.assertTrue(use_recovery_code(self.user.id, code))
+        self.assertFalse(use_recovery_code(self.user.id, code))
+        self.assertEqual(count_recovery_codes(self.user.id), 1)
+
+    def test_codes_are_normalized(self):
+        code = generate_recovery_codes(self.user.id, count=1)[0]
+        self.assertTrue(use_recovery_code(self.user.id, f" {code.replace('-', ' ').lower()} "))
+
+    def test_codes_belong_to_one_user(self):
+        code = generate_recovery_codes(self.user.id, count=1)[0]
+        self.assertFalse(use_recovery_code(self.other.id, code))
+        self.assertTrue(use_recovery_code(self.user.id, code))
+
+    def test_recovery_code_completes_mfa(self):
+        code = generate_recovery_codes(self.user.id, count=1)[0]
+        form = MFAAuth({"user_id": self.user.id, "auth_code": code, "next": "/", "trusted_device": "false"},
+                       user=self.user)
+        self.assertTrue(form.authenticate())
+        self.assertTrue(form.used_recovery_code)
+
+
+class RecoveryCodeViewTests(ViewTestCase):
+    recovery_url = "/mfa/mfa_recovery/"
+
+    def test_codes_require_mfa(self):
+        self.assertRedirectsToMFA(self.client.post(self.recovery_url), self.recovery_url)
+        self.assertEqual(count_recovery_codes(self.user.id), 0)
+
+    def test_generate_codes(self):
+        self.set_mfa_authenticated()
+        self.assertEqual(self.client.get(self.recovery_url).context["remaining"], 0)
+        response = self.client.post(self.recovery_url)
+        self.assertEqual(len(response.context["codes"]), DEFAULTS["MFA_RECOVERY_CODE_COUNT"])
+        for code in response.context["codes"]:
+            self.assertContains(response, code)
+        self.assertEqual(response.context["remaining"], DEFAULTS["MFA_RECOVERY_CODE_COUNT"])
+
+    def test_login_with_recovery_code(self):
+        code = generate_recovery_codes(self.user.id, count=1)[0]
+        data = {"user_id": self.user.id, "auth_code": code, "next": "/protected/", "trusted_device": ""}
+        response = self.client.post("/mfa/mfa_auth/", data)
+        self.assertEqual(response["Location"], "/protected/")
+        self.assertEqual(count_recovery_codes(self.user.id), 0)
+
+
+class CodeVerificationTests(SimpleMFATestCase):
+
+    def get_form(self, user_id, code, user=None):
+        data = {"user_id": user_id, "auth_code": code, "next": "/", "trusted_device": "false"}
+        return MFAAuth(data, user=user or self.user)
+
+    def test_valid_code(self):
+        code = get_code_store().create_code_for_user(self.user.id)
+        self.assertTrue(self.get_form(self.user.id, code).authenticate())
+        # a code is used once
+        self.assertFalse(self.get_form(self.user.id, code).authenticate())
+
+    def test_wrong_code(self):
+        code = get_code_store().create_code_for_user(self.user.id)
+        form = self.get_form(self.user.id, "X" * len(code))
+        self.assertFalse(form.authenticate())
+        self.assertIn("auth_code", form.errors)
+
+    def test_other_users_code_is_refused(self):
+        # a session must not complete MFA by posting another account's id and code
+        code = get_code_store().create_code_for_user(self.other.id)
+        form = self.get_form(self.other.id, code)
+        self.assertFalse(form.authenticate())
+        self.assertIn("user_id", form.errors)
+        self.assertEqual(get_code_store().verify(self.other.id, code), CodeVerificationResult.VALID)
+
+    def test_inactive_user_is_refused(self):
+        code = get_code_store().create_code_for_user(self.user.id)
+        self.user.is_active = False
+        self.assertFalse(self.get_form(self.user.id, code).authenticate())
+
+    def test_new_code_replaces_old(self):
+        store = get_code_store()
+        old = store.create_code_for_user(self.user.id)
+        new = store.create_code_for_user(self.user.id)
+        self.assertEqual(AuthCode.objects.filter(user=self.user).count(), 1)
+        if old != new:
+            self.assertEqual(store.verify(self.user.id, old), CodeVerificationResult.INVALID)
+        self.assertEqual(store.verify(self.user.id, new), CodeVerificationResult.VALID)
+
+
+class DatabaseCodeStoreTests(SimpleMFATestCase):
+    store_path = "simplemfa.stores.DatabaseCodeStore"
+
+    def setUp(self):
+        super().setUp()
+        self.store = get_code_store(self.store_path)
+
+    def expire(self):
+        later = timezone.now() + timezone.timedelta(seconds=DEFAULTS["MFA_CODE_EXPIRATION"] + 1)
+        return mock.patch("simplemfa.stores.timezone.now", return_value=later)
+
+    def test_verify(self):
+        code = self.store.create_code_for_user(self.user.id)
+        self.assertEqual(self.store.verify(self.user.id, code), CodeVerificationResult.VALID)
+        self.assertEqual(self.store.verify(self.user.id, "wrong"), CodeVerificationResult.INVALID)
+        self.assertEqual(self.store.verify(self.other.id, code), CodeVerificationResult.NOT_FOUND)
+
+    def test_expired_code_is_removed(self):
+        code = self.store.create_code_for_user(self.user.id)
+        with self.expire():
+            self.assertEqual(self.store.verify(self.user.id, code), CodeVerificationResult.EXPIRED)
+        self.assertEqual(self.store.verify(self.user.id, code), CodeVerificationResult.NOT_FOUND)
+
+    def test_new_code_replaces_old(self):
+        old = self.store.create_code_for_user(self.user.id)
+        new = self.store.create_code_for_user(self.user.id)
+        self.assertEqual(self.store.verify(self.user.id, new), CodeVerificationResult.VALID)
+        if old != new:
+            self.assertEqual(self.store.verify(self.user.id, old), CodeVerificationResult.INVALID)
+
+    def test_delete_codes(self):
+        codes = {user.id: self.store.create_code_for_user(user.id) for user in (self.user, self.other)}
+        self.store.delete_all_codes_for_user(self.user.id)
+        self.assertEqual(self.store.verify(self.user.id, codes[self.user.id]), CodeVerificationResult.NOT_FOUND)
+        self.assertEqual(self.store.verify(self.other.id, codes[self.other.id]), CodeVerificationResult.VALID)
+
+        codes = {user.id: self.store.create_code_for_user(user.id) for user in (self.user, self.other)}
+        self.store.delete_codes_for_users([self.user.id, self.other.id])
+        for user_id, code in codes.items():
+            self.assertEqual(self.store.verify(user_id, code), CodeVerificationResult.NOT_FOUND)
+
+        codes = {user.id: self.store.create_code_for_user(user.id) for user in (self.user, self.other)}
+        self.store.delete_all_codes(chunk_size=1)
+        for user_id, code in codes.items():
+            self.assertEqual(self.store.verify(user_id, code), CodeVerificationResult.NOT_FOUND)
+
+
+class CacheCodeStoreTests(DatabaseCodeStoreTests):
+    store_path = "simplemfa.stores.CacheCodeStore"
+
+    def test_no_queries(self):
+        with self.assertNumQueries(0):
+            code = self.store.create_code_for_user(self.user.id)
+            self.assertEqual(self.store.verify(self.user.id, code), CodeVerificationResult.VALID)
+        self.assertFalse(AuthCode.objects.exists())
+
+    def test_entry_expires_in_the_cache(self):
+        with mock.patch.object(LocMemCache, "set") as cache_set:
+            self.store.create_code_for_user(self.user.id)
+        self.assertEqual(cache_set.call_args[0][2], DEFAULTS["MFA_CODE_EXPIRATION"])
+
+    @override_settings(MFA_CODE_STORE="simplemfa.stores.CacheCodeStore")
+    def test_selected_by_setting(self):
+        self.assertIsInstance(get_code_store(), CacheCodeStore)
+        code = self.store.create_code_for_user(self.user.id)
+        form = MFAAuth({"user_id": self.user.id, "auth_code": code, "next": "/", "trusted_device": ""}, user=self.user)
+        self.assertTrue(form.authenticate())
+
+
+class CodeUpsertTests(SimpleMFATestCase):
+
+    def without_upsert(self):
+        return mock.patch.object(connection.features, "supports_update_conflicts_with_target", False)
+
+    def assertSingleCode(self, code):
+        self.assertEqual(AuthCode.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(get_code_store().verify(self.user.id, code), CodeVerificationResult.VALID)
+
+    def test_replace_code(self):
+        AuthCode.create_code_for_user(self.user.id)
+        self.assertSingleCode(AuthCode.create_code_for_user(self.user.id, sent_via="TEXT"))
+        self.assertEqual(AuthCode.objects.get(user=self.user).sent_via, "TEXT")
+
+    def test_replace_code_without_upsert(self):
+        with self.without_upsert():
+            AuthCode.create_code_for_user(self.user.id)
+            self.assertSingleCode(AuthCode.create_code_for_user(self.user.id))
+
+    def test_concurrent_insert_without_upsert(self):
+        AuthCode.create_code_for_user(self.user.id)
+        # another request inserted the row between our lookup and insert
+        with self.without_upsert(), mock.patch.object(AuthCode.objects, "update_or_create", side_effect=IntegrityError):
+            self.assertSingleCode(AuthCode.create_code_for_user(self.user.id))
+
+    def test_one_code_per_user(self):
+        AuthCode.create_code_for_user(self.user.id)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            AuthCode.objects.create(user=self.user, code="x", expires=timezone.now())
+
+
+@override_settings(MFA_RATE_LIMITS={"VERIFY": {"USER": (3, 300), "IP": (5, 300)}})
+class RateLimitTests(SimpleMFATestCase):
+
+    def get_request(self, user, ip="192.0.2.1", **extra):
+        request = RequestFactory().post("/", REMOTE_ADDR=ip, **extra)
+        request.user = user
+        return request
+
+    def test_no_limits_by_default(self):
+        self.assertEqual(DEFAULTS["MFA_RATE_LIMITS"], {})
+
+    def test_user_limit(self):
+        limiter = RateLimiter.for_scope("VERIFY")
+        for _ in range(3):
+            self.assertIsNone(limiter.hit(self.get_request(self.user)))
+        retry_after = limiter.hit(self.get_request(self.user))
+        self.assertIsNotNone(retry_after)
+        self.assertTrue(0 < retry_after <= 301)
+        # other accounts have their own budget
+        self.assertIsNone(limiter.hit(self.get_request(self.other, ip="192.0.2.2")))
+
+    def test_ip_limit(self):
+        limiter = RateLimiter.for_scope("VERIFY")
+        users = [User.objects.create_user(f"user{i}") for i in range(6)]
+        results = [limiter.hit(self.get_request(user)) for user in users]
+        self.assertEqual(results[:5], [None] * 5)
+        self.assertIsNotNone(results[5])
+
+    def test_forwarded_for_is_not_trusted(self):
+        limiter = RateLimiter.for_scope("VERIFY")
+        users = [User.objects.create_user(f"user{i}") for i in range(6)]
+        # a client cannot dodge the per-IP limit by sending a different X-Forwarded-For every time
+        results = [limiter.hit(self.get_request(user, HTTP_X_FORWARDED_FOR=f"203.0.113.{i}"))
+                   for i, user in enumerate(users)]
+        self.assertIsNotNone(results[5])
+
+    def test_request_ip(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="10.0.0.2", HTTP_X_FORWARDED_FOR="203.0.113.9, 198.51.100.7")
+        self.assertEqual(get_request_ip(request), "10.0.0.2")
+        self.assertEqual(get_request_ip(request, proxy_count=1), "198.51.100.7")
+        self.assertEqual(get_request_ip(request, proxy_count=2), "203.0.113.9")
+        # the request did not pass through every proxy
+        self.assertEqual(get_request_ip(request, proxy_count=3), "10.0.0.2")
+
+    @override_settings(MFA_RATE_LIMIT_PROXY_COUNT=1)
+    def test_trusted_proxy(self):
+        limiter = RateLimiter.for_scope("VERIFY")
+        users = [User.objects.create_user(f"user{i}") for i in range(6)]
+        # the proxy's address is shared by every client; the address it recorded is not
+        results = [limiter.hit(self.get_request(user, ip="10.0.0.2", HTTP_X_FORWARDED_FOR=f"spoofed, 198.51.100.{i}"))
+                   for i, user in enumerate(users)]
+        self.assertEqual(results, [None] * 6)
+
+    def test_reset(self):
+        limiter = RateLimiter.for_scope("VERIFY")
+        for _ in range(4):
+            limiter.hit(self.get_request(self.user))
+        limiter.reset(self.get_request(self.user))
+        self.assertIsNone(limiter.hit(self.get_request(self.user)))
+
+    def test_unlimited_scope(self):
+        limiter = RateLimiter.for_scope("REQUEST")
+        for _ in range(20):
+            self.assertIsNone(limiter.hit(self.get_request(self.user)))
+
+
+@override_settings(MFA_DELIVERY_MAX_ATTEMPTS=1)
+class OutboxTests(SimpleMFATestCase):
+
+    def deliver(self):
+        call_command("simplemfa_deliver", stdout=StringIO(), stderr=StringIO())
+
+    def test_queued_code_is_created_at_send_time(self):
+        job = DeliveryJob.enqueue(self.user.id, "EMAIL", app_name="Test", url="http://testserver/mfa/")
+        self.assertEqual(job.code, "")
+        self.assertFalse(AuthCode.objects.filter(user=self.user).exists())
+        self.deliver()
+        job.refresh_from_db()
+        self.assertEqual(job.status, "SENT")
+        self.assertEqual(job.code, "")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue(AuthCode.objects.filter(user=self.user).exists())
+
+    @override_settings(EMAIL_BACKEND="simplemfa.tests.RefusingEmailBackend")
+    def test_refused_email_fails_only_its_job(self):
+        users = [self.user, User.objects.create_user("carol", "refused@example.com"), self.other]
+        for reuse in (True, False):
+            with self.subTest(reuse_connection=reuse), self.settings(MFA_EMAIL_REUSE_CONNECTION=reuse):
+                DeliveryJob.objects.all().delete()
+                mail.outbox = []
+                jobs = [DeliveryJob.enqueue(user.id, "EMAIL", app_name="Test", url="http://testserver/mfa/")
+                        for user in users]
+                self.deliver()
+                statuses = [DeliveryJob.objects.get(id=job.id).status for job in jobs]
+                self.assertEqual(statuses, ["SENT", "FAILED", "SENT"])
+                self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                                 ["alice@example.com", "bob@example.com"])
+
+
+@override_settings(MFA_ASYNC_DELIVERY=True)
+class QueuedDeliveryViewTests(ViewTestCase):
+
+    def request_code(self, **params):
+        response = self.client.get("/mfa/mfa_request/", params, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_request_is_queued(self):
+        response = self.request_code()
+        self.assertTrue(response["code_created"])
+        self.assertEqual(response["message"], MessageConstants.MFA_NEW_CODE_QUEUED)
+        self.assertEqual(response["delivery_status"], "PENDING")
+        self.assertEqual(len(mail.outbox), 0)
+
+        call_command("simplemfa_deliver", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(self.request_code(status="true"),
+                         {"delivery_id": response["delivery_id"], "delivery_status": "SENT"})
+        code = re.search(r"Your code is: (\w+)", mail.outbox[0].body).group(1)
+        self.assertEqual(get_code_store().verify(self.user.id, code), CodeVerificationResult.VALID)
+
+    def test_new_request_cancels_the_queued_one(self):
+        first = self.request_code()
+        second = self.request_code()
+        self.assertFalse(DeliveryJob.objects.filter(id=first["delivery_id"]).exists())
+        call_command("simplemfa_deliver", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(DeliveryJob.objects.get(id=second["delivery_id"]).status, "SENT")
+        self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(TWILIO_ACCOUNT_SID="AC" + "0" * 32, TWILIO_AUTH_TOKEN="token", TWILIO_NUMBER="+15005550006")
+class DeliveryBackendTests(SimpleMFATestCase):
+
+    def test_backends_are_shared(self):
+        backend = get_delivery_backend("EMAIL")
+        self.assertIsInstance(backend, EmailBackend)
+        self.assertIs(get_delivery_backend("EMAIL"), backend)
+        self.assertIsNone(get_delivery_backend("PIGEON"))
+
+    def test_backends_follow_settings(self):
+        backend = get_delivery_backend("TEXT")
+        with self.settings(MFA_DELIVERY_BACKENDS={"TEXT": "simplemfa.backends.LocMemBackend"}):
+            self.assertIsInstance(get_delivery_backend("TEXT"), LocMemBackend)
+        self.assertIsNot(get_delivery_backend("TEXT"), backend)
+        self.assertIsInstance(get_delivery_backend("TEXT"), TwilioBackend)
+
+    def test_twilio_clients_are_shared_per_channel(self):
+        client = TwilioBackend.get_client("TEXT")
+        self.assertIs(TwilioBackend.get_client("TEXT"), client)
+        self.assertIsNot(TwilioBackend.get_client("PHONE"), client)
+        self.assertEqual(client.http_client.timeout, 5.0)
+
+    def test_twilio_clients_follow_settings(self):
+        client = TwilioBackend.get_client("TEXT")
+        with self.settings(MFA_CIRCUIT_BREAKER={"CHANNELS": {"TEXT": {"TIME_BUDGET": 2.0}}}):
+            self.assertEqual(TwilioBackend.get_client("TEXT").http_client.timeout, 2.0)
+        self.assertIsNot(TwilioBackend.get_client("TEXT"), client)
+        with self.settings(TWILIO_AUTH_TOKEN=None):
+            self.assertIsNone(TwilioBackend.get_client("TEXT"))
+
+
+@override_settings(EMAIL_BACKEND="simplemfa.tests.CountingEmailBackend")
+class EmailBackendTests(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        CountingEmailBackend.connections = 0
+        self.backend = EmailBackend(mode="EMAIL")
+        self.addCleanup(EmailBackend.close_connection)
+
+    def context(self, user):
+        return build_message_context(user, "123456", app_name="Test", url="http://testserver/mfa/")
+
+    def test_send_connects_per_message(self):
+        for user in (self.user, self.other):
+            self.assertTrue(self.backend.send(user, self.context(user)))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(CountingEmailBackend.connections, 2)
+
+    def test_send_many_uses_one_connection(self):
+        users = [self.user, self.other, User.objects.create_user("carol", "")]
+        self.assertEqual(self.backend.send_many([(user, self.context(user)) for user in users]), [True, True, False])
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(CountingEmailBackend.connections, 1)
+
+    @override_settings(MFA_EMAIL_REUSE_CONNECTION=True)
+    def test_reused_connection(self):
+        self.backend.send(self.user, self.context(self.user))
+        connection = EmailBackend.get_connection()
+        self.backend.send(self.other, self.context(self.other))
+        self.assertIs(EmailBackend.get_connection(), connection)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(CountingEmailBackend.connections, 1)
+
+
+class PurgeTests(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        now = timezone.now()
+        users = [User.objects.create_user(f"user{i}") for i in range(8)]
+        # five expired codes and three live ones
+        AuthCode.objects.bulk_create([AuthCode(user=user, code="x", expires=now + timezone.timedelta(
+            minutes=-5 if index < 5 else 5)) for index, user in enumerate(users)])
+
+    def purge(self, **options):
+        stdout = StringIO()
+        call_command("simplemfa_purge", stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def test_purge_in_chunks(self):
+        with CaptureQueriesContext(connection) as queries:
+            output = self.purge(chunk_size=2, skip_jobs=True, verbosity=2)
+        self.assertIn("Purged 5 MFA Authentication Codes", output)
+        self.assertEqual(output.count("MFA Authentication Codes: deleted"), 3)
+        self.assertEqual(AuthCode.objects.count(), 3)
+        self.assertFalse(AuthCode.objects.filter(expires__lte=timezone.now()).exists())
+        # chunks are read in the order of the expires index
+        selects = [query["sql"] for query in queries.captured_queries
+                   if query["sql"].startswith("SELECT") and "simplemfa_authcode" in query["sql"]]
+        self.assertTrue(selects)
+        order_by = f"ORDER BY {connection.ops.quote_name('simplemfa_authcode')}.{connection.ops.quote_name('expires')}"
+        self.assertTrue(all(order_by in sql for sql in selects))
+
+    def test_max_chunks(self):
+        self.purge(chunk_size=2, max_chunks=1, skip_jobs=True)
+        self.assertEqual(AuthCode.objects.count(), 6)
+        self.purge(chunk_size=2)
+        self.assertEqual(AuthCode.objects.count(), 3)
+
+    def test_purge_jobs_and_devices(self):
+        now = timezone.now()
+        url = "http://testserver/mfa/"
+        pending = DeliveryJob.enqueue(self.user.id, "EMAIL", app_name="Test", url=url)
+        DeliveryJob.objects.create(user=self.user, status="SENT", url=url)
+        DeliveryJob.objects.create(user=self.user, status="FAILED", url=url)
+        DeliveryJob.objects.create(user=self.user, expires=now - timezone.timedelta(minutes=1), url=url)
+        device = TrustedDevice.objects.create(user=self.user, expires=now + timezone.timedelta(days=1))
+        TrustedDevice.objects.create(user=self.user, expires=now - timezone.timedelta(days=1))
+
+        self.purge(chunk_size=1)
+        self.assertEqual(list(DeliveryJob.objects.values_list("id", flat=True)), [pending.id])
+        self.assertEqual(list(TrustedDevice.objects.values_list("id", flat=True)), [device.id])
+
+    def test_skip_jobs(self):
+        DeliveryJob.objects.create(user=self.user, status="SENT")
+        self.purge(skip_jobs=True)
+        self.assertEqual(DeliveryJob.objects.count(), 1)
+
+
+@override_settings(MFA_DELIVERY_BACKENDS={"TEXT": "simplemfa.backends.LocMemBackend",
+                                          "PHONE": "simplemfa.backends.LocMemBackend"},
+                   MFA_DELIVERY_FANOUT=["TEXT", "PHONE"])
+class FanOutTests(SimpleMFATestCase):
+
+    def deliver(self, mode="TEXT"):
+        context = build_message_context(self.user, "123456", app_name="Test", url="http://testserver/mfa/")
+        return deliver_mfa_code(self.user, context, mode=mode)
+
+    def test_first_confirmation_completes_delivery(self):
+        self.assertIn(self.deliver(), ("TEXT", "PHONE"))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_failing_channel_does_not_block_the_others(self):
+        for backend in ("simplemfa.tests.FailingBackend", "simplemfa.tests.RaisingBackend"):
+            with self.subTest(backend=backend), self.settings(MFA_DELIVERY_BACKENDS={
+                    "TEXT": backend, "PHONE": "simplemfa.backends.LocMemBackend"}):
+                outbox.clear()
+                with self.assertLogs("simplemfa", "WARNING"):
+                    self.assertEqual(self.deliver(), "PHONE")
+                self.assertEqual([entry["mode"] for entry in outbox], ["PHONE"])
+
+    @override_settings(MFA_DELIVERY_BACKENDS={"TEXT": "simplemfa.tests.FailingBackend",
+                                              "PHONE": "simplemfa.tests.RaisingBackend"})
+    def test_falls_back_to_email(self):
+        with self.assertLogs("simplemfa", "WARNING"):
+            self.assertEqual(self.deliver(), "EMAIL")
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_modes_outside_the_fanout(self):
+        self.assertEqual(self.deliver(mode="EMAIL"), "EMAIL")
+        self.assertEqual(outbox, [])
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_outage(self):
+        LocMemBackend.fail = True
+        try:
+            with self.assertLogs("simplemfa", "WARNING"):
+                self.assertEqual(self.deliver(), "EMAIL")
+        finally:
+            LocMemBackend.fail = False
+
+
+class CircuitBreakerTests(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.breaker = CircuitBreaker("TEXT", failure_threshold=3, reset_timeout=60, time_budget=5.0)
+        self.events = []
+        for signal in (circuit_opened, circuit_closed):
+            signal.connect(self.receive_event)
+            self.addCleanup(signal.disconnect, self.receive_event)
+
+    def receive_event(self, signal, **kwargs):
+        self.events.append("opened" if signal is circuit_opened else "closed")
+
+    def later(self, seconds):
+        return mock.patch("simplemfa.breakers.time.time", return_value=self.now + seconds)
+
+    def open_breaker(self):
+        self.now = 1000000.0
+        with self.later(0), self.assertLogs("simplemfa", "WARNING"):
+            for _ in range(3):
+                self.breaker.record(False)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.allow_request())
+        self.open_breaker()
+        self.assertEqual(self.events, ["opened"])
+        with self.later(59):
+            self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_the_count(self):
+        for succeeded in (False, False, True, False, False):
+            self.breaker.record(succeeded)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.events, [])
+
+    def test_slow_calls_count_as_failures(self):
+        self.breaker.failure_threshold = 1
+        with self.assertLogs("simplemfa", "WARNING"):
+            self.breaker.record(True, elapsed=6.0)
+        self.assertEqual(self.events, ["opened"])
+
+    def test_half_open_probe_closes(self):
+        self.open_breaker()
+        with self.later(61):
+            # one probe across all workers
+            self.assertTrue(self.breaker.allow_request())
+            self.assertFalse(self.breaker.allow_request())
+            self.breaker.record(True)
+            self.assertTrue(self.breaker.allow_request())
+            self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.events, ["opened", "closed"])
+
+    def test_failed_probe_reopens(self):
+        self.open_breaker()
+        # the failure count expires before the probe
+        self.breaker.cache.delete(self.breaker.make_key("failures"))
+        with self.later(61):
+            self.assertTrue(self.breaker.allow_request())
+            with self.assertLogs("simplemfa", "WARNING"):
+                self.breaker.record(False)
+            self.assertFalse(self.breaker.allow_request())
+        with self.later(61 + 59):
+            self.assertFalse(self.breaker.allow_request())
+        with self.later(61 + 61):
+            self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.events, ["opened", "opened"])
+
+    @override_settings(MFA_CIRCUIT_BREAKER={"CHANNELS": {"PHONE": {"ENABLED": False}}})
+    def test_settings(self):
+        self.assertIsNone(CircuitBreaker.for_channel("PHONE"))
+        self.assertEqual(CircuitBreaker.for_channel("TEXT").failure_threshold, 5)
+
+
+class AuthCodeAdminTests(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.model_admin = admin.site._registry[AuthCode]
+        self.request = RequestFactory().post("/admin/simplemfa/authcode/")
+        self.request.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.request._messages = CookieStorage(self.request)
+        for user in (self.user, self.other):
+            AuthCode.create_code_for_user(user.id)
+
+    def get_messages(self):
+        return [str(message) for message in self.request._messages]
+
+    def test_delete_selected_is_removed(self):
+        actions = self.model_admin.get_actions(self.request)
+        self.assertNotIn("delete_selected", actions)
+        self.assertIn("purge_expired", actions)
+
+    def test_purge_expired(self):
+        AuthCode.objects.filter(user=self.user).update(expires=timezone.now() - timezone.timedelta(seconds=1))
+        self.model_admin.purge_expired(self.request, AuthCode.objects.all())
+        self.assertEqual(list(AuthCode.objects.values_list("user_id", flat=True)), [self.other.id])
+        self.assertEqual(self.get_messages(), ["Purged 1 expired code(s)."])
+
+    def test_revoke_codes(self):
+        DeliveryJob.enqueue(self.user.id, "EMAIL", app_name="Test", url="http://testserver/mfa/")
+        self.model_admin.revoke_codes(self.request, AuthCode.objects.filter(user=self.user))
+        self.assertEqual(list(AuthCode.objects.values_list("user_id", flat=True)), [self.other.id])
+        self.assertFalse(DeliveryJob.objects.filter(status="PENDING").exists())
+        self.assertEqual(self.get_messages(), ["Revoked 1 code(s)."])
+
+    def test_rechallenge(self):
+        before = get_mfa_epochs(self.user.id)
+        self.model_admin.rechallenge(self.request, AuthCode.objects.filter(user=self.user))
+        self.assertNotEqual(get_mfa_epochs(self.user.id), before)
+        self.assertEqual(self.get_messages(), ["1 user(s) must complete MFA again."])
+
+
+class RenderingTests(SimpleMFATestCase):
+
+    def test_templates_are_cached(self):
+        compiled = get_cached_template("simplemfa/auth_email.html")
+        self.assertIs(get_cached_template("simplemfa/auth_email.html"), compiled)
+        with self.settings(TEMPLATES=VIEW_SETTINGS["TEMPLATES"]):
+            self.assertIsNot(get_cached_template("simplemfa/auth_email.html"), compiled)
+
+    def test_template_fallback(self):
+        names = ["simplemfa/missing.html", "simplemfa/auth.html", "simplemfa/mfa_auth.html"]
+        self.assertEqual(resolve_template_fallback(names), "simplemfa/auth.html")
+        self.assertEqual(resolve_template_fallback(names), "simplemfa/auth.html")
+        with self.assertRaises(TemplateDoesNotExist):
+            resolve_template_fallback(["simplemfa/missing.html"])
+
+    def test_voice_twiml(self):
+        from twilio.twiml.voice_response import Say, VoiceResponse
+        message, code = "Your code for <Test> & co is", "a1B2"
+        response = VoiceResponse()
+        say = Say()
+        say.p(f",,,,,,,,,{message},,,,,,,,,...")
+        for char in code:
+            say.say_as(f",,,,,,,,...{char},,,,,,,,...", interpret_as="spell-out")
+        say.p(f",,,,,,,,,...Again, {message},,,,,,,,,")
+        for char in code:
+            say.say_as(f",,,,,,,,...{char},,,,,,,,...", interpret_as="spell-out")
+        say.p(",,,,,,Goodbye!")
+        response.append(say)
+        self.assertEqual(build_voice_twiml(message, code), str(response.to_xml()))
+
+    def test_message_context_and_rendering(self):
+        context = build_message_context(self.user, "123456", app_name="Test", url="http://testserver/mfa/")
+        self.assertTrue(deliver_mfa_code(self.user, context, mode="EMAIL"))
+        self.assertIn("Your code is: 123456", mail.outbox[0].body)
+
+
+class RouterTests(SimpleMFATestCase):
+
+    def test_default_database(self):
+        self.assertEqual(get_mfa_database(), "default")
+        self.assertEqual(get_user_database(), "default")
+        self.assertEqual(AuthCode.objects.all().db, "default")
+
+    @override_settings(MFA_DATABASE="mfa", MFA_USER_DATABASE="replica")
+    def test_separate_databases(self):
+        # querysets are only built, never evaluated, as the test databases do not include these aliases
+        for model in (AuthCode, DeliveryJob, TOTPDevice, TrustedDevice, MFAUserState):
+            with self.subTest(model=model.__name__):
+                self.assertEqual(model.objects.filter(user_id=self.user.id).db, "mfa")
+        self.assertEqual(get_user_database(), "replica")
+
+    @override_settings(MFA_DATABASE="mfa", MFA_USER_DATABASE="replica")
+    def test_router(self):
+        router = SimpleMFARouter()
+        code = AuthCode(user_id=self.user.id)
+        self.assertEqual(router.db_for_read(AuthCode), "mfa")
+        self.assertEqual(router.db_for_write(TrustedDevice), "mfa")
+        self.assertEqual(router.db_for_read(User, instance=code), "replica")
+        self.assertIsNone(router.db_for_read(User))
+        self.assertIsNone(router.db_for_write(User))
+        self.assertTrue(router.allow_relation(code, self.user))
+
+    def test_router_migrations(self):
+        router = SimpleMFARouter()
+        self.assertIsNone(router.allow_migrate("default", "auth"))
+        with self.settings(MFA_DATABASE="mfa"):
+            self.assertFalse(router.allow_migrate("mfa", "auth"))
+            self.assertIsNone(router.allow_migrate("mfa", "simplemfa"))
+            self.assertIsNone(router.allow_migrate("default", "auth"))
+
+    def test_user_deletion_deletes_mfa_data(self):
+        get_code_store().create_code_for_user(self.user.id)
+        TrustedDevice.objects.create(user=self.user, expires=timezone.now())
+        generate_recovery_codes(self.user.id, count=1)
+        rechallenge_user(self.user.id)
+        user_id = self.user.id
+        self.user.delete()
+        for model in (AuthCode, TrustedDevice, MFAUserState):
+            self.assertFalse(model.objects.filter(user_id=user_id).exists())
+        self.assertEqual(count_recovery_codes(user_id), 0)
+
+
+class InstrumentationTests(SimpleMFATestCase):
+
+    def setUp(self):
+        super().setUp()
+        get_metrics().reset()
+        self.addCleanup(get_metrics().reset)
+
+    def view(self, request):
+        with timed("mfa.hash"):
+            pass
+        return HttpResponse()
+
+    def get_response(self):
+        return ValidateMFAMiddleware(self.view)(RequestFactory().get("/"))
+
+    @override_settings(MFA_SERVER_TIMING=True)
+    def test_server_timing(self):
+        self.assertRegex(self.get_response()["Server-Timing"], r"^mfa\.hash;dur=\d+\.\d{3}$")
+
+    def test_server_timing_disabled(self):
+        self.assertNotIn("Server-Timing", self.get_response())
+
+    @override_settings(MFA_METRICS=True)
+    def test_metrics(self):
+        self.get_response()
+        self.get_response()
+        self.assertEqual(get_metrics().snapshot()["mfa.hash"]["count"], 2)
+
+    def test_metrics_disabled(self):
+        self.get_response()
+        self.assertEqual(get_metrics().snapshot(), {})
+
+
+@override_settings(**VIEW_SETTINGS)
+class BenchmarkTests(SimpleMFATestCase):
+
+    def run_benchmark(self, *args):
+        stdout = StringIO()
+        # the command sets up its own test database; here it runs in this test's database instead
+        command = "simplemfa.management.commands.simplemfa_benchmark"
+        with mock.patch(f"{command}.setup_databases"), mock.patch(f"{command}.teardown_databases"), \
+                transaction.atomic():
+            call_command("simplemfa_benchmark", *args, stdout=stdout)
+            transaction.set_rollback(True)
+        return stdout.getvalue()
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "results.json")
+            stdout = self.run_benchmark("--only", "middleware", "verify", "codes", "totp", "--iterations", "5",
+                                        "--flow-iterations", "2", "--path", "/protected/", "--output", output)
+            with open(output) as f:
+                report = json.load(f)
+            self.assertEqual(report["meta"]["groups"], ["middleware", "verify", "codes", "totp"])
+            self.assertTrue(report["results"])
+            for name, result in report["results"].items():
+                self.assertIn(name, stdout)
+                self.assertGreater(result["iterations"], 0)
+
+            stdout = self.run_benchmark("--only", "codes", "--iterations", "5", "--compare", output)
+            self.assertIn("vs baseline", stdout)
+
+    def test_json_output(self):
+        report = json.loads(self.run_benchmark("--only", "codes", "--iterations", "5", "--json"))
+        self.assertEqual(report["meta"]["options"]["iterations"], 5)
+        self.assertTrue(report["results"])
+        for result in report["results"].values():
+            self.assertGreater(result["per_call_us"], 0)
+
+    def test_invalid_table_sizes(self):
+        with self.assertRaises(CommandError):
+            self.run_benchmark("--only", "cleanup", "--table-sizes", "many")
+
+
+class RechallengeTests(SimpleMFATestCase):
+
+    def test_rechallenge_bumps_epochs(self):
+        mfa_epochs, trust_epochs = get_mfa_epochs(self.user.id), get_epochs(self.user.id)
+        rechallenge_user(self.user.id)
+        self.assertEqual(get_mfa_epochs(self.user.id)[0], mfa_epochs[0] + 1)
+        self.assertEqual(get_epochs(self.user.id)[0], trust_epochs[0] + 1)
+        self.assertEqual(get_mfa_epochs(self.other.id), [0, 0])
+
+    def test_rechallenge_deletes_codes(self):
+        get_code_store().create_code_for_user(self.user.id)
+        DeliveryJob.enqueue(self.user.id, "EMAIL", app_name="Test", url="http://testserver/mfa/")
+        rechallenge_user(self.user.id)
+        self.assertFalse(AuthCode.objects.filter(user=self.user).exists())
+        self.assertFalse(DeliveryJob.objects.filter(user=self.user).exists())
+
+    def test_stale_reader_cannot_restore_old_epochs(self):
+        get_mfa_epochs(self.user.id)
+        get_epochs(self.user.id)
+        # a request read the epochs from the database before the re-challenge committed...
+        stale_mfa_epoch = MFAUserState.get_epoch(self.user.id, field="mfa_epoch")
+        stale_trust_epoch = MFAUserState.get_epoch(self.user.id, field="trust_epoch")
+        rechallenge_user(self.user.id)
+        # ...and tries to cache them afterwards
+        get_epoch_cache().add(mfa_epoch_key(self.user.id), stale_mfa_epoch)
+        get_device_cache().add(user_epoch_key(self.user.id), stale_trust_epoch)
+        self.assertEqual(get_mfa_epochs(self.user.id)[0], stale_mfa_epoch + 1)
+        self.assertEqual(get_epochs(self.user.id)[0], stale_trust_epoch + 1)
+
+    def test_rechallenge_users_in_chunks(self):
+        users = [self.user, self.other] + [User.objects.create_user(f"user{i}") for i in range(3)]
+        rechallenge_user(self.user.id)
+        self.assertEqual(rechallenge_users(User.objects.all(), chunk_size=2), 5)
+        self.assertEqual([get_mfa_epochs(user.id)[0] for user in users], [2, 1, 1, 1, 1])
+
+    def test_keep_codes_and_devices(self):
+        code = get_code_store().create_code_for_user(self.user.id)
+        rechallenge_user(self.user.id, codes=False, devices=False)
+        self.assertEqual(get_mfa_epochs(self.user.id)[0], 1)
+        self.assertEqual(get_epochs(self.user.id)[0], 0)
+        self.assertEqual(get_code_store().verify(self.user.id, code), CodeVerificationResult.VALID)
+
+    def test_rechallenge_all(self):
+        rechallenge_all()
+        self.assertEqual(get_mfa_epochs(self.user.id), [0, 1])
+        self.assertEqual(get_epochs(self.other.id), (0, 1))
+
+    def call_rechallenge(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command("simplemfa_rechallenge", *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_command(self):
+        stdout, stderr = self.call_rechallenge("--user", "alice", "--user", "nobody")
+        self.assertIn("Re-challenged 1 user(s)", stdout)
+        self.assertIn("1 username(s) do not exist", stderr)
+        self.assertEqual(get_mfa_epochs(self.user.id)[0], 1)
+        self.assertEqual(get_mfa_epochs(self.other.id)[0], 0)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("alice\n\nbob\n")
+            f.flush()
+            self.call_rechallenge("--file", f.name, "--keep-devices")
+        self.assertEqual(get_mfa_epochs(self.user.id)[0], 2)
+        self.assertEqual(get_mfa_epochs(self.other.id)[0], 1)
+        self.assertEqual(get_epochs(self.other.id)[0], 0)
+
+        self.call_rechallenge("--all")
+        self.assertEqual(get_mfa_epochs(self.other.id), [1, 1])
+
+    def test_command_requires_users(self):
+        with self.assertRaises(CommandError):
+            self.call_rechallenge()
+        with self.assertRaises(CommandError):
+            self.call_rechallenge("--file", "/nonexistent/users.txt")
+
+
+class AssertionTests(SimpleMFATestCase):
+
+    def test_valid_assertion(self):
+        self.assertTrue(verify_assertion(issue_assertion(self.user.id), self.user.id))
+
+    def test_assertion_is_bound_to_user(self):
+        self.assertFalse(verify_assertion(issue_assertion(self.user.id), self.other.id))
+
+    def test_expired_and_tampered_assertions(self):
+        self.assertFalse(verify_assertion(issue_assertion(self.user.id, max_age=-1), self.user.id))
+        assertion = issue_assertion(self.user.id)
+        self.assertFalse(verify_assertion(assertion[:-1] + ("A" if assertion[-1] != "A" else "B"), self.user.id))
+        self.assertFalse(verify_assertion("", self.user.id))
+
+    def test_rechallenge_ends_assertions(self):
+        assertion = issue_assertion(self.user.id)
+        other_assertion = issue_assertion(self.other.id)
+        rechallenge_user(self.user.id, devices=False)
+        self.assertFalse(verify_assertion(assertion, self.user.id))
+        self.assertTrue(verify_assertion(other_assertion, self.other.id))
+
+    def test_warm_check_is_one_cache_round_trip(self):
+        assertion = issue_assertion(self.user.id)
+        with mock.patch.object(LocMemCache, "get_many", autospec=True, side_effect=LocMemCache.get_many) as get_many, \
+                self.assertNumQueries(0):
+            self.assertTrue(verify_assertion(assertion, self.user.id))
+        self.assertEqual(get_many.call_count, 1)
+
+    @override_settings(CACHES={"default": TEST_SETTINGS["CACHES"]["default"],
+                               "devices": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                           "LOCATION": "simplemfa-tests-devices"}},
+                       MFA_TRUSTED_DEVICE_CACHE="devices")
+    def test_separate_epoch_caches(self):
+        assertion = issue_assertion(self.user.id)
+        self.assertTrue(verify_assertion(assertion, self.user.id))
+        revoke_user_devices(self.user.id)
+        self.assertFalse(verify_assertion(assertion, self.user.id))
+
+    def test_cold_cache(self):
+        assertion = issue_assertion(self.user.id)
+        cache.clear()
+        self.assertTrue(verify_assertion(assertion, self.user.id))
+        rechallenge_user(self.user.id)
+        cache.clear()
+        self.assertFalse(verify_assertion(assertion, self.user.id))
+
+    def test_device_revocation_ends_assertions(self):
+        assertion = issue_assertion(self.user.id)
+        revoke_user_devices(self.user.id)
+        self.assertFalse(verify_assertion(assertion, self.user.id))
+
+    def test_epoch_setting_ends_assertions(self):
+        assertion = issue_assertion(self.user.id)
+        with self.settings(MFA_ASSERTION_EPOCH=1):
+            self.assertFalse(verify_assertion(assertion, self.user.id))
+
+    def test_logout_deletes_cookie(self):
+        request = RequestFactory().get("/")
+        user_logged_out.send(sender=User, request=request, user=self.user)
+        response = ValidateMFAMiddleware(lambda request: HttpResponse()).finish_response(request, HttpResponse())
+        self.assertEqual(response.cookies[COOKIE_NAME]["max-age"], 0)
+        response = ValidateMFAMiddleware(lambda request: HttpResponse()).finish_response(RequestFactory().get("/"),
+                                                                                          HttpResponse())
+        self.assertNotIn(COOKIE_NAME, response.cookies)
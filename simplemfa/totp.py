@@ -0,0 +1,106 @@
+"""
+Time-based one-time passwords (RFC 6238) for authenticator apps
+
+Codes are computed locally from a shared secret, so TOTP logins need no delivery and no database
+writes. Replay protection (each time step can be used once per user) is kept in the Django cache.
+"""
+import base64
+import hashlib
+import hmac
+import secrets
+import struct
+import time
+from urllib.parse import quote, urlencode
+
+from django.core.cache import caches
+
+from simplemfa.conf import get_config
+
+
+SECRET_BYTES = 20  # 160 bits, the size recommended by RFC 4226
+
+
+def generate_secret():
+    return base64.b32encode(secrets.token_bytes(SECRET_BYTES)).decode("ascii").rstrip("=")
+
+
+def decode_secret(secret):
+    secret = secret.strip().replace(" ", "").upper()
+    return base64.b32decode(secret + "=" * (-len(secret) % 8))
+
+
+def get_counter(timestamp=None, period=30):
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp // period)
+
+
+def hotp_value(key, counter, digits=6):
+    digest = hmac.new(key, struct.pack(">Q", counter), hashlib.sha1).digest()
+    start = digest[-1] & 0x0F
+    return (int.from_bytes(digest[start:start + 4], "big") & 0x7FFFFFFF) % 10 ** digits
+
+
+def hotp_code(key, counter, digits=6):
+    return str(hotp_value(key, counter, digits=digits)).zfill(digits)
+
+
+def totp_code(secret, timestamp=None, period=30, digits=6):
+    return hotp_code(decode_secret(secret), get_counter(timestamp, period), digits=digits)
+
+
+def match_totp(secret, code, timestamp=None, period=30, digits=6, drift=1):
+    """
+    Returns the counter (time step) that code matches within +/- drift steps of the current one, or None
+    """
+    if code is None:
+        return None
+    code = str(code).strip()
+    if len(code) != digits or not code.isdigit():
+        return None
+    value = int(code)
+    key = decode_secret(secret)
+    current = get_counter(timestamp, period)
+    # every step in the window is computed (no early exit) so the time taken does not depend on the match
+    matched = None
+    for counter in range(current - drift, current + drift + 1):
+        if hotp_value(key, counter, digits) == value:
+            matched = counter
+    return matched
+
+
+def verify_totp(user_id, secret, code, timestamp=None):
+    """
+    Verifies code for the user's secret using the configured period, digits and drift window, and
+    rejects a code whose time step was already used by that user
+    """
+    config = get_config()
+    counter = match_totp(secret, code, timestamp=timestamp, period=config.MFA_TOTP_PERIOD,
+                         digits=config.MFA_TOTP_DIGITS, drift=config.MFA_TOTP_DRIFT_STEPS)
+    if counter is None:
+        return False
+    # the key lives until the step has left every possible drift window
+    timeout = config.MFA_TOTP_PERIOD * (2 * config.MFA_TOTP_DRIFT_STEPS + 2)
+    return caches[config.MFA_TOTP_CACHE].add(f"simplemfa:totp:{user_id}:{counter}", True, timeout=timeout)
+
+
+def get_provisioning_uri(secret, account_name, issuer=None):
+    config = get_config()
+    label = f"{issuer}:{account_name}" if issuer else account_name
+    params = {"secret": secret, "digits": config.MFA_TOTP_DIGITS, "period": config.MFA_TOTP_PERIOD}
+    if issuer:
+        params["issuer"] = issuer
+    return f"otpauth://totp/{quote(label)}?{urlencode(params)}"
+
+
+def get_qr_code_svg(data):
+    """
+    Renders data as an inline SVG QR code if the optional qrcode package is installed, otherwise None
+    """
+    try:
+        import qrcode
+        import qrcode.image.svg
+    except ImportError:
+        return None
+    image = qrcode.make(data, image_factory=qrcode.image.svg.SvgPathImage)
+    return image.to_string(encoding="unicode")
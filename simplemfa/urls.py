@@ -2,11 +2,13 @@ try:
     from django.urls import path as url
 except:
      from django.conf.urls import  url
-from simplemfa.views import MFALoginView, MFARequestView
+from simplemfa.views import MFALoginView, MFARequestView, MFATOTPEnrollView, MFARecoveryCodesView
 
 urlpatterns = [
     url(r'mfa_auth/', MFALoginView.as_view(), name="mfa-login"),
     url(r'mfa_request/', MFARequestView.as_view(), name="mfa-request"),
+    url(r'mfa_totp/', MFATOTPEnrollView.as_view(), name="mfa-totp"),
+    url(r'mfa_recovery/', MFARecoveryCodesView.as_view(), name="mfa-recovery"),
     ]
 
 app_name = "simplemfa"
\ No newline at end of file
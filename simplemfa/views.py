@@ -1,18 +1,35 @@
+import asyncio
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, reverse
 from django.views.generic import TemplateView, View
 from simplemfa.forms import MFAAuth
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from simplemfa.models import AuthCode
+from simplemfa.models import DeliveryJob, TOTPDevice, RecoveryCode
+from simplemfa.stores import get_code_store
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.http import JsonResponse
 from django.contrib import messages
-from django.utils import timezone
 from simplemfa.constants import MessageConstants
 from simplemfa.errors import MFACodeNotSentError
-from simplemfa.helpers import send_mfa_code, get_user_mfa_mode, get_user_phone, set_cookie, \
-    get_cookie_expiration, sanitize_email, sanitize_phone, template_fallback, build_mfa_request_url, build_mfa_post_url
+from simplemfa.helpers import send_mfa_code, get_user_mfa_mode, get_user_phone, \
+    get_cookie_expiration, sanitize_email, sanitize_phone, template_fallback, build_mfa_request_url, \
+    build_mfa_post_url, async_delivery_enabled, queue_mfa_code, asend_mfa_code, is_ajax
+from simplemfa.conf import get_config
+from simplemfa.totp import verify_totp, get_provisioning_uri, get_qr_code_svg
+from simplemfa.ratelimit import check_rate_limit, reset_rate_limit
+from simplemfa.coalesce import claim_code_request, release_code_request
+from simplemfa.devices import trust_device
+from simplemfa.assertions import set_assertion
+from simplemfa.rechallenge import set_mfa_authenticated, is_mfa_authenticated
+from simplemfa.recovery import generate_recovery_codes, count_recovery_codes
+
+
+# a code created by MFARequestView that still has to be sent
+CodeIssue = namedtuple("CodeIssue", ["code", "mode", "response"])
 
 
 class MFALoginView(LoginRequiredMixin, TemplateView):
@@ -25,27 +42,41 @@ class MFALoginView(LoginRequiredMixin, TemplateView):
         self.request = request
         self.next_url = request.GET.get("next", None)
         context = self.get_context_data(request=request)
+        if not context['mfa_code_sent'] and context['default_mode'] == "TOTP" and context['totp_enabled']:
+            # nothing has to be sent for an authenticator app, so go straight to the code form
+            request.session['_simplemfa_code_sent'] = context['mfa_code_sent'] = True
+            request.session['_simplemfa_mode'] = context['mfa_mode'] = "TOTP"
         context['form'] = self.form_class(initial={"user_id": request.user.id, "next": self.next_url})
         return render(request, self.get_template_names(), context)
 
     def post(self, request, *args, **kwargs):
         self.request = request
-        form_data = self.form_class(request.POST)
+
+        # refuse excess guesses before any code lookup or hashing happens
+        retry_after = check_rate_limit(request, "VERIFY")
+        if retry_after is not None:
+            return self.rate_limited(request, retry_after)
+
+        form_data = self.form_class(request.POST, user=request.user, mode=request.session.get('_simplemfa_mode'))
         user_authenticated = form_data.authenticate()
         self.next_url = form_data.cleaned_data.get("next", request.GET.get("next", None))
 
         # this authenticates the user for our MFA middleware based on result of form.authenticate()
-        request.session['_simplemfa_authenticated'] = user_authenticated
+        set_mfa_authenticated(request, user_authenticated)
 
         if user_authenticated:
+            reset_rate_limit(request, "VERIFY")
             if self.next_url is not None:
                 response = redirect(self.next_url, request)
             else:
-                redirect_view = settings.LOGIN_REDIRECT_URL if hasattr(settings, 'LOGIN_REDIRECT_URL') else "index"
+                redirect_view = settings.LOGIN_REDIRECT_URL or "index"
                 response = redirect(reverse(redirect_view), request)
 
             if form_data.cleaned_data.get("trusted_device").upper() == "TRUE":
-                set_cookie(response, "_simplemfa_trusted_device", timezone.now())
+                trust_device(request, response)
+
+            if get_config().MFA_ASSERTION_ENABLED:
+                set_assertion(response, request.user.pk)
 
             return response
         else:
@@ -55,6 +86,15 @@ class MFALoginView(LoginRequiredMixin, TemplateView):
             messages.add_message(request, messages.ERROR, MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
             return render(request, self.get_template_names(), context)
 
+    def rate_limited(self, request, retry_after):
+        self.next_url = request.POST.get("next", request.GET.get("next", None))
+        context = self.get_context_data(request=request)
+        context['form'] = self.form_class(initial={"user_id": request.user.id, "next": self.next_url})
+        messages.add_message(request, messages.ERROR, MessageConstants.MFA_RATE_LIMITED)
+        response = render(request, self.get_template_names(), context, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+
     def get_template_names(self):
         return template_fallback([self.template_name, "simplemfa/auth.html", "simplemfa/mfa_auth.html"])
 
@@ -65,6 +105,9 @@ class MFALoginView(LoginRequiredMixin, TemplateView):
         request = kwargs.get("request", self.request)
         context['next'] = request.GET.get("next", self.next_url)
         context['mfa_code_sent'] = request.session.get("_simplemfa_code_sent", False)
+        context['mfa_mode'] = request.session.get("_simplemfa_mode", None)
+        context['totp_enabled'] = TOTPDevice.objects.filter(user_id=request.user.id, confirmed=True).exists()
+        context['recovery_enabled'] = RecoveryCode.objects.filter(user_id=request.user.id).exists()
         context['userid'] = request.user.id
         context['default_mode'] = get_user_mfa_mode(request)
         context['trusted_device_days'] = get_cookie_expiration()
@@ -83,65 +126,72 @@ OUTPUT: JSON response (result)
 
 
 class MFARequestView(LoginRequiredMixin, View):
+    """
+    Each request is handled in three steps: prepare (checks, session and code creation), send_code()
+    and complete_request(). Only send_code() waits on the network, which lets AsyncMFARequestView
+    await it natively.
+    """
 
     def get(self, request, *args, **kwargs):
+        issue = self.prepare_get(request)
+        if isinstance(issue, HttpResponse):
+            return issue
+        return self.complete_request(request, issue, self.send_code(request, issue.code, issue.mode))
+
+    def post(self, request, *args, **kwargs):
+        issue = self.prepare_post(request)
+        if isinstance(issue, HttpResponse):
+            return issue
+        return self.complete_request(request, issue, self.send_code(request, issue.code, issue.mode))
+
+    def prepare_get(self, request):
+        """
+        Returns the final response, or a CodeIssue if a new code was created and has to be sent
+        """
         reset = request.GET.get("reset", None)
+        status = request.GET.get("status", None)
         response = {}
 
-        if reset is not None and reset.upper() == "TRUE":
-            AuthCode.delete_all_codes_for_user(request.user.id)
+        if status is not None and status.upper() == "TRUE":
+            # polled by the client while an asynchronous delivery is outstanding
+            return JsonResponse(self.get_delivery_status(request))
+
+        is_reset = reset is not None and reset.upper() == "TRUE"
+        mode = request.GET.get("sent_via", get_user_mfa_mode(request))
+        coalesced = not is_reset and mode != "TOTP" and not claim_code_request(request.user.id, mode)
+        retry_after = None if is_reset or coalesced else check_rate_limit(request, "REQUEST")
+        if retry_after is not None:
+            release_code_request(request.user.id)
+            if is_ajax(request):
+                return self.rate_limited(request, retry_after)
+
+        if is_reset:
+            get_code_store().delete_all_codes_for_user(request.user.id)
+            DeliveryJob.cancel_pending_for_user(request.user.id)
+            release_code_request(request.user.id)
             request.session['_simplemfa_code_sent'] = False
+        elif coalesced:
+            # a repeat of a request that was just handled: the code already on its way is reused
+            if not is_ajax(request):
+                messages.add_message(request, messages.SUCCESS, MessageConstants.MFA_CODE_ALREADY_SENT)
+            else:
+                response.update(self.get_coalesced_response(request))
+        elif retry_after is not None:
+            # too many codes requested: nothing is created or sent
+            messages.add_message(request, messages.ERROR, MessageConstants.MFA_RATE_LIMITED)
         else:
-            mode = request.GET.get("sent_via", get_user_mfa_mode(request))
             try:
-                # delete old codes (if any) for this user
-                AuthCode.delete_all_codes_for_user(request.user.id)
-
-                # create the new MFA auth object
-                code = AuthCode.create_code_for_user(request.user.id, sent_via=mode)
-
-                # send email or text to the user, depending on selected mode
-                send_result = send_mfa_code(request, code, mode=mode)
-
-                # for testing in development
-                if settings.DEBUG:
-                    print("MFA CODE: " + code)
-
-                if code is not None and send_result:
-                    # this triggers the verification form to show
-                    request.session['_simplemfa_code_sent'] = True
-
-                    # the result is good, code is created and sent
-                    if not request.is_ajax():
-                        messages.add_message(request, messages.SUCCESS, MessageConstants.MFA_NEW_CODE_SENT)
-                    else:
-                        response['code_created'] = True
-                else:
-                    raise MFACodeNotSentError
-
+                # create the new MFA code, replacing old codes (if any) for this user
+                return CodeIssue(self.create_code(request, mode), mode, response)
             except MFACodeNotSentError as e:
-                # something went wrong, let them know no new code was issued and show the request form again
-                AuthCode.delete_all_codes_for_user(request.user.id)
-                request.session['_simplemfa_code_sent'] = False
-                if not request.is_ajax():
-                    messages.add_message(request, messages.ERROR, e.message)
-                else:
-                    response['code_created'] = False
-                    response['message'] = e.message
-
-        if request.is_ajax():
-            return JsonResponse(response)
-        else:
-            next_url = request.GET.get("next", None)
-            url = reverse("mfa:mfa-login")
-            if next_url is not None:
-                url += f"?next={next_url}"
-            return redirect(url, request)
+                self.code_not_sent(request, e, response)
 
-    def post(self, request, *args, **kwargs):
+        return self.get_response(request, response)
+
+    def prepare_post(self, request):
         # request must be AJAX
-        if not request.is_ajax():
-            return HttpResponseBadRequest
+        if not is_ajax(request):
+            return HttpResponseBadRequest()
 
         # POST variables
         mode = request.POST.get("sent_via", request.GET.get("sent_via", get_user_mfa_mode(request)))
@@ -152,36 +202,278 @@ class MFARequestView(LoginRequiredMixin, View):
         if user_id is None or request.user.id != user_id:
             raise PermissionDenied
 
+        if mode != "TOTP" and not claim_code_request(request.user.id, mode):
+            return JsonResponse(self.get_coalesced_response(request))
+
+        retry_after = check_rate_limit(request, "REQUEST")
+        if retry_after is not None:
+            release_code_request(request.user.id)
+            return self.rate_limited(request, retry_after)
+
         # start doing some work
         response = {}
 
         try:
-            # delete any existing codes before issuing a new one
-            AuthCode.delete_all_codes_for_user(request.user.id)
+            # create the new MFA code, replacing any existing codes for this user
+            return CodeIssue(self.create_code(request, mode), mode, response)
+        except MFACodeNotSentError as e:
+            self.code_not_sent(request, e, response)
+        return JsonResponse(response)
 
-            # create the new MFA auth object
-            code = AuthCode.create_code_for_user(request.user.id, sent_via=mode)
+    def complete_request(self, request, issue, send_result):
+        code, mode, response = issue
 
-            # send code to the user, depending on selected mode
-            send_result = send_mfa_code(request, code, mode=mode)
+        # for testing in development
+        if settings.DEBUG and code:
+            print("MFA CODE: " + code)
 
-            # for testing in development
-            if settings.DEBUG:
-                print("MFA CODE: " + code)
+        if code is not None and send_result:
+            # this triggers the verification form to show
+            request.session['_simplemfa_code_sent'] = True
 
-            if code is not None and send_result:
-                request.session['_simplemfa_code_sent'] = True
-                # the result is good
-                response['code_created'] = True
-                response['message'] = MessageConstants.MFA_NEW_CODE_SENT
+            # the result is good, code is created and sent
+            if not is_ajax(request):
+                messages.add_message(request, messages.SUCCESS, self.get_issued_message(mode))
             else:
-                raise MFACodeNotSentError
-
-        except MFACodeNotSentError as e:
-            # something went wrong, let them know no new code was issued or sent
-            AuthCode.delete_all_codes_for_user(request.user.id)
+                response['code_created'] = True
+                response['message'] = self.get_issued_message(mode)
+                response.update(self.get_delivery_status(request))
+        else:
+            self.code_not_sent(request, MFACodeNotSentError(), response)
+        return self.get_response(request, response)
+
+    def code_not_sent(self, request, error, response):
+        # something went wrong, let them know no new code was issued and show the request form again
+        get_code_store().delete_all_codes_for_user(request.user.id)
+        release_code_request(request.user.id)
+        request.session['_simplemfa_code_sent'] = False
+        if not is_ajax(request):
+            messages.add_message(request, messages.ERROR, error.message)
+        else:
             response['code_created'] = False
-            request.session['_simplemfa_code_sent'] = False
-            response['message'] = e.message
+            response['message'] = error.message
 
-        return JsonResponse(response)
+    def get_response(self, request, response):
+        if is_ajax(request):
+            return JsonResponse(response)
+        next_url = request.GET.get("next", None)
+        url = reverse("mfa:mfa-login")
+        if next_url is not None:
+            url += f"?next={next_url}"
+        return redirect(url, request)
+
+    def rate_limited(self, request, retry_after):
+        response = JsonResponse({'code_created': False, 'message': MessageConstants.MFA_RATE_LIMITED}, status=429)
+        response['Retry-After'] = str(retry_after)
+        return response
+
+    def get_coalesced_response(self, request):
+        request.session['_simplemfa_code_sent'] = True
+        response = {'code_created': True, 'coalesced': True, 'message': MessageConstants.MFA_CODE_ALREADY_SENT}
+        response.update(self.get_delivery_status(request))
+        return response
+
+    def create_code(self, request, mode):
+        """
+        Returns the new plain-text code. TOTP codes come from the user's authenticator app, so nothing is
+        created and the code is empty.
+        """
+        request.session['_simplemfa_mode'] = mode
+        if not async_delivery_enabled():
+            request.session.pop('_simplemfa_delivery_job', None)
+        if mode == "TOTP":
+            if TOTPDevice.get_secret_for_user(request.user.id) is None:
+                raise MFACodeNotSentError(MessageConstants.MFA_TOTP_NOT_ENROLLED)
+            return ""
+        if async_delivery_enabled():
+            # the delivery worker creates the code as it sends it, so it is never stored in plain text.
+            # The previous code stops working now, as it would when replaced.
+            get_code_store().delete_all_codes_for_user(request.user.id)
+            return ""
+        return get_code_store().create_code_for_user(request.user.id, sent_via=mode)
+
+    def get_issued_message(self, mode):
+        if mode == "TOTP":
+            return MessageConstants.MFA_TOTP_READY
+        return MessageConstants.MFA_NEW_CODE_QUEUED if async_delivery_enabled() else MessageConstants.MFA_NEW_CODE_SENT
+
+    def send_code(self, request, code, mode):
+        if code is None:
+            return False
+        if mode == "TOTP":
+            return True
+        if async_delivery_enabled():
+            return self.queue_code(request, mode)
+        channel = send_mfa_code(request, code, mode=mode)
+        if channel is not None and channel != mode:
+            self.record_delivery(request, channel)
+        return channel
+
+    def record_delivery(self, request, channel):
+        # the code was delivered through another channel than the one requested (fan-out or email fallback)
+        get_code_store().record_delivery(request.user.id, channel)
+
+    def queue_code(self, request, mode):
+        # hand the code to the outbox; the simplemfa_deliver worker sends it
+        job = queue_mfa_code(request, mode=mode)
+        request.session['_simplemfa_delivery_job'] = job.id
+        return True
+
+    def get_delivery_status(self, request):
+        job_id = request.session.get('_simplemfa_delivery_job', None)
+        if job_id is None:
+            return {}
+        status = DeliveryJob.objects.filter(id=job_id, user_id=request.user.id) \
+            .values_list("status", flat=True).first()
+        return {'delivery_id': job_id, 'delivery_status': status}
+
+
+class AsyncLoginRequiredMixin(LoginRequiredMixin):
+    """
+    LoginRequiredMixin for views with async handlers
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        # request.user is loaded lazily from the session and the database
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return self.handle_no_permission()
+        response = super(LoginRequiredMixin, self).dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+
+class AsyncMFALoginView(AsyncLoginRequiredMixin, MFALoginView):
+    """
+    MFALoginView for ASGI deployments (Django 4.1+). Verifying a code is short database and CPU work,
+    so each request makes a single hop to the ORM's thread.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        return await sync_to_async(super().get)(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(super().post)(request, *args, **kwargs)
+
+
+class AsyncMFARequestView(AsyncLoginRequiredMixin, MFARequestView):
+    """
+    MFARequestView for ASGI deployments (Django 4.1+). The database work before and after delivery runs
+    in one thread hop each, and delivery itself is awaited through the backends' asend(), so no thread
+    is held while waiting on the email or SMS provider.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        issue = await sync_to_async(self.prepare_get)(request)
+        if isinstance(issue, HttpResponse):
+            return issue
+        send_result = await self.asend_code(request, issue.code, issue.mode)
+        return await sync_to_async(self.complete_request)(request, issue, send_result)
+
+    async def post(self, request, *args, **kwargs):
+        issue = await sync_to_async(self.prepare_post)(request)
+        if isinstance(issue, HttpResponse):
+            return issue
+        send_result = await self.asend_code(request, issue.code, issue.mode)
+        return await sync_to_async(self.complete_request)(request, issue, send_result)
+
+    async def asend_code(self, request, code, mode):
+        if code is None:
+            return False
+        if mode == "TOTP":
+            return True
+        if async_delivery_enabled():
+            return await sync_to_async(self.queue_code)(request, mode)
+        channel = await asend_mfa_code(request, code, mode=mode)
+        if channel is not None and channel != mode:
+            await sync_to_async(self.record_delivery)(request, channel)
+        return channel
+
+
+class MFATOTPEnrollView(LoginRequiredMixin, TemplateView):
+    """
+    Sets up an authenticator app for the TOTP mode: shows the secret (and a QR code if the optional
+    qrcode package is installed) and confirms enrollment once the user enters a valid code. Changing
+    the second factor requires an MFA-authenticated session.
+    """
+    template_name = "simplemfa/totp_enroll.html"
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated and not is_mfa_authenticated(request):
+            return redirect(f"{reverse('simplemfa:mfa-login')}?next={request.path}")
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return render(request, self.get_template_names(), self.get_context_data(request=request))
+
+    def post(self, request, *args, **kwargs):
+        if request.POST.get("action", "").upper() == "REMOVE":
+            TOTPDevice.objects.filter(user_id=request.user.id).delete()
+            messages.add_message(request, messages.SUCCESS, MessageConstants.MFA_TOTP_REMOVED)
+            return redirect(reverse("simplemfa:mfa-totp"))
+
+        retry_after = check_rate_limit(request, "VERIFY")
+        if retry_after is not None:
+            messages.add_message(request, messages.ERROR, MessageConstants.MFA_RATE_LIMITED)
+            response = render(request, self.get_template_names(), self.get_context_data(request=request), status=429)
+            response['Retry-After'] = str(retry_after)
+            return response
+
+        device = TOTPDevice.get_or_start_enrollment(request.user.id)
+        if not device.confirmed and verify_totp(request.user.id, device.secret, request.POST.get("auth_code")):
+            device.confirm()
+            reset_rate_limit(request, "VERIFY")
+            messages.add_message(request, messages.SUCCESS, MessageConstants.MFA_TOTP_ENROLLED)
+            return redirect(reverse("simplemfa:mfa-totp"))
+
+        messages.add_message(request, messages.ERROR, MessageConstants.MFA_CODE_NOT_AUTHENTICATED)
+        return render(request, self.get_template_names(), self.get_context_data(request=request))
+
+    def get_template_names(self):
+        return template_fallback([self.template_name, "simplemfa/totp_enroll.html"])
+
+    def get_context_data(self, **kwargs):
+        context = super(MFATOTPEnrollView, self).get_context_data(**kwargs)
+        request = kwargs.get("request", self.request)
+        device = TOTPDevice.get_or_start_enrollment(request.user.id)
+        context['enrolled'] = device.confirmed
+        if not device.confirmed:
+            config = get_config()
+            issuer = config.MFA_TOTP_ISSUER or config.APP_NAME or request.get_host()
+            uri = get_provisioning_uri(device.secret, request.user.get_username(), issuer=issuer)
+            context['secret'] = device.secret
+            context['provisioning_uri'] = uri
+            context['qr_code'] = get_qr_code_svg(uri)
+        return context
+
+
+class MFARecoveryCodesView(LoginRequiredMixin, TemplateView):
+    """
+    Creates a new set of one-time recovery codes and shows them once. Like MFATOTPEnrollView, it
+    requires an MFA-authenticated session.
+    """
+    template_name = "simplemfa/recovery_codes.html"
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.user.is_authenticated and not is_mfa_authenticated(request):
+            return redirect(f"{reverse('simplemfa:mfa-login')}?next={request.path}")
+        return super().dispatch(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return render(request, self.get_template_names(), self.get_context_data(request=request))
+
+    def post(self, request, *args, **kwargs):
+        codes = generate_recovery_codes(request.user.id)
+        messages.add_message(request, messages.SUCCESS, MessageConstants.MFA_RECOVERY_CODES_GENERATED)
+        # the plain-text codes are never stored, so they are rendered here rather than after a redirect
+        return render(request, self.get_template_names(), self.get_context_data(request=request, codes=codes))
+
+    def get_template_names(self):
+        return template_fallback([self.template_name, "simplemfa/recovery_codes.html"])
+
+    def get_context_data(self, **kwargs):
+        context = super(MFARecoveryCodesView, self).get_context_data(**kwargs)
+        request = kwargs.get("request", self.request)
+        context['remaining'] = count_recovery_codes(request.user.id)
+        return context